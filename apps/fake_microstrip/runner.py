@@ -0,0 +1,111 @@
+"""Synthetic solver that replays the resource profile of a real plugin.
+
+Reads ``profile.json`` next to this script and, without AEDT or PyEDB,
+burns CPU, ramps memory up to the recorded peak and writes an output tree
+of the recorded shape.  Environment variables scale the run for offline
+tests: ``FAKE_SOLVER_TIME_SCALE``, ``FAKE_SOLVER_SIZE_SCALE`` and
+``FAKE_SOLVER_MEMORY_SCALE`` (all default to 1.0).
+"""
+import argparse
+import json
+import os
+import re
+import time
+
+_CHUNK = 1024 * 1024
+
+
+def _scale(name):
+    return float(os.environ.get(name, '1'))
+
+
+def _write_file(path, size, block):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # Write to a temporary name and rename so the file appears complete
+    tmp = path + '.part'
+    with open(tmp, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            n = min(remaining, len(block))
+            f.write(block[:n])
+            remaining -= n
+    os.replace(tmp, path)
+
+
+def _expand(pattern, index):
+    """Replace each ``#`` run in ``pattern`` with ``index``."""
+    return re.sub(r'#+', str(index), pattern)
+
+
+def _output_plan(outputs, size_scale):
+    """Return ``[(relative_path, size)]`` for the profile's outputs."""
+    plan = []
+    for entry in outputs:
+        kind = entry.get('type', 'file')
+        if kind == 'tree':
+            count = max(1, int(entry.get('files', 1)))
+            each = int(entry.get('bytes', 0) * size_scale) // count
+            for i in range(count):
+                plan.append((os.path.join(entry['name'], f'part_{i:04d}.bin'), each))
+        elif kind == 'group':
+            each = int(entry.get('bytes_each', 0) * size_scale)
+            for i in range(1, int(entry.get('count', 1)) + 1):
+                plan.append((_expand(entry['pattern'], i), each))
+        else:
+            plan.append((entry['name'], int(entry.get('bytes', 0) * size_scale)))
+    return plan
+
+
+def _burn(seconds):
+    end = time.perf_counter() + seconds
+    x = 0
+    while time.perf_counter() < end:
+        for i in range(10000):
+            x += i * i
+    return x
+
+
+def main(profile, inputs):
+    time_scale = _scale('FAKE_SOLVER_TIME_SCALE')
+    size_scale = _scale('FAKE_SOLVER_SIZE_SCALE')
+    memory_scale = _scale('FAKE_SOLVER_MEMORY_SCALE')
+    input_bytes = sum(os.path.getsize(p) for p in inputs if os.path.isfile(p))
+    print(f"Emulating {profile.get('plugin')} ({profile.get('source', 'unknown source')}), "
+          f"input {input_bytes} bytes", flush=True)
+
+    duration = profile['duration_s']['p50'] * time_scale
+    cpu_fraction = min(1.0, max(0.0, profile.get('cpu_fraction', 0.5)))
+    peak_bytes = int(profile.get('peak_rss_mb', 0) * 1024 * 1024 * memory_scale)
+    plan = _output_plan(profile.get('outputs', []), size_scale)
+
+    steps = max(1, min(20, len(plan)))
+    block = os.urandom(_CHUNK)
+    memory = []
+    written = 0
+    for step in range(steps):
+        print(f'PROGRESS {100 * step // steps} Step {step + 1}/{steps}', flush=True)
+        # Ramp resident memory linearly towards the recorded peak
+        target = peak_bytes * (step + 1) // steps
+        held = sum(len(m) for m in memory)
+        if target > held:
+            chunk = bytearray(target - held)
+            chunk[::4096] = b'\x01' * len(chunk[::4096])  # touch every page
+            memory.append(chunk)
+        slice_time = duration / steps
+        _burn(slice_time * cpu_fraction)
+        time.sleep(slice_time * (1 - cpu_fraction))
+        upto = len(plan) * (step + 1) // steps
+        for path, size in plan[written:upto]:
+            _write_file(path, size, block)
+        written = upto
+    print('PROGRESS 100 Done', flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded plugin resource profile.')
+    args, extra = parser.parse_known_args()
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, 'profile.json')) as f:
+        profile_data = json.load(f)
+    # Any argument that names an existing file is treated as an input
+    main(profile_data, [a for a in extra if not a.startswith('--')])
@@ -0,0 +1,121 @@
+"""Closed-form microstrip model, vectorised over frequency and geometry.
+
+* Static impedance and effective permittivity: Hammerstad and Jensen
+  (1980), including their strip thickness correction.
+* Dispersion of the effective permittivity: Kirschning and Jansen
+  (1982), valid to about 60 GHz for 0.1 <= W/h <= 100 and er <= 20.
+  The impedance follows with the usual power-current scaling
+  ``Z0(f) = Z0 * (eeff(f) - 1) / (eeff - 1) * sqrt(eeff / eeff(f))``.
+* Conductor loss from the strip's skin-effect resistance, blending into
+  the DC resistance when the skin depth exceeds the strip thickness,
+  plus the resistance of a thick ground plane.
+* Dielectric loss from the filling factor of the substrate.
+
+Inputs are in SI units and broadcast against each other, so a sweep
+over ``n`` frequencies for ``m`` widths is one call with ``f`` of shape
+``(n,)`` and ``w`` of shape ``(m, 1)``.
+"""
+import numpy as np
+
+C0 = 299792458.0
+MU0 = 4e-7 * np.pi
+ETA0 = MU0 * C0
+# Resistivity of copper (Ohm m), the metal of the Nexxim substrate definition
+RHO_COPPER = 1.724138e-8
+
+
+def _z01(u):
+    """Impedance of a zero-thickness strip in air, Hammerstad-Jensen."""
+    f = 6 + (2 * np.pi - 6) * np.exp(-(30.666 / u) ** 0.7528)
+    return ETA0 / (2 * np.pi) * np.log(f / u + np.sqrt(1 + (2 / u) ** 2))
+
+
+def _eeff0(u, er):
+    """Static effective permittivity of a zero-thickness strip."""
+    a = 1 + np.log((u ** 4 + (u / 52) ** 2) / (u ** 4 + 0.432)) / 49 + np.log(1 + (u / 18.1) ** 3) / 18.7
+    b = 0.564 * ((er - 0.9) / (er + 3)) ** 0.053
+    return (er + 1) / 2 + (er - 1) / 2 * (1 + 10 / u) ** (-a * b)
+
+
+def static(w, h, t, er):
+    """Return ``(z0, eeff)`` at DC for strip width ``w``, height ``h`` and thickness ``t``."""
+    u = w / h
+    if np.any(t > 0):
+        t = np.maximum(t, 1e-12)
+        coth = 1 / np.tanh(np.sqrt(6.517 * u))
+        du1 = t / (np.pi * h) * np.log(1 + 4 * np.e / (t / h * coth ** 2))
+        dur = 0.5 * (1 + 1 / np.cosh(np.sqrt(er - 1))) * du1
+        u1, ur = u + du1, u + dur
+    else:
+        u1 = ur = u
+    eeff_r = _eeff0(ur, er)
+    z0 = _z01(ur) / np.sqrt(eeff_r)
+    eeff = eeff_r * (_z01(u1) / _z01(ur)) ** 2
+    return z0, eeff
+
+
+def dispersion(f, w, h, er, eeff):
+    """Effective permittivity at frequency ``f``, Kirschning-Jansen."""
+    u = w / h
+    fn = f * 1e-9 * h * 1e3  # GHz * mm
+    p1 = 0.27488 + (0.6315 + 0.525 / (1 + 0.0157 * fn) ** 20) * u - 0.065683 * np.exp(-8.7513 * u)
+    p2 = 0.33622 * (1 - np.exp(-0.03442 * er))
+    p3 = 0.0363 * np.exp(-4.6 * u) * (1 - np.exp(-(fn / 38.7) ** 4.97))
+    p4 = 1 + 2.751 * (1 - np.exp(-(er / 15.916) ** 8))
+    p = p1 * p2 * ((0.1844 + p3 * p4) * fn) ** 1.5763
+    return er - (er - eeff) / (1 + p)
+
+
+def line(f, w, h, length, er, tand, t=1.778e-5, rho=RHO_COPPER, z_ref=50.0):
+    """Solve a microstrip line of ``length`` between ``z_ref`` ports.
+
+    Returns a dict of arrays broadcast over the inputs: ``z0`` and
+    ``eeff`` (frequency dependent), ``alpha_c`` and ``alpha_d`` (Np/m),
+    ``s11`` and ``s21`` (complex).  ``er`` must be greater than 1, as the
+    dielectric loss is scaled by the filling factor ``(eeff - 1) / (er - 1)``.
+    """
+    f = np.asarray(f, dtype=float)
+    z0_dc, eeff_dc = static(w, h, t, er)
+    eeff = dispersion(f, w, h, er, eeff_dc)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.where(eeff_dc > 1, (eeff - 1) / (eeff_dc - 1), 1.0)
+    z0 = z0_dc * scale * np.sqrt(eeff_dc / eeff)
+
+    omega = 2 * np.pi * f
+    with np.errstate(divide='ignore'):
+        skin = np.where(f > 0, np.sqrt(2 * rho / (omega * MU0)), np.inf)
+    # Current fills the strip at DC and crowds into one skin depth above
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t_eff = np.where(np.isinf(skin), t, skin * -np.expm1(-t / skin))
+    r_strip = rho / (w * t_eff)
+    r_ground = rho / (w * skin)
+    alpha_c = (r_strip + r_ground) / (2 * z0)
+    k0 = omega / C0
+    alpha_d = k0 * er * (eeff - 1) * tand / (2 * np.sqrt(eeff) * (er - 1))
+    gamma = alpha_c + alpha_d + 1j * k0 * np.sqrt(eeff)
+
+    gl = gamma * length
+    ratio = z0 / z_ref
+    denom = 2 * np.cosh(gl) + (ratio + 1 / ratio) * np.sinh(gl)
+    return {
+        'z0': z0 * np.ones_like(gl.real),
+        'eeff': eeff * np.ones_like(gl.real),
+        'alpha_c': alpha_c * np.ones_like(gl.real),
+        'alpha_d': alpha_d * np.ones_like(gl.real),
+        's11': (ratio - 1 / ratio) * np.sinh(gl) / denom,
+        's21': 2 / denom,
+    }
+
+
+def width_for(z_target, h, er, t=1.778e-5, lo=1e-3, hi=50.0, steps=60):
+    """Strip width giving static impedance ``z_target``, by bisection on W/h."""
+    lo = np.full(np.broadcast(z_target, h, er).shape, lo, dtype=float)
+    hi = np.full_like(lo, hi)
+    for _ in range(steps):
+        mid = np.sqrt(lo * hi)
+        z0, _ = static(mid * h, h, t, er)
+        # Impedance falls as the strip gets wider
+        too_narrow = z0 > z_target
+        lo = np.where(too_narrow, mid, lo)
+        hi = np.where(too_narrow, hi, mid)
+    return np.sqrt(lo * hi) * h
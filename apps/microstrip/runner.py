@@ -1,14 +1,80 @@
-"""Simulate a microstrip line in AEDT and plot dB(S21)."""
+"""Simulate a microstrip line and plot dB(S21).
+
+``--mode analytic`` evaluates closed-form models (see
+``microstrip_model.py``) over the whole sweep in milliseconds; thickness,
+Er, TanD, width and length may then be comma-separated lists and every
+combination is plotted.  ``--mode full`` runs a Nexxim analysis in AEDT
+Circuit, and ``--mode both`` overlays the two for comparison.
+"""
 import argparse
+import csv
+import html
+import itertools
 import os
+import re
 import tempfile
+import time
+import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-from pyaedt import Circuit
 
+import microstrip_model
+
+# Strip thickness of the Nexxim substrate definition (m)
+METAL_THICKNESS = 1.778e-5
+UNITS = {'hz': 1.0, 'khz': 1e3, 'mhz': 1e6, 'ghz': 1e9}
+# Largest number of parameter combinations in one analytic run
+MAX_COMBINATIONS = 500
+# Curves drawn with a legend; larger grids are only shaded by index
+MAX_LEGEND = 12
+
+
+def parse_values(text, name):
+    """Parse ``"1.2"`` or ``"0.1, 0.2, 0.3"`` into a list of floats."""
+    try:
+        values = [float(v) for v in str(text).split(',') if v.strip()]
+    except ValueError:
+        raise SystemExit(f'Invalid {name}: {text!r}')
+    if not values:
+        raise SystemExit(f'Missing {name}')
+    return values
+
+
+def parse_sweep(srange):
+    """Turn ``"0GHz 20GHz 2001"`` into the sweep's frequencies in Hz."""
+    parts = srange.split()
+    if len(parts) != 3:
+        raise SystemExit(f'Sweep range must be "<start> <stop> <points>", got {srange!r}')
+    bounds = []
+    for part in parts[:2]:
+        match = re.fullmatch(r'([-+0-9.eE]+)\s*([a-zA-Z]*)', part)
+        if not match or match.group(2).lower() not in UNITS | {'': 1.0}:
+            raise SystemExit(f'Invalid frequency {part!r}')
+        bounds.append(float(match.group(1)) * UNITS.get(match.group(2).lower(), 1.0))
+    return np.linspace(bounds[0], bounds[1], int(parts[2]))
+
+
+def analytic(freqs, thickness, er, tand, width, length):
+    """Evaluate every parameter combination; lengths are in mm.
+
+    Returns ``(combos, result)`` where ``result`` holds arrays of shape
+    ``(len(combos), len(freqs))``.
+    """
+    combos = list(itertools.product(thickness, er, tand, width, length))
+    if len(combos) > MAX_COMBINATIONS:
+        raise SystemExit(f'{len(combos)} parameter combinations, at most {MAX_COMBINATIONS} are allowed')
+    h, e, d, w, ln = (np.array(col, dtype=float)[:, None] for col in zip(*combos))
+    result = microstrip_model.line(
+        freqs, w * 1e-3, h * 1e-3, ln * 1e-3, e, d, t=METAL_THICKNESS,
+    )
+    return combos, result
+
+
+def full_solve(thickness, er, tand, width, length, srange):
+    """Run the Nexxim analysis and return ``(freq_ghz, db_s21)``."""
+    from pyaedt import Circuit
 
-def main(thickness, er, tand, width, length, srange):
     # Create a simple netlist for a microstrip transmission line
     netlist = f"""
 .SUB Substrate MS( H={float(thickness)*1e-3} Er={er} TAND={tand} TANM=0 MSat=0 MRem=0 HU=0.025
@@ -21,8 +87,10 @@ A1 Port1 Port2 W={float(width)*1e-3} P={float(length)*1e-3} COMPONENT=TRL SUBSTR
     with open(netlist_file, "w") as f:
         f.write(netlist)
 
+    print('PROGRESS 5 Launching AEDT Circuit', flush=True)
     circuit = Circuit()
     try:
+        print('PROGRESS 20 Building schematic', flush=True)
         circuit.modeler.schematic.create_interface_port('Port1')
         circuit.modeler.schematic.create_interface_port('Port2')
         oModule = circuit.odesign.GetModule("DataBlock")
@@ -35,10 +103,106 @@ A1 Port1 Port2 W={float(width)*1e-3} P={float(length)*1e-3} COMPONENT=TRL SUBSTR
             ])
         setup = circuit.create_setup(setup_type=circuit.SETUPS.NexximLNA)
         setup.props['SweepDefinition']['Data'] = f'LINC {srange}'
+        print('PROGRESS 40 Running Nexxim analysis', flush=True)
         setup.analyze()
+        print('PROGRESS 80 Plotting results', flush=True)
         data = circuit.post.get_solution_data('dB(S21)')
-        x = data.primary_sweep_values
-        y = data.data_real()
+        return list(data.primary_sweep_values), list(data.data_real())
+    finally:
+        circuit.release_desktop(True, True)
+
+
+def _label(combo, varying):
+    names = ('H', 'Er', 'TanD', 'W', 'L')
+    parts = [f'{names[i]}={combo[i]:g}' for i in varying]
+    return ', '.join(parts) or f'W={combo[3]:g} mm'
+
+
+def plot_analytic(freqs, combos, result, full=None):
+    """Write ``s21.png`` and ``z0.png``; ``full`` overlays the Nexxim curve."""
+    varying = [i for i in range(5) if len({c[i] for c in combos}) > 1]
+    ghz = freqs / 1e9
+    db = 20 * np.log10(np.abs(result['s21']))
+    legend = len(combos) <= MAX_LEGEND
+    colors = plt.cm.viridis(np.linspace(0, 0.9, len(combos)))
+    for name, values, ylabel in (('s21.png', db, 'dB(S21)'), ('z0.png', result['z0'], 'Z0 (Ohm)')):
+        fig, ax = plt.subplots(figsize=(8, 5))
+        for idx, combo in enumerate(combos):
+            ax.plot(ghz, values[idx], color=colors[idx],
+                    label=('Analytic ' if full is not None else '') + _label(combo, varying) if legend else None)
+        if full is not None and name == 's21.png':
+            ax.plot(full[0], full[1], 'k--', label='Nexxim')
+        ax.grid(True)
+        ax.set_xlabel('Frequency (GHz)')
+        ax.set_ylabel(ylabel)
+        if legend:
+            ax.legend(fontsize='small')
+        fig.tight_layout()
+        fig.savefig(name)
+        plt.close(fig)
+    return ['s21.png', 'z0.png']
+
+
+def write_csv(path, freqs, combos, result):
+    """One row per combination and frequency."""
+    db = 20 * np.log10(np.abs(result['s21']))
+    db11 = 20 * np.log10(np.maximum(np.abs(result['s11']), 1e-15))
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['thickness_mm', 'er', 'tand', 'width_mm', 'length_mm', 'freq_ghz',
+                         'db_s21', 'db_s11', 'z0_ohm', 'eeff', 'alpha_c_db_per_m', 'alpha_d_db_per_m'])
+        for idx, combo in enumerate(combos):
+            for k, freq in enumerate(freqs):
+                writer.writerow(list(combo) + [
+                    f'{freq / 1e9:.6g}', f'{db[idx, k]:.6g}', f'{db11[idx, k]:.6g}',
+                    f"{result['z0'][idx, k]:.6g}", f"{result['eeff'][idx, k]:.6g}",
+                    f"{result['alpha_c'][idx, k] * 8.686:.6g}", f"{result['alpha_d'][idx, k] * 8.686:.6g}",
+                ])
+
+
+def summary_rows(freqs, combos, result):
+    """Key figures per combination for the report table."""
+    db = 20 * np.log10(np.abs(result['s21']))
+    rows = []
+    for idx, (h, er, tand, w, ln) in enumerate(combos):
+        w50 = float(microstrip_model.width_for(50.0, h * 1e-3, er, t=METAL_THICKNESS)) * 1e3
+        rows.append([h, er, tand, w, ln, f"{result['z0'][idx, 0]:.2f}", f"{result['eeff'][idx, 0]:.3f}",
+                     f'{db[idx, -1]:.3f}', f'{w50:.4f}'])
+    return rows
+
+
+def write_index(images, summary=None, notes=()):
+    parts = ['<html><body>']
+    parts += [f'<p>{html.escape(n)}</p>' for n in notes]
+    if summary:
+        header = ['H (mm)', 'Er', 'TanD', 'W (mm)', 'L (mm)', 'Z0 (Ohm)', 'Eeff',
+                  'dB(S21) at stop', 'W for 50 Ohm (mm)']
+        parts.append('<table border="1" cellpadding="4"><tr>'
+                     + ''.join(f'<th>{h}</th>' for h in header) + '</tr>')
+        for row in summary:
+            parts.append('<tr>' + ''.join(f'<td>{c}</td>' for c in row) + '</tr>')
+        parts.append('</table>')
+    parts += [f'<img src="{img}" alt="{img}">' for img in images]
+    parts.append('</body></html>')
+    with open('index.html', 'w') as f:
+        f.write('\n'.join(parts))
+
+
+def main(thickness, er, tand, width, length, srange, mode='analytic'):
+    values = [parse_values(v, n) for v, n in (
+        (thickness, 'thickness'), (er, 'Er'), (tand, 'TanD'), (width, 'width'), (length, 'length'))]
+    # The loss model divides by er - 1
+    if min(values[1]) <= 1:
+        raise SystemExit(f'Er must be greater than 1, got {min(values[1]):g}')
+    if mode != 'analytic' and any(len(v) > 1 for v in values):
+        raise SystemExit('Parameter lists are only supported in analytic mode')
+
+    full = None
+    images = []
+    notes = []
+    if mode in ('full', 'both'):
+        x, y = full_solve(thickness, er, tand, width, length, srange)
+        full = (np.asarray(x, dtype=float), np.asarray(y, dtype=float))
         plt.grid(True)
         plt.xlabel('Frequency (GHz)')
         plt.ylabel('dB(S21)')
@@ -47,10 +211,29 @@ A1 Port1 Port2 W={float(width)*1e-3} P={float(length)*1e-3} COMPONENT=TRL SUBSTR
         img_file = 'microstrip.png'
         plt.savefig(img_file)
         plt.close()
-        with open('index.html', 'w') as f:
-            f.write(f'<html><body><img src="{img_file}" alt="Microstrip"></body></html>')
-    finally:
-        circuit.release_desktop(True, True)
+        images.append(img_file)
+    if mode == 'full':
+        write_index(images)
+        print('PROGRESS 100 Done', flush=True)
+        return
+
+    print('PROGRESS 85 Evaluating closed-form model' if full is not None else 'PROGRESS 10 Evaluating closed-form model',
+          flush=True)
+    freqs = parse_sweep(srange)
+    start = time.perf_counter()
+    combos, result = analytic(freqs, *values)
+    elapsed = (time.perf_counter() - start) * 1000
+    notes.append(f'Closed-form model: {len(combos)} combination(s) x {len(freqs)} frequencies '
+                 f'in {elapsed:.1f} ms (Hammerstad-Jensen, Kirschning-Jansen dispersion).')
+    print(notes[-1], flush=True)
+    if full is not None:
+        analytic_db = 20 * np.log10(np.abs(result['s21'][0]))
+        deviation = np.max(np.abs(np.interp(full[0] * 1e9, freqs, analytic_db) - full[1]))
+        notes.append(f'Largest difference between Nexxim and the closed-form model: {deviation:.3f} dB.')
+    images = plot_analytic(freqs, combos, result, full) + images
+    write_csv('microstrip.csv', freqs, combos, result)
+    write_index(images, summary_rows(freqs, combos, result), notes)
+    print('PROGRESS 100 Done', flush=True)
 
 
 if __name__ == '__main__':
@@ -61,5 +244,7 @@ if __name__ == '__main__':
     parser.add_argument('--width', required=True, help='Trace width in mm')
     parser.add_argument('--length', required=True, help='Trace length in mm')
     parser.add_argument('--srange', required=True, help='Sweep range, e.g., "0GHz 20GHz 2001"')
+    parser.add_argument('--mode', choices=('analytic', 'full', 'both'), default='analytic',
+                        help='Closed-form model, Nexxim solve, or both overlaid')
     args = parser.parse_args()
-    main(args.thickness, args.er, args.tand, args.width, args.length, args.srange)
+    main(args.thickness, args.er, args.tand, args.width, args.length, args.srange, args.mode)
@@ -1,13 +1,27 @@
-"""Convert a BRD layout to AEDB and export its stackup table."""
+"""Convert a BRD layout to AEDB and export its stackup table.
+
+A zip of ``.brd`` files is converted in batch by a pool of ``--workers``
+processes into one ``<board>_aedb.zip`` per board, a ``stackup.xlsx``
+with one sheet per board and a ``result.html`` summary.
+"""
 import argparse
+import html
 import os
+import re
+import shutil
+import time
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import openpyxl
 from openpyxl import Workbook
 from pyedb import Edb
 
 
-def export_stackup(edb_obj, xlsx_path):
+HEADER = ['Layer Name', 'Type', 'Thickness (mm)', 'Permittivity', 'Loss Tangent', 'Conductivity (S/m)']
+
+
+def stackup_rows(edb_obj):
+    """Return one row per stackup layer, in the order of :data:`HEADER`."""
     data = []
     for layer_name, layer in edb_obj.stackup.stackup_layers.items():
         m = edb_obj.materials.materials[layer.material]
@@ -28,12 +42,15 @@ def export_stackup(edb_obj, xlsx_path):
             loss_tangent,
             conductivity
         ])
+    return data
+
+
+def export_stackup(edb_obj, xlsx_path):
     wb = Workbook()
     ws = wb.active
     ws.title = "Stackup"
-    header = ['Layer Name', 'Type', 'Thickness (mm)', 'Permittivity', 'Loss Tangent', 'Conductivity (S/m)']
-    ws.append(header)
-    for row in data:
+    ws.append(HEADER)
+    for row in stackup_rows(edb_obj):
         ws.append(row)
     wb.save(xlsx_path)
 
@@ -42,14 +59,35 @@ def table_html(xlsx_path, html_path):
     """Generate a styled HTML table from the stackup Excel sheet."""
     wb = openpyxl.load_workbook(xlsx_path)
     ws = wb["Stackup"]
+    write_page(html_path, f"<table>\n{html_rows(ws.iter_rows(values_only=True))}\n</table>")
+
 
-    rows = []
-    for idx, r in enumerate(ws.iter_rows(values_only=True)):
+def html_rows(rows):
+    """Render table rows, the first one as the header."""
+    out = []
+    for idx, r in enumerate(rows):
         tag = "th" if idx == 0 else "td"
-        cells = "".join(f"<{tag}>{c}</{tag}>" for c in r)
-        rows.append(f"<tr>{cells}</tr>")
+        cells = "".join(f"<{tag}>{html.escape(str(c)) if c is not None else ''}</{tag}>" for c in r)
+        out.append(f"<tr>{cells}</tr>")
+    return ''.join(out)
+
 
-    html = f"""<!DOCTYPE html>
+def write_page(html_path, body, centered=True):
+    """Write ``body`` into the report page shared by single and batch runs."""
+    layout = """body {
+  display: flex;
+  justify-content: center;
+  align-items: center;
+  background: #f8f9fa;
+}""" if centered else """body {
+  background: #f8f9fa;
+  font-family: sans-serif;
+  padding: 1em 2em;
+}
+table {
+  margin-bottom: 2em;
+}"""
+    page = f"""<!DOCTYPE html>
 <html>
 <head>
 <meta charset='UTF-8'>
@@ -58,12 +96,7 @@ html, body {{
   height: 100%;
   margin: 0;
 }}
-body {{
-  display: flex;
-  justify-content: center;
-  align-items: center;
-  background: #f8f9fa;
-}}
+{layout}
 table {{
   border-collapse: collapse;
   box-shadow: 0 2px 6px rgba(0,0,0,0.1);
@@ -82,38 +115,192 @@ tr:nth-child(odd) {{
 </style>
 </head>
 <body>
-<table>
-{''.join(rows)}
-</table>
+{body}
 </body>
 </html>"""
 
     with open(html_path, "w", encoding="utf-8") as f:
-        f.write(html)
+        f.write(page)
+
+
+def zip_dir(src_dir, zip_name, arc_root):
+    with zipfile.ZipFile(zip_name, 'w', zipfile.ZIP_DEFLATED) as z:
+        for root, _, files in os.walk(src_dir):
+            for f in files:
+                p = os.path.join(root, f)
+                arc = os.path.relpath(p, src_dir)
+                z.write(p, os.path.join(arc_root, arc))
 
 
 def main(brd_file, edb_version):
     edb_name = 'board.aedb'
+    print('PROGRESS 5 Opening BRD file', flush=True)
     edb = Edb(brd_file, edbversion=edb_version)
-    export_stackup(edb, 'stackup.xlsx')
+    print('PROGRESS 50 Exporting stackup', flush=True)
+    # Outputs are renamed once complete so they are only published whole
+    export_stackup(edb, 'stackup.xlsx.part')
+    os.replace('stackup.xlsx.part', 'stackup.xlsx')
     # Save the project inside the current working directory so it can be
     # included in the output files instead of writing next to the source ``.brd``.
     edb.save_edb_as(edb_name)
     edb.close_edb()
     zip_name = 'board_aedb.zip'
-    with zipfile.ZipFile(zip_name, 'w', zipfile.ZIP_DEFLATED) as z:
-        for root, _, files in os.walk(edb_name):
-            for f in files:
-                p = os.path.join(root, f)
-                arc = os.path.relpath(p, edb_name)
-                z.write(p, os.path.join('board.aedb', arc))
-    table_html('stackup.xlsx', 'result.html')
+    print('PROGRESS 70 Compressing AEDB', flush=True)
+    zip_dir(edb_name, zip_name + '.part', 'board.aedb')
+    os.replace(zip_name + '.part', zip_name)
+    table_html('stackup.xlsx', 'result.html.part')
+    os.replace('result.html.part', 'result.html')
+    print('PROGRESS 100 Done', flush=True)
     print(f"Generated {zip_name} and stackup.xlsx")
 
 
+def extract_boards(zip_path, work_dir):
+    """Extract the ``.brd`` files of ``zip_path`` and return ``[(name, path)]``.
+
+    Boards are named after their file name; duplicates from different
+    folders get a numeric suffix.
+    """
+    boards = []
+    seen = set()
+    with zipfile.ZipFile(zip_path) as z:
+        for member in z.infolist():
+            base = os.path.basename(member.filename.replace('\\', '/'))
+            if member.is_dir() or not base.lower().endswith('.brd'):
+                continue
+            stem = re.sub(r'[^\w.-]', '_', os.path.splitext(base)[0]) or 'board'
+            name, n = stem, 1
+            while name.lower() in seen:
+                n += 1
+                name = f'{stem}_{n}'
+            seen.add(name.lower())
+            path = os.path.join(work_dir, name + '.brd')
+            with z.open(member) as src, open(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            boards.append((name, path))
+    return boards
+
+
+def convert_board(name, brd_path, edb_version):
+    """Convert one board in a pool worker and return its summary.
+
+    The AEDB is zipped to ``<name>_aedb.zip`` in the current directory and
+    the unzipped project removed.
+    """
+    start = time.monotonic()
+    edb_dir = os.path.join(os.path.dirname(brd_path), name + '.aedb')
+    try:
+        edb = Edb(brd_path, edbversion=edb_version)
+        try:
+            rows = stackup_rows(edb)
+            edb.save_edb_as(edb_dir)
+        finally:
+            edb.close_edb()
+        # Renamed once complete so finished boards are published mid-run
+        zip_dir(edb_dir, f'{name}_aedb.zip.part', name + '.aedb')
+        os.replace(f'{name}_aedb.zip.part', f'{name}_aedb.zip')
+        return {'name': name, 'rows': rows, 'zip': f'{name}_aedb.zip',
+                'seconds': time.monotonic() - start}
+    except Exception as exc:
+        return {'name': name, 'error': f'{type(exc).__name__}: {exc}',
+                'seconds': time.monotonic() - start}
+    finally:
+        shutil.rmtree(edb_dir, ignore_errors=True)
+        try:
+            os.remove(brd_path)
+        except OSError:
+            pass
+
+
+def sheet_title(name, used):
+    """Excel sheet names are at most 31 characters, unique and without []:*?/\\."""
+    base = re.sub(r'[\[\]:*?/\\]', '_', name)[:31] or 'Board'
+    title, n = base, 1
+    while title.lower() in used:
+        n += 1
+        suffix = f'~{n}'
+        title = base[:31 - len(suffix)] + suffix
+    used.add(title.lower())
+    return title
+
+
+def write_batch_reports(results, xlsx_path, html_path):
+    """Write the stackup workbook (one sheet per board) and the summary page."""
+    wb = Workbook()
+    wb.remove(wb.active)
+    used = set()
+    for result in results:
+        if 'rows' in result:
+            ws = wb.create_sheet(sheet_title(result['name'], used))
+            ws.append(HEADER)
+            for row in result['rows']:
+                ws.append(row)
+    if wb.worksheets:
+        # Renamed once complete, like the board archives
+        wb.save(xlsx_path + '.part')
+        os.replace(xlsx_path + '.part', xlsx_path)
+
+    summary = [['Board', 'Status', 'Layers', 'Seconds', 'Output']]
+    for result in results:
+        if 'rows' in result:
+            summary.append([result['name'], 'OK', len(result['rows']), f"{result['seconds']:.1f}", result['zip']])
+        else:
+            summary.append([result['name'], 'FAILED', '', f"{result['seconds']:.1f}", result['error']])
+    converted = sum('rows' in r for r in results)
+    parts = [
+        f'<h1>{converted} of {len(results)} boards converted</h1>',
+        f'<table>{html_rows(summary)}</table>',
+    ]
+    for result in results:
+        if 'rows' in result:
+            parts.append(f"<h2 id='{html.escape(result['name'])}'>{html.escape(result['name'])}</h2>")
+            parts.append(f"<table>{html_rows([HEADER] + result['rows'])}</table>")
+    write_page(html_path + '.part', '\n'.join(parts), centered=False)
+    os.replace(html_path + '.part', html_path)
+
+
+def main_batch(zip_path, edb_version, workers):
+    """Convert every board of ``zip_path`` with ``workers`` EDB processes.
+
+    Each pool process imports PyEDB once and converts boards one after
+    another.  A failing board is reported in ``result.html`` and does not
+    stop the others; the run fails only when no board could be converted.
+    """
+    work_dir = os.path.abspath('_boards')
+    os.makedirs(work_dir, exist_ok=True)
+    print('PROGRESS 2 Extracting boards', flush=True)
+    boards = extract_boards(zip_path, work_dir)
+    if not boards:
+        raise SystemExit(f'No .brd files found in {os.path.basename(zip_path)}')
+    workers = max(1, min(workers, len(boards), os.cpu_count() or 1))
+    print(f'Converting {len(boards)} boards with {workers} worker(s)', flush=True)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(convert_board, name, path, edb_version) for name, path in boards]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            status = 'done' if 'rows' in result else f"failed: {result['error']}"
+            print(f"{result['name']}: {status} in {result['seconds']:.1f} s", flush=True)
+            percent = 5 + int(90 * len(results) / len(boards))
+            print(f'PROGRESS {percent} Converted {len(results)}/{len(boards)} boards', flush=True)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    order = {name: i for i, (name, _) in enumerate(boards)}
+    results.sort(key=lambda r: order[r['name']])
+    write_batch_reports(results, 'stackup.xlsx', 'result.html')
+    converted = sum('rows' in r for r in results)
+    print('PROGRESS 100 Done', flush=True)
+    print(f'Converted {converted} of {len(boards)} boards')
+    if not converted:
+        raise SystemExit('No board could be converted')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Convert BRD to AEDB and export stackup.')
-    parser.add_argument('--brd', required=True, help='Input BRD file')
+    parser.add_argument('--brd', required=True, help='Input BRD file, or a zip of BRD files')
     parser.add_argument('--edbversion', default='2025.1', help='AEDT version')
+    parser.add_argument('--workers', type=int, default=2, help='EDB processes for a zip of boards')
     args = parser.parse_args()
-    main(args.brd, args.edbversion)
+    if args.brd.lower().endswith('.zip'):
+        main_batch(args.brd, args.edbversion, args.workers)
+    else:
+        main(args.brd, args.edbversion)
@@ -1,5 +1,7 @@
 """Generate network parameter plots from a Touchstone file."""
 import argparse
+import csv
+import html
 import os
 import numpy as np
 import matplotlib
@@ -7,15 +9,243 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import skrf as rf
 
+import si_metrics
 
-def main(input_file, plot='xy', parameter='S', operation='db'):
+# Columns of metrics.csv and the summary tables in index.html
+PORT_METRICS = [
+    ('rl_worst_db', 'Worst RL (dB)'),
+    ('rl_worst_ghz', 'at (GHz)'),
+    ('mask_margin_db', 'RL mask margin (dB)'),
+    ('tdr_min_ohm', 'TDR min (Ohm)'),
+    ('tdr_max_ohm', 'TDR max (Ohm)'),
+]
+CHANNEL_METRICS = [
+    ('il_nyquist_db', 'IL at Nyquist (dB)'),
+    ('ild_rms_db', 'ILD RMS (dB)'),
+    ('ild_peak_db', 'ILD peak (dB)'),
+    ('scd_max_db', 'Max SCD (dB)'),
+    ('pulse_peak', 'Pulse peak'),
+    ('pulse_delay_ns', 'Pulse delay (ns)'),
+]
+
+
+def _db(x):
+    return 20 * np.log10(np.maximum(np.abs(x), 1e-15))
+
+
+def _save(fig, fname):
+    fig.tight_layout()
+    fig.savefig(fname + '.part', format='png')
+    plt.close(fig)
+    os.replace(fname + '.part', fname)
+
+
+def compute_metrics(ntwk, pairs='', channels='', bitrate='', rl_mask=''):
+    """Derive SI metrics of ``ntwk`` and plot them.
+
+    With differential ``pairs`` the metrics use the SDD block of the
+    mixed-mode parameters (logical port ``k`` is pair ``k``), otherwise the
+    single-ended ports.  ``channels`` lists the through paths between
+    logical ports.  Returns ``(images, ports, channels)`` where the last two
+    are lists of ``(name, {metric: value})``.
+    """
+    f = ntwk.f
+    s = ntwk.s
+    z0 = np.real(ntwk.z0[0])
+    pair_list = si_metrics.parse_pairs(pairs, ntwk.nports)
+    if pair_list:
+        sdd, _, scd, _ = si_metrics.mixed_mode(s, pair_list)
+        logical = sdd
+        z_ref = np.array([z0[p] + z0[n] for p, n in pair_list])
+        labels = [f'Pair {k + 1} ({p + 1}-{n + 1})' for k, (p, n) in enumerate(pair_list)]
+        prefix = 'SDD'
+    else:
+        logical, scd = s, None
+        z_ref = z0
+        labels = [f'Port {k + 1}' for k in range(ntwk.nports)]
+        prefix = 'S'
+    names = [str(k + 1) for k in range(len(labels))]
+    chan_list = si_metrics.parse_channels(channels, len(names))
+    gbps = si_metrics.parse_bitrate(bitrate)
+    bit_time = 1 / (gbps * 1e9) if gbps else 1 / f[-1]
+    nyquist = 0.5 / bit_time
+    ghz = f / 1e9
+    images = []
+
+    # Reflections of every logical port
+    diag = np.arange(len(names))
+    rho = logical[:, diag, diag]
+    rl = _db(rho)
+    mask = si_metrics.parse_mask(rl_mask)
+    port_stats = [dict() for _ in names]
+    worst = np.argmax(rl, axis=0)
+    for k, stats in enumerate(port_stats):
+        stats['rl_worst_db'] = rl[worst[k], k]
+        stats['rl_worst_ghz'] = ghz[worst[k]]
+    fig, ax = plt.subplots(figsize=(8, 5))
+    for k, name in enumerate(names):
+        ax.plot(ghz, rl[:, k], label=f'{prefix}({name},{name})')
+    if len(mask[0]):
+        limit, margin, _ = si_metrics.mask_margin(f, rl, mask)
+        ax.plot(ghz, limit, 'k--', label='Mask')
+        for k, stats in enumerate(port_stats):
+            stats['mask_margin_db'] = margin[k]
+    ax.set_xlabel('Frequency (GHz)')
+    ax.set_ylabel('Return loss (dB)')
+    ax.set_title('Return loss')
+    ax.grid(True)
+    ax.legend(fontsize='small')
+    _save(fig, 'return_loss.png')
+    images.append(('return_loss.png', 'Return loss'))
+
+    t, z = si_metrics.tdr(f, rho, z_ref)
+    t_end = 0.5 * t[-1]
+    if chan_list:
+        src = [c[0] for c in chan_list]
+        dst = [c[1] for c in chan_list]
+        through = logical[:, dst, src]
+        il = -_db(through)
+        # Fitted up to the bit rate, twice the Nyquist frequency
+        fit_band = f <= 2 * nyquist
+        fit, ild = si_metrics.fit_insertion_loss(f, il, fmax=2 * nyquist)
+        tp, pulse = si_metrics.pulse_response(f, through, bit_time)
+        peak = np.argmax(pulse[:len(tp) // 2], axis=0)
+        # Show a round trip of the slowest channel that transmits anything
+        delays = tp[peak][pulse[peak, np.arange(len(peak))] > 1e-3]
+        if len(delays):
+            t_end = min(t_end, 2.5 * delays.max() + 10 * bit_time)
+        nyq = np.argmin(np.abs(f - nyquist))
+        chan_names = [f'{prefix}({names[d]},{names[i]})' for i, d in chan_list]
+        chan_stats = []
+        for k in range(len(chan_list)):
+            stats = {
+                'il_nyquist_db': il[nyq, k],
+                'ild_rms_db': np.sqrt(np.mean(ild[fit_band, k] ** 2)),
+                'ild_peak_db': np.max(np.abs(ild[fit_band, k])),
+                'pulse_peak': pulse[peak[k], k],
+                'pulse_delay_ns': tp[peak[k]] * 1e9,
+            }
+            if scd is not None:
+                stats['scd_max_db'] = np.max(_db(scd[:, chan_list[k][1], chan_list[k][0]]))
+            chan_stats.append(stats)
+
+        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(8, 7), sharex=True)
+        for k, name in enumerate(chan_names):
+            line, = ax1.plot(ghz, -il[:, k], label=name)
+            ax1.plot(ghz, -fit[:, k], '--', color=line.get_color(), label=f'{name} fit')
+            ax2.plot(ghz, ild[:, k], label=name)
+        ax1.axvline(nyquist / 1e9, color='gray', linestyle=':')
+        ax1.set_ylabel('Insertion loss (dB)')
+        ax1.set_title('Insertion loss and fit')
+        ax2.set_ylabel('ILD (dB)')
+        ax2.set_xlabel('Frequency (GHz)')
+        for ax in (ax1, ax2):
+            ax.grid(True)
+            ax.legend(fontsize='small')
+        _save(fig, 'insertion_loss.png')
+        images.append(('insertion_loss.png', 'Insertion loss and deviation'))
+
+        if scd is not None:
+            fig, ax = plt.subplots(figsize=(8, 5))
+            for k, (i, d) in enumerate(chan_list):
+                ax.plot(ghz, -il[:, k], label=chan_names[k])
+                ax.plot(ghz, _db(scd[:, d, i]), '--', label=f'SCD({names[d]},{names[i]})')
+            ax.set_xlabel('Frequency (GHz)')
+            ax.set_ylabel('Magnitude (dB)')
+            ax.set_title('Mixed-mode transmission')
+            ax.grid(True)
+            ax.legend(fontsize='small')
+            _save(fig, 'mixed_mode.png')
+            images.append(('mixed_mode.png', 'Mixed-mode transmission'))
+
+        shown = tp <= t_end
+        fig, ax = plt.subplots(figsize=(8, 5))
+        ax.plot(tp[shown] * 1e9, pulse[shown])
+        ax.legend(chan_names, fontsize='small')
+        ax.set_xlabel('Time (ns)')
+        ax.set_ylabel('Amplitude')
+        ax.set_title(f'Pulse response ({1e-9 / bit_time:g} Gbps)')
+        ax.grid(True)
+        _save(fig, 'pulse_response.png')
+        images.append(('pulse_response.png', 'Pulse response'))
+    else:
+        chan_names, chan_stats = [], []
+
+    shown = t <= t_end
+    for k, stats in enumerate(port_stats):
+        stats['tdr_min_ohm'] = np.min(z[shown, k])
+        stats['tdr_max_ohm'] = np.max(z[shown, k])
+    fig, ax = plt.subplots(figsize=(8, 5))
+    ax.plot(t[shown] * 1e9, z[shown])
+    ax.legend(labels, fontsize='small')
+    ax.set_xlabel('Time (ns)')
+    ax.set_ylabel('Impedance (Ohm)')
+    ax.set_title('TDR')
+    ax.grid(True)
+    _save(fig, 'tdr.png')
+    images.append(('tdr.png', 'TDR'))
+
+    return images, list(zip(labels, port_stats)), list(zip(chan_names, chan_stats))
+
+
+def write_metrics_csv(path, ports, channels):
+    """One row per port or channel and metric."""
+    with open(path + '.part', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['item', 'metric', 'value'])
+        for rows, columns in ((ports, PORT_METRICS), (channels, CHANNEL_METRICS)):
+            for name, stats in rows:
+                for key, _ in columns:
+                    if key in stats:
+                        writer.writerow([name, key, f'{stats[key]:.6g}'])
+    os.replace(path + '.part', path)
+
+
+def _metrics_table(rows, columns, first):
+    columns = [c for c in columns if any(c[0] in stats for _, stats in rows)]
+    parts = ['<table border="1" cellpadding="4"><tr>', f'<th>{first}</th>']
+    parts += [f'<th>{html.escape(label)}</th>' for _, label in columns]
+    parts.append('</tr>')
+    for name, stats in rows:
+        parts.append(f'<tr><td>{html.escape(name)}</td>'
+                     + ''.join(f'<td>{stats[key]:.3f}</td>' if key in stats else '<td></td>'
+                               for key, _ in columns)
+                     + '</tr>')
+    parts.append('</table>')
+    return ''.join(parts)
+
+
+def main(input_file, plot='xy', parameter='S', operation='db', metrics='yes',
+         pairs='', channels='', bitrate='', rl_mask=''):
     ntwk = rf.Network(input_file)
     nports = ntwk.nports
     freqs = ntwk.f
 
+    metric_html = []
+    if metrics == 'yes':
+        print('PROGRESS 0 Computing metrics', flush=True)
+        try:
+            images, port_rows, channel_rows = compute_metrics(ntwk, pairs, channels, bitrate, rl_mask)
+        except ValueError as exc:
+            raise SystemExit(str(exc))
+        write_metrics_csv('metrics.csv', port_rows, channel_rows)
+        metric_html.append('<h2>Metrics</h2>')
+        metric_html.append(_metrics_table(port_rows, PORT_METRICS, 'Port'))
+        if channel_rows:
+            metric_html.append(_metrics_table(channel_rows, CHANNEL_METRICS, 'Channel'))
+        metric_html.append('<p><a href="metrics.csv">metrics.csv</a></p><div class="grid">')
+        for fname, title in images:
+            metric_html.append(
+                f'<div class="metric"><a href="{fname}" target="_blank">'
+                f'<img src="{fname}" alt="{html.escape(title)}"></a></div>'
+            )
+        metric_html.append('</div><h2>Plots</h2>')
+
     plot_files = []
+    total = nports * nports
     for i in range(nports):
         for j in range(nports):
+            print(f'PROGRESS {100 * (i * nports + j) // total} Plotting ({i + 1},{j + 1})', flush=True)
             fig, ax = plt.subplots()
             if plot == 'smith':
                 ntwk.plot_s_smith(m=i, n=j, ax=ax, color='red')
@@ -45,8 +275,11 @@ def main(input_file, plot='xy', parameter='S', operation='db'):
             ax.set_title(title)
             ax.grid(True)
             fig.tight_layout()
-            fig.savefig(fname)
+            # Written under a temporary name so finished plots can be
+            # published while the others are still being drawn
+            fig.savefig(fname + '.part', format='png')
             plt.close(fig)
+            os.replace(fname + '.part', fname)
             plot_files.append((fname, title))
 
     # Build simple HTML with 4-column grid and simple filter rules
@@ -60,9 +293,13 @@ def main(input_file, plot='xy', parameter='S', operation='db'):
         '.grid{display:flex;flex-wrap:wrap;}',
         '.plot{width:25%;padding:10px;box-sizing:border-box;}',
         '.plot img{width:100%;height:auto;}',
+        '.metric{width:50%;padding:10px;box-sizing:border-box;}',
+        '.metric img{width:100%;height:auto;}',
+        'table{border-collapse:collapse;margin-bottom:10px;}',
         '</style>',
         '</head>',
         '<body>',
+        *metric_html,
         f'<input type="text" id="search" placeholder="e.g., S(m,m);S(m,m+3)">',
         '<div class="grid" id="plots">'
     ]
@@ -119,8 +356,10 @@ def main(input_file, plot='xy', parameter='S', operation='db'):
         '</html>'
     ])
 
-    with open('index.html', 'w') as f:
+    with open('index.html.part', 'w') as f:
         f.write('\n'.join(html_parts))
+    os.replace('index.html.part', 'index.html')
+    print('PROGRESS 100 Done', flush=True)
 
 
 if __name__ == '__main__':
@@ -129,5 +368,12 @@ if __name__ == '__main__':
     parser.add_argument('--plot', choices=['xy', 'smith'], default='xy')
     parser.add_argument('--parameter', choices=['S', 'Y', 'Z'], default='S')
     parser.add_argument('--operation', choices=['db', 'real', 'imag', 'mag', 'phase'], default='db')
+    parser.add_argument('--metrics', choices=['yes', 'no'], default='yes',
+                        help='Compute return loss, TDR, insertion loss fit and pulse response')
+    parser.add_argument('--pairs', default='', help='Differential pairs, e.g. "1-3, 2-4"')
+    parser.add_argument('--channels', default='', help='Through channels between logical ports, e.g. "1>2"')
+    parser.add_argument('--bitrate', default='', help='Bit rate in Gbps for the pulse response and Nyquist IL')
+    parser.add_argument('--rl_mask', default='', help='Return loss limit as GHz:dB points, e.g. "0:-12, 20:-6"')
     args = parser.parse_args()
-    main(args.file, args.plot, args.parameter, args.operation)
+    main(args.file, args.plot, args.parameter, args.operation, args.metrics,
+         args.pairs, args.channels, args.bitrate, args.rl_mask)
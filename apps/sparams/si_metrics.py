@@ -0,0 +1,193 @@
+"""Signal-integrity metrics of a network, vectorised over ports and frequency.
+
+Every function takes arrays with frequency on the first axis and works on
+all ports or channels at once:
+
+* :func:`mixed_mode` converts single-ended S-parameters to mixed mode
+  with one matrix product per frequency.
+* :func:`tdr` and :func:`pulse_response` transform reflections and
+  through paths to the time domain with a single inverse real FFT.
+* :func:`fit_insertion_loss` fits ``a0 + a1*sqrt(f) + a2*f + a3*f**2`` to
+  the insertion loss of every channel in one least-squares solve; the
+  residual is the insertion loss deviation (ILD).
+* :func:`mask_margin` compares return loss against a piecewise-linear
+  limit line.
+"""
+import numpy as np
+
+# Largest frequency grid used for time-domain transforms
+MAX_POINTS = 1 << 15
+
+
+def parse_pairs(text, nports):
+    """Parse differential pairs such as ``"1-3, 2-4"`` into 0-based tuples.
+
+    An empty string pairs consecutive ports (1-2, 3-4, ...) of networks
+    with an even number of ports, four or more, and returns no pairs
+    otherwise.
+    """
+    text = (text or '').strip()
+    if not text:
+        if nports % 2 or nports < 4:
+            return []
+        return [(p, p + 1) for p in range(0, nports, 2)]
+    pairs = []
+    for token in text.replace(';', ',').split(','):
+        if not token.strip():
+            continue
+        try:
+            p, n = (int(v) - 1 for v in token.split('-'))
+        except ValueError:
+            raise ValueError(f'Invalid pair {token.strip()!r}, expected "<p>-<n>"')
+        if not (0 <= p < nports and 0 <= n < nports) or p == n:
+            raise ValueError(f'Pair {token.strip()!r} does not match a {nports}-port network')
+        pairs.append((p, n))
+    used = [p for pair in pairs for p in pair]
+    if len(set(used)) != len(used):
+        raise ValueError('A port is used in more than one pair')
+    return pairs
+
+
+def parse_channels(text, nports):
+    """Parse through channels such as ``"1>2, 3>4"`` into 0-based tuples.
+
+    An empty string uses consecutive ports (1>2, 3>4, ...).
+    """
+    text = (text or '').strip()
+    if not text:
+        return [(p, p + 1) for p in range(0, nports - 1, 2)]
+    channels = []
+    for token in text.replace(';', ',').split(','):
+        if not token.strip():
+            continue
+        try:
+            src, dst = (int(v) - 1 for v in token.split('>'))
+        except ValueError:
+            raise ValueError(f'Invalid channel {token.strip()!r}, expected "<in>><out>"')
+        if not (0 <= src < nports and 0 <= dst < nports) or src == dst:
+            raise ValueError(f'Channel {token.strip()!r} does not match {nports} port(s)')
+        channels.append((src, dst))
+    return channels
+
+
+def mixed_mode(s, pairs):
+    """Return ``(sdd, sdc, scd, scc)`` of ``s`` with shape ``(F, N, N)``.
+
+    Pair ``k`` drives ``(a_p - a_n) / sqrt(2)`` differentially and
+    ``(a_p + a_n) / sqrt(2)`` in common mode; each block has shape
+    ``(F, P, P)`` for ``P`` pairs.
+    """
+    npairs = len(pairs)
+    m = np.zeros((2 * npairs, s.shape[1]))
+    for k, (p, n) in enumerate(pairs):
+        m[k, p], m[k, n] = 1, -1
+        m[npairs + k, p], m[npairs + k, n] = 1, 1
+    m /= np.sqrt(2)
+    smm = m @ s @ m.T
+    d, c = slice(0, npairs), slice(npairs, 2 * npairs)
+    return smm[:, d, d], smm[:, d, c], smm[:, c, d], smm[:, c, c]
+
+
+def _uniform(f, x):
+    """Resample ``x`` (shape ``(F, K)``) onto an even grid from DC to ``f[-1]``.
+
+    The grid keeps the file's median frequency step, up to
+    :data:`MAX_POINTS` points.  The DC point is extrapolated from the
+    lowest measured frequency (real part only, as a physical response is
+    real at DC).
+    """
+    if f[0] > 0:
+        f = np.concatenate(([0.0], f))
+        x = np.concatenate((x[:1].real, x))
+    step = np.median(np.diff(f))
+    grid = np.linspace(0, f[-1], int(min(max(len(f), round(f[-1] / step) + 1), MAX_POINTS)))
+    idx = np.clip(np.searchsorted(f, grid), 1, len(f) - 1)
+    w = ((grid - f[idx - 1]) / (f[idx] - f[idx - 1]))[:, None]
+    return grid, x[idx - 1] * (1 - w) + x[idx] * w
+
+
+def _impulse(f, x, pad=4):
+    """Windowed impulse responses of ``x`` (shape ``(F, K)``) and their time axis."""
+    grid, xu = _uniform(f, x)
+    # Half of a Hann window tapers the response to zero at the top frequency
+    window = np.cos(np.pi / 2 * grid / grid[-1]) ** 2
+    n = pad * 2 * (len(grid) - 1)
+    h = np.fft.irfft(xu * window[:, None], n=n, axis=0)
+    dt = 1 / (n * (grid[1] - grid[0]))
+    return np.arange(n) * dt, h
+
+
+def tdr(f, rho, z_ref):
+    """Step-response impedance of reflections ``rho`` (shape ``(F, K)``).
+
+    Returns ``(t, z)`` with ``z`` of shape ``(T, K)``; ``z_ref`` is the
+    reference impedance of each column.
+    """
+    t, h = _impulse(f, rho)
+    step = np.clip(np.cumsum(h, axis=0), -0.999, 0.999)
+    return t, np.asarray(z_ref) * (1 + step) / (1 - step)
+
+
+def pulse_response(f, s21, bit_time):
+    """Response of through paths ``s21`` (shape ``(F, K)``) to a one-bit pulse."""
+    t, h = _impulse(f, s21)
+    step = np.cumsum(h, axis=0)
+    shift = int(round(bit_time / (t[1] - t[0])))
+    pulse = step.copy()
+    pulse[shift:] -= step[:len(step) - shift]
+    return t, pulse
+
+
+def fit_insertion_loss(f, il_db, fmax=None):
+    """Least-squares IL fit of every channel; ``il_db`` has shape ``(F, K)``.
+
+    Returns ``(fit, ild)``, both shaped like ``il_db``.  Only frequencies
+    up to ``fmax`` take part in the fit.
+    """
+    x = f / 1e9
+    basis = np.stack([np.ones_like(x), np.sqrt(x), x, x ** 2], axis=1)
+    used = x <= (fmax / 1e9 if fmax else x[-1])
+    coeffs, *_ = np.linalg.lstsq(basis[used], il_db[used], rcond=None)
+    fit = basis @ coeffs
+    return fit, il_db - fit
+
+
+def parse_mask(text):
+    """Parse ``"0:-12, 4:-12, 20:-6"`` (GHz:dB) into two arrays."""
+    points = []
+    for token in (text or '').split(','):
+        if not token.strip():
+            continue
+        try:
+            freq, level = (float(v) for v in token.split(':'))
+        except ValueError:
+            raise ValueError(f'Invalid mask point {token.strip()!r}, expected "<GHz>:<dB>"')
+        points.append((freq * 1e9, level))
+    points.sort()
+    return np.array([p[0] for p in points]), np.array([p[1] for p in points])
+
+
+def parse_bitrate(text):
+    """Parse a bit rate in Gbps; ``None`` when ``text`` is empty."""
+    if not (text or '').strip():
+        return None
+    try:
+        gbps = float(text)
+    except ValueError:
+        raise ValueError(f'Invalid bit rate {text.strip()!r}, expected a number of Gbps')
+    if not np.isfinite(gbps) or gbps <= 0:
+        raise ValueError(f'Bit rate must be a positive number of Gbps, got {text.strip()!r}')
+    return gbps
+
+
+def mask_margin(f, rl_db, mask):
+    """Margin (dB, positive passes) of ``rl_db`` (shape ``(F, K)``) below ``mask``.
+
+    Returns ``(limit, margin, worst_freq)`` where ``limit`` is the mask at
+    ``f`` and the others have one value per column.
+    """
+    mask_f, mask_db = mask
+    limit = np.interp(f, mask_f, mask_db)
+    diff = limit[:, None] - rl_db
+    worst = np.argmin(diff, axis=0)
+    return limit, diff[worst, np.arange(diff.shape[1])], f[worst]
@@ -0,0 +1,43 @@
+"""Benchmark stub that sleeps and writes synthetic output files.
+
+Used by ``service.stress_jobs`` to exercise scheduling, result handling
+and downloads without AEDT or PyEDB.
+"""
+import argparse
+import os
+import time
+
+
+def main(payload, duration, output_kb, files):
+    files = max(1, int(files))
+    per_file = int(float(output_kb) * 1024) // files
+    duration = float(duration)
+    chunk = os.urandom(min(per_file, 1024 * 1024)) if per_file else b''
+    names = []
+    for i in range(files):
+        print(f'PROGRESS {100 * i // files} Writing output {i + 1}/{files}', flush=True)
+        time.sleep(duration / files)
+        name = f'out_{i + 1}.bin'
+        # Renamed when complete so it can be published while the run goes on
+        with open(name + '.part', 'wb') as f:
+            remaining = per_file
+            while remaining > 0:
+                f.write(chunk[:remaining])
+                remaining -= len(chunk)
+        os.replace(name + '.part', name)
+        names.append(name)
+    size = os.path.getsize(payload) if payload and os.path.exists(payload) else 0
+    links = ''.join(f'<li><a href="{n}">{n}</a></li>' for n in names)
+    with open('index.html', 'w') as f:
+        f.write(f'<html><body><p>Payload: {size} bytes</p><ul>{links}</ul></body></html>')
+    print('PROGRESS 100 Done', flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark stub runner.')
+    parser.add_argument('--payload', default='', help='Uploaded input file')
+    parser.add_argument('--duration', default='1', help='Seconds to run')
+    parser.add_argument('--output_kb', default='64', help='Total output size in KiB')
+    parser.add_argument('--files', default='4', help='Number of output files')
+    args = parser.parse_args()
+    main(args.payload, args.duration, args.output_kb, args.files)
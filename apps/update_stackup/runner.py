@@ -51,10 +51,26 @@ def export_stackup(edb_obj, xlsx_path):
 
 
 
-def apply_xlsx(xlsx_path, edb_path, version):
-    edb = Edb(edb_path, edbversion=version)
+def stackup_sheet(wb, sheet=''):
+    """Return worksheet ``sheet``, else "Stackup" or the only sheet.
+
+    Batch readpcb workbooks have one sheet per board, named after it.
+    """
+    if sheet:
+        if sheet not in wb.sheetnames:
+            raise SystemExit(f'Sheet {sheet!r} not found; the workbook has {", ".join(wb.sheetnames)}')
+        return wb[sheet]
+    if "Stackup" in wb.sheetnames:
+        return wb["Stackup"]
+    if len(wb.worksheets) == 1:
+        return wb.worksheets[0]
+    raise SystemExit(f'The workbook has one sheet per board; set the sheet to one of {", ".join(wb.sheetnames)}')
+
+
+def apply_xlsx(xlsx_path, edb_path, version, sheet=''):
     wb = openpyxl.load_workbook(xlsx_path)
-    ws = wb["Stackup"]
+    ws = stackup_sheet(wb, sheet)
+    edb = Edb(edb_path, edbversion=version)
     
     material_dic = {}
     for row in ws.iter_rows(min_row=2, values_only=True):
@@ -139,8 +155,9 @@ tr:nth-child(odd) {{
         f.write(html)
 
 
-def main(aedb_zip, xlsx_file, version):
+def main(aedb_zip, xlsx_file, version, sheet=''):
     with tempfile.TemporaryDirectory() as tmp:
+        print('PROGRESS 5 Extracting AEDB archive', flush=True)
         with zipfile.ZipFile(aedb_zip) as z:
             z.extractall(tmp)
         aedb_dirs = [p for p in os.listdir(tmp) if p.endswith('.aedb')]
@@ -151,10 +168,13 @@ def main(aedb_zip, xlsx_file, version):
         aedb_dir = aedb_dirs[0]
         aedb_path = os.path.join(tmp, aedb_dir)
         shutil.copy(xlsx_file, os.path.join(tmp, 'stackup.xlsx'))
-        apply_xlsx(os.path.join(tmp, 'stackup.xlsx'), aedb_path, version)
+        print('PROGRESS 30 Applying stackup changes', flush=True)
+        apply_xlsx(os.path.join(tmp, 'stackup.xlsx'), aedb_path, version, sheet)
+        print('PROGRESS 60 Exporting updated stackup', flush=True)
         export_stackup(Edb(aedb_path, edbversion=version), os.path.join(tmp, 'updated.xlsx'))
 
         output_zip = 'updated_aedb.zip'
+        print('PROGRESS 80 Compressing AEDB', flush=True)
         with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as out:
             for root, _, files in os.walk(aedb_path):
                 for f in files:
@@ -163,6 +183,7 @@ def main(aedb_zip, xlsx_file, version):
                     out.write(p, os.path.join(aedb_dir, arc))
         shutil.copy(os.path.join(tmp, 'updated.xlsx'), 'updated.xlsx')
     table_html('updated.xlsx', 'result.html')
+    print('PROGRESS 100 Done', flush=True)
     print(f"Updated AEDB written to {output_zip}")
 
 
@@ -171,5 +192,6 @@ if __name__ == '__main__':
     parser.add_argument('--aedb_zip', required=True, help='Zipped AEDB')
     parser.add_argument('--xlsx', required=True, help='Stackup Excel file')
     parser.add_argument('--version', default='2025.1', help='AEDT version')
+    parser.add_argument('--sheet', default='', help='Worksheet to apply (a board of a batch readpcb workbook)')
     args = parser.parse_args()
-    main(args.aedb_zip, args.xlsx, args.version)
+    main(args.aedb_zip, args.xlsx, args.version, args.sheet)
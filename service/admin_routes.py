@@ -1,16 +1,75 @@
+
 from flask import (
     Blueprint, render_template, request, redirect, url_for,
-    flash, abort
+    flash, abort, current_app
 )
 from werkzeug.security import generate_password_hash
 from flask_login import login_required, current_user
-from sqlalchemy import or_
+from sqlalchemy import case, func, or_
+from sqlalchemy.orm import joinedload
 
-from .models import db, User, Task
+from . import runtime_model
+from .admission import free_disk_mb, queue_depths, thresholds
+from .config_utils import load_config
+from .metrics import percentile
+from .models import db, User, Task, TaskArchive, Worker
 from .plugin_loader import scan_plugins, load_registry, save_registry
+from .user_cache import invalidate as invalidate_user
+from .worker_registry import live_workers, worker_loads
 
 admin_bp = Blueprint('admin', __name__)
 
+# Rows per page of the task and user lists
+ADMIN_PAGE_SIZE = 100
+# Finished tasks, newest first, behind the time and memory percentiles
+STATS_WINDOW = 5000
+
+
+def _all_tasks(*names):
+    """Columns ``names`` of live and archived tasks as one subquery."""
+    return db.union_all(
+        db.select(*(getattr(Task, n) for n in names)),
+        db.select(*(getattr(TaskArchive, n) for n in names)),
+    ).subquery()
+
+
+def _task_stats():
+    """Per-plugin counts over all tasks, and times over recent ones.
+
+    Counts and success rates are aggregated in SQL.  Durations and peak
+    memory are read for the last :data:`STATS_WINDOW` finished tasks only,
+    so the view does not load the archive.
+    """
+    tasks = _all_tasks('task_type', 'status')
+    stats = {}
+    for task_type, count, success in db.session.query(
+        tasks.c.task_type, func.count(), func.sum(case((tasks.c.status == 'SUCCESS', 1), else_=0)),
+    ).group_by(tasks.c.task_type):
+        stats[task_type] = {
+            'count': count, 'success_rate': round(success / count * 100, 2),
+            'times': [], 'peaks': [],
+        }
+    finished = _all_tasks('task_type', 'start_time', 'end_time', 'peak_rss_kb')
+    recent = db.session.query(finished).filter(
+        finished.c.end_time.isnot(None),
+    ).order_by(finished.c.end_time.desc()).limit(STATS_WINDOW)
+    for task_type, start, end, peak in recent:
+        entry = stats.get(task_type)
+        if entry is None:
+            continue
+        if start:
+            entry['times'].append((end - start).total_seconds())
+        if peak:
+            entry['peaks'].append(peak / 1024)
+    for data in stats.values():
+        times = data['times']
+        data['avg_time'] = round(sum(times) / len(times), 2) if times else 0
+        data['p50_time'] = percentile(times, 50, 2)
+        data['p95_time'] = percentile(times, 95, 2)
+        data['p50_peak_mb'] = percentile(data['peaks'], 50, 2)
+        data['p95_peak_mb'] = percentile(data['peaks'], 95, 2)
+    return stats
+
 
 @admin_bp.route('/admin', endpoint='admin')
 @login_required
@@ -27,7 +86,13 @@ def admin_tasks():
         abort(403)
     q = request.args.get('q', '').strip()
     tasks_query = Task.query
-    if q:
+    if q and '=' in q:
+        # ``key=value`` searches parameter values inside the JSON column
+        key, _, value = q.partition('=')
+        tasks_query = tasks_query.filter(
+            Task.parameters[key.strip()].as_string() == value.strip()
+        )
+    elif q:
         filters = []
         if q.isdigit():
             filters.append(Task.id == int(q))
@@ -35,21 +100,25 @@ def admin_tasks():
         tasks_query = tasks_query.join(User).filter(
             or_(User.username.ilike(f'%{q}%'), *filters)
         )
-    tasks_query = tasks_query.order_by(Task.create_time.desc()).all()
-    stats = {}
-    for t in Task.query.all():
-        entry = stats.setdefault(t.task_type, {'count': 0, 'success': 0, 'total_time': 0.0})
-        entry['count'] += 1
-        if t.status == 'SUCCESS':
-            entry['success'] += 1
-        if t.start_time and t.end_time:
-            entry['total_time'] += (t.end_time - t.start_time).total_seconds()
-    for stype, data in stats.items():
-        count = data['count']
-        data['success_rate'] = round((data['success'] / count * 100) if count else 0, 2)
-        data['avg_time'] = round((data['total_time'] / count) if count else 0, 2)
+    page = tasks_query.options(joinedload(Task.user)).order_by(Task.create_time.desc()).paginate(
+        per_page=ADMIN_PAGE_SIZE, error_out=False,
+    )
+    stats = _task_stats()
+    workers = []
+    # Remote workers, and worker processes when the roles are split
+    if current_app.config.get('WORKER_TOKEN') or current_app.config['PROCESS_ROLE'] != 'all':
+        live = {w.name for w in live_workers()}
+        loads = worker_loads()
+        for w in Worker.query.order_by(Worker.name).all():
+            workers.append({
+                'worker': w,
+                'alive': w.name in live,
+                'load': loads.get(w.name, 0),
+            })
+    models = runtime_model.summaries()
     return render_template(
-        'admin_tasks.html', stats=stats, tasks=tasks_query, q=q
+        'admin_tasks.html', stats=stats, tasks=page.items, page=page, q=q, workers=workers,
+        models=models, stats_window=STATS_WINDOW,
     )
 
 
@@ -59,14 +128,15 @@ def admin_users():
     """Display the user management page with per-user statistics."""
     if not current_user.is_admin:
         abort(403)
-    users = User.query.all()
-    user_stats = {}
-    for u in users:
-        total = len(u.tasks)
-        success = sum(1 for t in u.tasks if t.status == 'SUCCESS')
-        rate = round((success / total * 100) if total else 0, 2)
-        user_stats[u.id] = {'total': total, 'success_rate': rate}
-    return render_template('admin_users.html', users=users, user_stats=user_stats)
+    page = User.query.order_by(User.username).paginate(per_page=ADMIN_PAGE_SIZE, error_out=False)
+    tasks = _all_tasks('user_id', 'status')
+    rows = db.session.query(
+        tasks.c.user_id, func.count(), func.sum(case((tasks.c.status == 'SUCCESS', 1), else_=0)),
+    ).filter(tasks.c.user_id.in_([u.id for u in page.items])).group_by(tasks.c.user_id)
+    user_stats = {u.id: {'total': 0, 'success_rate': 0} for u in page.items}
+    for user_id, total, success in rows:
+        user_stats[user_id] = {'total': total, 'success_rate': round(success / total * 100, 2)}
+    return render_template('admin_users.html', users=page.items, page=page, user_stats=user_stats)
 
 
 @admin_bp.route('/admin/archive/<int:task_id>', methods=['POST'], endpoint='archive_task')
@@ -80,6 +150,56 @@ def archive_task(task_id):
     return redirect(url_for('admin.admin_tasks'))
 
 
+@admin_bp.route('/admin/task/<int:task_id>/priority', methods=['POST'], endpoint='set_priority')
+@login_required
+def set_priority(task_id):
+    """Change the scheduling priority of a task."""
+    if not current_user.is_admin:
+        abort(403)
+    task = Task.query.get_or_404(task_id)
+    task.priority = request.form.get('priority', 0, type=int)
+    db.session.commit()
+    from .tasks import dispatch
+    dispatch()
+    return redirect(url_for('admin.admin_tasks', q=request.args.get('q', '')))
+
+
+@admin_bp.route('/admin/task/<int:task_id>/preempt', methods=['POST'], endpoint='preempt_task')
+@login_required
+def preempt_task(task_id):
+    """Run a queued task now, requeueing a lower-priority task if needed."""
+    if not current_user.is_admin:
+        abort(403)
+    from .tasks import active_tasks, preempt_for
+
+    task = Task.query.get_or_404(task_id)
+    if task.status != 'PENDING':
+        flash(f'Task {task_id} is not queued')
+        return redirect(url_for('admin.admin_tasks'))
+    # Rank the task above everything that currently holds a slot
+    top = max([t.priority or 0 for t in active_tasks()], default=0)
+    task.priority = max(task.priority or 0, top + 1)
+    db.session.commit()
+    victim = preempt_for(task)
+    if victim is not None:
+        flash(f'Task {victim.id} was preempted and requeued to make room for task {task_id}')
+    else:
+        flash(f'Task {task_id} raised to priority {task.priority}')
+    return redirect(url_for('admin.admin_tasks'))
+
+
+@admin_bp.route('/admin/archive/run', methods=['POST'], endpoint='run_archival')
+@login_required
+def run_archival():
+    """Move finished tasks past the retention window to cold storage now."""
+    if not current_user.is_admin:
+        abort(403)
+    from .archive import archive_old_tasks
+    count = archive_old_tasks()
+    flash(f'Archived {count} tasks')
+    return redirect(url_for('admin.admin_tasks'))
+
+
 @admin_bp.route('/admin/users/add', methods=['POST'], endpoint='add_user')
 @login_required
 def add_user():
@@ -131,7 +251,10 @@ def edit_user(user_id):
         if password:
             user.password_hash = generate_password_hash(password, method='pbkdf2:sha256')
         user.is_admin = bool(request.form.get('is_admin'))
+        user.share = request.form.get('share', 1.0, type=float) or 1.0
+        user.max_running = request.form.get('max_running', type=int)
         db.session.commit()
+        invalidate_user(user.id)
         flash('User updated')
         return redirect(url_for('admin.admin_users'))
     return render_template('edit_user.html', user=user)
@@ -149,6 +272,7 @@ def delete_user(user_id):
         return redirect(url_for('admin.admin_users'))
     db.session.delete(user)
     db.session.commit()
+    invalidate_user(user_id)
     flash('User deleted')
     return redirect(url_for('admin.admin_users'))
 
@@ -167,4 +291,9 @@ def admin_apps():
         save_registry(registry)
         return redirect(url_for('admin.admin_apps'))
     plugins = scan_plugins()
-    return render_template('admin_apps.html', plugins=plugins)
+    configs = load_config(enabled_only=False)
+    admission = {name: thresholds(configs[name]) for name in plugins if name in configs}
+    return render_template(
+        'admin_apps.html', plugins=plugins, admission=admission,
+        queued=queue_depths(), free_mb=free_disk_mb(),
+    )
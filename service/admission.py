@@ -0,0 +1,112 @@
+"""Refuse new tasks while a plugin's queue, a user's backlog or the disk is full.
+
+Both the submit form and ``POST /api/v1/tasks`` call :func:`admit` before
+any upload is written.  Three limits apply per plugin:
+
+* ``max_queued``: tasks of the plugin waiting to start (``PENDING`` and
+  ``WAITING``), from every user.  Refused with 503.
+* ``max_user_pending``: tasks of the plugin the submitting user has
+  waiting to start.  Refused with 429.
+* ``min_free_mb``: free space on the file system of ``OUTPUT_DIR``.
+  Refused with 503.
+
+Defaults come from the ``ADMISSION_*`` settings and a plugin overrides
+them with an ``admission`` block in its ``config.yaml``; 0 disables a
+limit.  The limits are checked, not reserved, so concurrent submissions
+may overshoot them by a few tasks.
+"""
+import os
+import shutil
+from collections import Counter
+
+from flask import current_app
+from sqlalchemy import func
+
+from .metrics import ADMISSION_REJECTED
+from .models import Task
+
+# Statuses of tasks that have been admitted but have not started
+WAITING_STATUSES = ('PENDING', 'WAITING')
+
+
+class AdmissionError(Exception):
+    """A submission refused by :func:`admit`.
+
+    ``status`` is the HTTP status for the API (429 or 503) and
+    ``retry_after`` the seconds a client should wait before trying again.
+    """
+
+    def __init__(self, message, status, retry_after, task_type, reason):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.task_type = task_type
+        self.reason = reason
+
+
+def thresholds(conf):
+    """Effective limits of a plugin: the defaults with its ``admission`` overrides."""
+    config = current_app.config
+    limits = {
+        'max_queued': config['ADMISSION_MAX_QUEUED'],
+        'max_user_pending': config['ADMISSION_MAX_USER_PENDING'],
+        'min_free_mb': config['ADMISSION_MIN_FREE_MB'],
+        'retry_after': config['ADMISSION_RETRY_AFTER'],
+    }
+    for key, value in (conf.get('admission') or {}).items():
+        if key in limits and value is not None:
+            limits[key] = type(limits[key])(value)
+    return limits
+
+
+def queue_depths(user_id=None):
+    """Tasks waiting to start per plugin, of one user or of everyone."""
+    query = Task.query.with_entities(Task.task_type, func.count(Task.id)).filter(
+        Task.status.in_(WAITING_STATUSES), Task.archived.is_(False),
+    )
+    if user_id is not None:
+        query = query.filter(Task.user_id == user_id)
+    return dict(query.group_by(Task.task_type).all())
+
+
+def free_disk_mb():
+    """Free space on the file system holding ``OUTPUT_DIR``, in MiB."""
+    path = os.path.abspath(current_app.config['OUTPUT_DIR'])
+    # The directory is created with the first task
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free / (1024 * 1024)
+
+
+def admit(user, requested, configs):
+    """Raise :class:`AdmissionError` unless every requested task fits.
+
+    ``requested`` lists the plugin of each task to submit and ``configs``
+    is the result of :func:`~service.config_utils.load_config`.
+    """
+    counts = Counter(requested)
+    limits = {task_type: thresholds(configs[task_type]) for task_type in counts}
+    if any(lim['min_free_mb'] for lim in limits.values()):
+        free = free_disk_mb()
+        for task_type, lim in limits.items():
+            if lim['min_free_mb'] and free < lim['min_free_mb']:
+                _refuse(f'The server is low on disk space ({free:.0f} MiB free); '
+                        f'{task_type} tasks are not accepted until it is cleaned up',
+                        503, lim, task_type, 'disk')
+    if any(lim['max_queued'] for lim in limits.values()):
+        queued = queue_depths()
+        for task_type, lim in limits.items():
+            if lim['max_queued'] and queued.get(task_type, 0) + counts[task_type] > lim['max_queued']:
+                _refuse(f'The {task_type} queue is full ({queued.get(task_type, 0)} of '
+                        f'{lim["max_queued"]} tasks waiting)', 503, lim, task_type, 'queue')
+    if any(lim['max_user_pending'] for lim in limits.values()):
+        pending = queue_depths(user.id)
+        for task_type, lim in limits.items():
+            if lim['max_user_pending'] and pending.get(task_type, 0) + counts[task_type] > lim['max_user_pending']:
+                _refuse(f'You already have {pending.get(task_type, 0)} {task_type} tasks waiting to start; '
+                        f'at most {lim["max_user_pending"]} are allowed', 429, lim, task_type, 'user')
+
+
+def _refuse(message, status, limits, task_type, reason):
+    ADMISSION_REJECTED.inc(task_type, reason)
+    raise AdmissionError(message, status, limits['retry_after'], task_type, reason)
@@ -0,0 +1,362 @@
+"""Versioned JSON API for scripted clients.
+
+Clients authenticate with a personal token created on the *API tokens*
+page and sent as ``Authorization: Bearer <token>``.  The same token also
+works for the HTML download routes, so result files listed by the
+manifest endpoint can be fetched directly.
+
+=========================================  =====================================
+``GET  /api/v1/plugins``                   enabled plugins and their parameters
+``POST /api/v1/tasks``                     submit many tasks in one transaction
+``GET  /api/v1/tasks``                     paged task list with filters
+``GET|POST /api/v1/tasks/status``          status of many tasks by id
+``GET  /api/v1/tasks/<id>``                one task
+``GET  /api/v1/tasks/<id>/manifest``       result files with sizes and URLs
+``POST /api/v1/tasks/<id>/cancel``         cancel a queued or running task
+=========================================  =====================================
+"""
+import hashlib
+import json
+import os
+import secrets
+import shutil
+from datetime import datetime, timedelta
+
+from flask import Blueprint, current_app, jsonify, request, url_for
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException
+
+from .admission import AdmissionError, admit
+from .config_utils import load_config, task_output_dir
+from .models import db, ApiToken, Task, TaskArchive
+from .pipeline import InputError
+from .submission import check_inputs, create_task, file_params, queue_tasks
+
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# ``last_used`` of a token is written at most this often
+_TOUCH_INTERVAL = timedelta(minutes=5)
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def issue_token(user, name):
+    """Create an API token for ``user`` and return its secret value.
+
+    Only the digest is stored, so the value cannot be shown again.
+    """
+    token = secrets.token_urlsafe(32)
+    db.session.add(ApiToken(user_id=user.id, name=name[:80], token_hash=hash_token(token)))
+    db.session.commit()
+    return token
+
+
+def user_from_request(req):
+    """Return the user of the request's bearer token, or ``None``."""
+    scheme, _, token = req.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token.strip():
+        return None
+    record = ApiToken.query.filter_by(token_hash=hash_token(token.strip())).first()
+    if record is None:
+        return None
+    now = datetime.now()
+    if record.last_used is None or now - record.last_used > _TOUCH_INTERVAL:
+        record.last_used = now
+        db.session.commit()
+    return record.user
+
+
+def _error(status, message, **extra):
+    response = jsonify(error=message, **extra)
+    response.status_code = status
+    return response
+
+
+@api_bp.before_request
+def _authenticate():
+    if not current_user.is_authenticated:
+        return _error(401, 'A valid API token is required')
+    return None
+
+
+@api_bp.errorhandler(HTTPException)
+def _http_error(exc):
+    return _error(exc.code, exc.description)
+
+
+def _task_json(task):
+    return {
+        'id': task.id,
+        'task_type': task.task_type,
+        'status': task.status,
+        'parameters': task.parameters,
+        'parents': task.parents or [],
+        'progress': task.progress,
+        'progress_message': task.progress_message,
+        'priority': task.priority,
+        'create_time': task.create_time.isoformat() if task.create_time else None,
+        'start_time': task.start_time.isoformat() if task.start_time else None,
+        'end_time': task.end_time.isoformat() if task.end_time else None,
+        'archived': isinstance(task, TaskArchive) or task.archived,
+    }
+
+
+def _visible(query, model):
+    """Restrict ``query`` to the tasks the caller may see."""
+    if current_user.is_admin:
+        return query
+    return query.filter(model.user_id == current_user.id)
+
+
+def _get_task(task_id):
+    """Live or archived task ``task_id`` of the caller; 404 otherwise."""
+    task = db.session.get(Task, task_id)
+    if task is None or task.archived:
+        task = db.session.get(TaskArchive, task_id)
+    if task is None or (task.user_id != current_user.id and not current_user.is_admin):
+        return None
+    return task
+
+
+def _int_list(values):
+    try:
+        return [int(v) for v in values]
+    except (TypeError, ValueError):
+        return None
+
+
+@api_bp.route('/plugins', endpoint='plugins')
+def plugins():
+    configs = load_config()
+    return {'plugins': [
+        {
+            'name': name,
+            'parameters': conf.get('params_def', {}),
+            'result_keep': conf.get('result_keep') or [],
+        }
+        for name, conf in sorted(configs.items())
+    ]}
+
+
+def _parse_submission(spec, configs):
+    """Split one submitted task into ``(task_type, conf, values, uploads, refs)``."""
+    if not isinstance(spec, dict):
+        raise InputError('Each task must be an object')
+    task_type = spec.get('task_type')
+    if task_type not in configs:
+        raise InputError(f'Unknown or disabled plugin {task_type!r}')
+    conf = configs[task_type]
+    params_def = conf.get('params_def', {})
+    given = spec.get('parameters') or {}
+    if not isinstance(given, dict):
+        raise InputError('parameters must be an object')
+    unknown = sorted(set(given) - set(params_def))
+    if unknown:
+        raise InputError(f"Unknown parameters: {', '.join(unknown)}")
+    files = file_params(conf)
+    values, uploads, refs = {}, {}, {}
+    for name, param in params_def.items():
+        value = given.get(name)
+        if name in files:
+            if isinstance(value, dict) and 'upload' in value:
+                uploaded = request.files.get(str(value['upload']))
+                if uploaded is None:
+                    raise InputError(f"No file part {value['upload']!r} for {name}")
+                uploads[name] = uploaded
+            elif isinstance(value, dict) and 'task' in value:
+                refs[name] = f"{value['task']}:{value.get('file', '')}"
+            elif isinstance(value, str) and value:
+                refs[name] = value
+            continue
+        if value is None:
+            value = param.get('default')
+        if value is None and param.get('required', True):
+            raise InputError(f'Missing parameter {name}')
+        if param.get('type') == 'select' and value is not None and str(value) not in param.get('options', {}):
+            raise InputError(f'Invalid value {value!r} for {name}')
+        values[name] = None if value is None else str(value)
+    return task_type, conf, values, uploads, refs
+
+
+@api_bp.route('/tasks', methods=['POST'], endpoint='submit_tasks')
+def submit_tasks():
+    """Create every task of the request, or none of them.
+
+    The body is ``{"tasks": [{"task_type": ..., "parameters": {...}}]}``,
+    sent as JSON or as the ``tasks`` field of a multipart form whose file
+    parts are referenced by ``{"upload": "<part name>"}``.  File parameters
+    may also name another task's output as ``"<task_id>:<filename>"``.
+    Submissions over a plugin's admission limits are refused with 429 or
+    503 and a ``Retry-After`` header (see :mod:`service.admission`).
+    """
+    if request.is_json:
+        body = request.get_json(silent=True) or {}
+    else:
+        try:
+            body = json.loads(request.form.get('tasks') or '{}')
+        except ValueError:
+            return _error(400, 'The tasks field is not valid JSON')
+    specs = body.get('tasks') if isinstance(body, dict) else body
+    if not isinstance(specs, list) or not specs:
+        return _error(400, 'Expected a non-empty list of tasks')
+    limit = current_app.config['API_MAX_BATCH']
+    if len(specs) > limit:
+        return _error(413, f'At most {limit} tasks per request')
+
+    configs = load_config()
+    parsed, errors = [], []
+    for index, spec in enumerate(specs):
+        try:
+            task_type, conf, values, uploads, refs = _parse_submission(spec, configs)
+            check_inputs(conf, uploads, refs, current_user)
+            parsed.append((task_type, conf, values, uploads, refs))
+        except InputError as exc:
+            errors.append({'index': index, 'error': str(exc)})
+    if errors:
+        return _error(400, 'No tasks were created', errors=errors)
+    try:
+        admit(current_user, [p[0] for p in parsed], configs)
+    except AdmissionError as exc:
+        response = _error(exc.status, str(exc), task_type=exc.task_type, reason=exc.reason,
+                          retry_after=exc.retry_after)
+        response.headers['Retry-After'] = str(exc.retry_after)
+        return response
+
+    tasks = []
+    saved = {}
+    try:
+        for task_type, conf, values, uploads, refs in parsed:
+            tasks.append(create_task(current_user, task_type, conf, values, uploads, refs, saved))
+        queue_tasks(tasks)
+    except Exception:
+        db.session.rollback()
+        for task in tasks:
+            shutil.rmtree(task_output_dir(task.id), ignore_errors=True)
+        raise
+    response = jsonify(tasks=[{'id': t.id, 'status': t.status} for t in tasks])
+    response.status_code = 201
+    return response
+
+
+@api_bp.route('/tasks', methods=['GET'], endpoint='list_tasks')
+def list_tasks():
+    """Page through tasks, newest first.
+
+    Filters: ``status`` and ``task_type`` (comma separated), ``since``
+    (ISO time of submission) and ``archived=1`` for cold storage.
+    """
+    model = TaskArchive if request.args.get('archived') in ('1', 'true') else Task
+    query = _visible(model.query, model)
+    if model is Task:
+        query = query.filter(Task.archived.is_(False))
+    for field in ('status', 'task_type'):
+        if request.args.get(field):
+            query = query.filter(getattr(model, field).in_(request.args[field].split(',')))
+    if request.args.get('since'):
+        try:
+            since = datetime.fromisoformat(request.args['since'])
+        except ValueError:
+            return _error(400, 'since must be an ISO date or time')
+        query = query.filter(model.create_time >= since)
+    if current_user.is_admin and request.args.get('user_id'):
+        query = query.filter(model.user_id == request.args.get('user_id', type=int))
+    page = query.order_by(model.id.desc()).paginate(
+        max_per_page=current_app.config['API_MAX_BATCH'], error_out=False,
+    )
+    return {
+        'tasks': [_task_json(t) for t in page.items],
+        'page': page.page,
+        'per_page': page.per_page,
+        'total': page.total,
+        'next_page': page.next_num,
+    }
+
+
+@api_bp.route('/tasks/status', methods=['GET', 'POST'], endpoint='task_status')
+def task_status():
+    """Status of many tasks: ``?ids=1,2,3`` or ``{"ids": [1, 2, 3]}``."""
+    if request.method == 'POST':
+        ids = _int_list((request.get_json(silent=True) or {}).get('ids') or [])
+    else:
+        ids = _int_list(x for x in request.args.get('ids', '').split(',') if x.strip())
+    if ids is None:
+        return _error(400, 'ids must be integers')
+    if len(ids) > current_app.config['API_MAX_BATCH']:
+        return _error(413, f"At most {current_app.config['API_MAX_BATCH']} ids per request")
+    found = {}
+    for model in (Task, TaskArchive):
+        missing = [i for i in ids if i not in found]
+        if not missing:
+            break
+        query = _visible(model.query, model).filter(model.id.in_(missing))
+        if model is Task:
+            query = query.filter(Task.archived.is_(False))
+        for task in query:
+            found[task.id] = task
+    return {
+        'tasks': [
+            {
+                'id': task.id,
+                'status': task.status,
+                'progress': task.progress,
+                'progress_message': task.progress_message,
+                'end_time': task.end_time.isoformat() if task.end_time else None,
+            }
+            for task in (found[i] for i in ids if i in found)
+        ],
+        'missing': [i for i in ids if i not in found],
+    }
+
+
+@api_bp.route('/tasks/<int:task_id>', endpoint='get_task')
+def get_task(task_id):
+    task = _get_task(task_id)
+    if task is None:
+        return _error(404, 'Task not found')
+    return _task_json(task)
+
+
+@api_bp.route('/tasks/<int:task_id>/manifest', endpoint='manifest')
+def manifest(task_id):
+    """List the task's result files with their sizes and download URLs.
+
+    Sizes of archived tasks are unknown until the first download restores
+    their outputs.
+    """
+    task = _get_task(task_id)
+    if task is None:
+        return _error(404, 'Task not found')
+    output_dir = task_output_dir(task.id)
+    files = []
+    for name in task.result_files or []:
+        path = os.path.join(output_dir, name)
+        stat = os.stat(path) if os.path.isfile(path) else None
+        endpoint = 'user.view_file' if name == task.html_file else 'user.download_file'
+        files.append({
+            'name': name,
+            'size': stat.st_size if stat else None,
+            'modified': datetime.fromtimestamp(stat.st_mtime).isoformat() if stat else None,
+            'url': url_for(endpoint, task_id=task.id, filename=name, _external=True),
+        })
+    return {
+        'id': task.id,
+        'status': task.status,
+        'html_file': task.html_file,
+        'files': files,
+        'log_url': url_for('user.task_log', task_id=task.id, _external=True),
+    }
+
+
+@api_bp.route('/tasks/<int:task_id>/cancel', methods=['POST'], endpoint='cancel_task')
+def cancel(task_id):
+    from .tasks import cancel_task
+
+    task = db.session.get(Task, task_id)
+    if task is None or task.archived or (task.user_id != current_user.id and not current_user.is_admin):
+        return _error(404, 'Task not found')
+    if task.status not in ('PENDING', 'RUNNING', 'WAITING'):
+        return _error(409, f'Task already ended as {task.status}')
+    cancel_task(task)
+    return {'id': task.id, 'status': task.status}
@@ -0,0 +1,194 @@
+"""Move old tasks and their outputs into compressed monthly archives.
+
+Finished tasks whose ``end_time`` is older than ``ARCHIVE_RETENTION_DAYS``
+have ``outputs/<task_id>/`` packed into ``ARCHIVE_DIR/<YYYY-MM>.zip`` and
+their :class:`~service.models.Task` row moved to ``task_archive``.  Each
+monthly zip has a ``<YYYY-MM>.json`` index next to it listing the files
+stored per task.  Files are unpacked again on demand by :func:`restore_task`
+and removed once more after ``ARCHIVE_RESTORE_HOURS``.
+
+Run once from the command line with ``python -m service.archive``; the
+server also runs it periodically via :func:`start_archiver`.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime, timedelta
+from itertools import groupby
+
+from flask import current_app
+
+from .config_utils import task_output_dir
+from .models import db, Task, TaskArchive
+
+FINISHED_STATUSES = ('SUCCESS', 'FAILURE', 'CANCELLED')
+# Already compressed formats are stored as-is instead of deflated again
+_STORED_EXTENSIONS = {'.zip', '.gz', '.png', '.jpg', '.jpeg', '.xlsx', '.7z'}
+_ARCHIVE_COLUMNS = [c.name for c in Task.__table__.columns]
+
+
+def _load_index(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def _save_index(path, index):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp, path)
+
+
+def _pack_outputs(zf, task_id):
+    """Add ``outputs/<task_id>/`` to ``zf`` and return the stored files."""
+    output_dir = task_output_dir(task_id)
+    stored = []
+    if not os.path.isdir(output_dir):
+        return stored
+    for root, _, files in os.walk(output_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, output_dir).replace(os.sep, '/')
+            ext = os.path.splitext(name)[1].lower()
+            compress = zipfile.ZIP_STORED if ext in _STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            zf.write(path, f'{task_id}/{rel}', compress_type=compress)
+            stored.append({'name': rel, 'size': os.path.getsize(path)})
+    return stored
+
+
+def archive_old_tasks(retention_days=None, now=None):
+    """Archive finished tasks older than the retention window.
+
+    Returns the number of tasks moved to the archive table.
+    """
+    if retention_days is None:
+        retention_days = current_app.config['ARCHIVE_RETENTION_DAYS']
+    now = now or datetime.now()
+    cutoff = now - timedelta(days=retention_days)
+    archive_dir = current_app.config['ARCHIVE_DIR']
+    os.makedirs(archive_dir, exist_ok=True)
+
+    tasks = Task.query.filter(
+        Task.status.in_(FINISHED_STATUSES),
+        Task.end_time < cutoff,
+    ).order_by(Task.end_time).all()
+
+    moved = 0
+    for month, group in groupby(tasks, key=lambda t: t.end_time.strftime('%Y-%m')):
+        group = list(group)
+        zip_name = f'{month}.zip'
+        index_path = os.path.join(archive_dir, f'{month}.json')
+        index = _load_index(index_path)
+        with zipfile.ZipFile(os.path.join(archive_dir, zip_name), 'a', zipfile.ZIP_DEFLATED) as zf:
+            for task in group:
+                # A previous run may have packed the files but not committed
+                if str(task.id) not in index:
+                    index[str(task.id)] = _pack_outputs(zf, task.id)
+        _save_index(index_path, index)
+
+        for task in group:
+            entry = TaskArchive(**{c: getattr(task, c) for c in _ARCHIVE_COLUMNS})
+            entry.archive_file = zip_name
+            entry.archived_time = now
+            db.session.add(entry)
+            db.session.delete(task)
+        db.session.commit()
+
+        for task in group:
+            shutil.rmtree(task_output_dir(task.id), ignore_errors=True)
+        moved += len(group)
+    return moved
+
+
+def prune_restored(max_age_hours=None, now=None):
+    """Remove outputs restored for download more than ``max_age_hours`` ago."""
+    if max_age_hours is None:
+        max_age_hours = current_app.config['ARCHIVE_RESTORE_HOURS']
+    now = now or datetime.now()
+    cutoff = now - timedelta(hours=max_age_hours)
+    entries = TaskArchive.query.filter(TaskArchive.restored_time < cutoff).all()
+    for entry in entries:
+        shutil.rmtree(task_output_dir(entry.id), ignore_errors=True)
+        entry.restored_time = None
+    db.session.commit()
+    return len(entries)
+
+
+def restore_task(entry):
+    """Unpack an archived task's files into ``outputs/<id>/``.
+
+    Returns the output directory.  Already restored tasks are left as-is.
+    """
+    output_dir = task_output_dir(entry.id)
+    if not os.path.isdir(output_dir) and entry.archive_file:
+        zip_path = os.path.join(current_app.config['ARCHIVE_DIR'], entry.archive_file)
+        prefix = f'{entry.id}/'
+        parent = os.path.dirname(output_dir)
+        os.makedirs(parent, exist_ok=True)
+        # Extract next to the final location and rename so that concurrent
+        # downloads never see a half-restored directory.
+        tmp = tempfile.mkdtemp(prefix=f'.restore-{entry.id}-', dir=parent)
+        try:
+            with zipfile.ZipFile(zip_path) as zf:
+                members = [m for m in zf.namelist() if m.startswith(prefix)]
+                zf.extractall(tmp, members)
+            staged = os.path.join(tmp, str(entry.id))
+            os.makedirs(staged, exist_ok=True)
+            try:
+                os.rename(staged, output_dir)
+            except OSError:
+                pass  # restored by a concurrent request
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+    entry.restored_time = datetime.now()
+    db.session.commit()
+    return output_dir
+
+
+def run_archival(app):
+    """Archive old tasks and prune stale restores inside ``app``'s context."""
+    with app.app_context():
+        moved = archive_old_tasks()
+        pruned = prune_restored()
+        if moved or pruned:
+            app.logger.info('Archived %d tasks, pruned %d restores', moved, pruned)
+        return moved
+
+
+def start_archiver(app):
+    """Run :func:`run_archival` every ``ARCHIVE_INTERVAL_HOURS`` in a thread."""
+    interval = app.config['ARCHIVE_INTERVAL_HOURS'] * 3600
+    if interval <= 0:
+        return None
+
+    def loop():
+        while True:
+            try:
+                run_archival(app)
+            except Exception:  # pragma: no cover - keep the scheduler alive
+                app.logger.exception('Task archival failed')
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name='task-archiver', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    from .flask_app import app
+
+    parser = argparse.ArgumentParser(description='Archive old tasks to cold storage.')
+    parser.add_argument('--days', type=int, default=None,
+                        help='Retention window in days (default: ARCHIVE_RETENTION_DAYS)')
+    args = parser.parse_args()
+    with app.app_context():
+        count = archive_old_tasks(args.days)
+        prune_restored()
+    print(f'Archived {count} tasks')
@@ -0,0 +1,188 @@
+"""Fingerprinted, precompressed static files and compressed result pages.
+
+``url_for('static', filename='css/style.css')`` renders as
+``/static/css/style.<hash>.css``, where ``<hash>`` is taken from the
+file's content.  Those URLs change whenever the file does, so they are
+served with ``Cache-Control: public, max-age=31536000, immutable`` and
+browsers stop revalidating Bootstrap on every page.  Plain URLs keep
+working and are revalidated as before.
+
+Text assets are compressed once per process and content hash, with gzip
+and with brotli when the optional ``brotli`` package is installed; each
+request gets the variant its ``Accept-Encoding`` prefers.
+
+:func:`send_output` does the same for task outputs shown by ``view_file``
+(the sparams ``index.html``, ``result.html``, ``error.html``, CSV files):
+text files are compressed on the fly at a faster level, tagged with an
+ETag from their size and modification time, and the last few results are
+kept in memory.
+"""
+import functools
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+from flask import current_app, request, send_file, send_from_directory
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+try:  # Optional; only gzip is offered without it
+    import brotli
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# Smaller files are not worth the Content-Encoding overhead
+MIN_COMPRESS_BYTES = 1024
+_TEXT_TYPES = ('application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+_HASHED_RE = re.compile(r'^(?P<stem>.+)\.(?P<digest>[0-9a-f]{12})(?P<ext>\.[^./]+)$')
+
+_assets = {}
+_lock = threading.Lock()
+
+
+def encodings():
+    """Content codings offered to clients, most preferred first."""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def _compressible(mimetype):
+    return bool(mimetype) and (mimetype.startswith('text/') or mimetype in _TEXT_TYPES)
+
+
+def _compress(data, encoding, fast=False):
+    if encoding == 'br':
+        return brotli.compress(data, quality=5 if fast else 11)
+    return gzip.compress(data, 6 if fast else 9, mtime=0)
+
+
+def _accepted_encoding(mimetype, size):
+    """The coding to send a ``size`` byte response in, or ``None``."""
+    if not _compressible(mimetype) or size < MIN_COMPRESS_BYTES:
+        return None
+    return request.accept_encodings.best_match(encodings())
+
+
+class _Asset:
+    """A static file with its content hash and compressed variants."""
+
+    def __init__(self, path, stat, data):
+        self.path = path
+        self.key = (stat.st_mtime_ns, stat.st_size)
+        self.digest = hashlib.sha256(data).hexdigest()[:12]
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        # Only text is kept in memory; other files are streamed from disk
+        self.data = data if _compressible(self.mimetype) else None
+        self.variants = {}
+
+    def variant(self, encoding):
+        """``data`` in ``encoding``, or ``None`` if that does not make it smaller."""
+        if encoding not in self.variants:
+            body = _compress(self.data, encoding)
+            self.variants[encoding] = body if len(body) < len(self.data) else None
+        return self.variants[encoding]
+
+
+def _asset(filename):
+    """Return the static file ``filename``, reloading it when it changed."""
+    path = safe_join(current_app.static_folder, filename)
+    try:
+        stat = os.stat(path) if path else None
+    except OSError:
+        stat = None
+    if stat is None or not os.path.isfile(path):
+        return None
+    asset = _assets.get(filename)
+    if asset is not None and asset.key == (stat.st_mtime_ns, stat.st_size):
+        return asset
+    with open(path, 'rb') as f:
+        asset = _Asset(path, stat, f.read())
+    with _lock:
+        _assets[filename] = asset
+    return asset
+
+
+def _fingerprint(endpoint, values):
+    """``url_defaults`` hook adding the content hash to static file names."""
+    if endpoint != 'static' or 'filename' not in values:
+        return
+    asset = _asset(values['filename'])
+    if asset is not None:
+        stem, ext = os.path.splitext(values['filename'])
+        values['filename'] = f'{stem}.{asset.digest}{ext}'
+
+
+def serve_static(filename):
+    """View of ``/static/<filename>`` replacing Flask's."""
+    match = _HASHED_RE.match(filename)
+    asset = _asset(match['stem'] + match['ext']) if match else None
+    if asset is not None and asset.digest == match['digest']:
+        cache_control = IMMUTABLE
+    else:
+        # Unhashed, or a hash from before the file changed
+        asset = asset or _asset(filename)
+        cache_control = 'no-cache'
+    if asset is None:
+        raise NotFound()
+
+    if asset.data is None:
+        response = send_file(asset.path, mimetype=asset.mimetype, etag=asset.digest)
+        response.headers['Cache-Control'] = cache_control
+        return response
+    encoding = _accepted_encoding(asset.mimetype, len(asset.data))
+    body = asset.variant(encoding) if encoding else None
+    response = current_app.response_class(body or asset.data, mimetype=asset.mimetype)
+    response.set_etag(f'{asset.digest}-{encoding}' if body else asset.digest)
+    if body:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = cache_control
+    return response.make_conditional(request)
+
+
+@functools.lru_cache(maxsize=32)
+def _compressed_output(path, key, encoding):
+    with open(path, 'rb') as f:
+        return _compress(f.read(), encoding, fast=True)
+
+
+def send_output(directory, filename):
+    """``send_from_directory`` for task outputs, compressing text files.
+
+    Files larger than ``OUTPUT_COMPRESS_MAX_MB`` are sent as they are.
+    """
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+    stat = os.stat(path)
+    mimetype = mimetypes.guess_type(path)[0]
+    encoding = None
+    if stat.st_size <= current_app.config['OUTPUT_COMPRESS_MAX_MB'] * 1024 * 1024:
+        encoding = _accepted_encoding(mimetype, stat.st_size)
+    if encoding is None:
+        response = send_from_directory(directory, filename, as_attachment=False)
+    else:
+        key = (stat.st_mtime_ns, stat.st_size)
+        etag = f'{key[0]:x}-{key[1]:x}-{encoding}'
+        # Unchanged files are revalidated without compressing them again
+        if request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.response_class(
+                _compressed_output(path, key, encoding), mimetype=mimetype,
+            )
+            response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+    if _compressible(mimetype):
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_assets(app):
+    """Serve ``app``'s static files fingerprinted and precompressed."""
+    app.url_defaults(_fingerprint)
+    app.view_functions['static'] = serve_static
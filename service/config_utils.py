@@ -1,5 +1,4 @@
 import os
-import yaml
 import ast
 from flask import current_app
 
@@ -28,10 +27,25 @@ def load_config(enabled_only: bool = True):
             "params_def": cfg.get("parameters", {}),
             "metadata": info.get("metadata", {}),
             "result_keep": cfg.get("result_keep"),
+            # Optional ``timeout`` (s), ``memory_mb`` and ``nice`` for the runner
+            "limits": cfg.get("limits") or {},
+            # ``host`` runs jobs in a warm, preloaded interpreter; see runner_host
+            "mode": cfg.get("mode", "fresh"),
+            "preload": cfg.get("preload") or [],
+            # Runner renames finished ``*.part`` files; publish them mid-run
+            "publish_partial": bool(cfg.get("publish_partial")),
+            # ``max_queued``, ``max_user_pending``, ``min_free_mb`` and
+            # ``retry_after`` override the ADMISSION_* defaults
+            "admission": cfg.get("admission") or {},
         }
     return configs
 
 
+def task_output_dir(task_id) -> str:
+    """Return the absolute output directory of a task."""
+    return os.path.join(current_app.config["OUTPUT_DIR"], str(task_id))
+
+
 def get_task_description(task_type: str) -> str:
     """Return the module level docstring from a plugin's runner."""
     configs = load_config(enabled_only=False)
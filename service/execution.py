@@ -0,0 +1,417 @@
+"""Run plugin scripts as child processes and stream their output.
+
+This module has no Flask dependency so it can be reused outside the web
+application.  Child output is written line by line to a size-bounded
+rotating log file while only the last few lines are kept in memory.
+
+Runners report progress by printing lines of the form::
+
+    PROGRESS <percent> [message]
+
+for example ``PROGRESS 40 Plotting S(1,2)``.
+
+Runners of plugins with ``publish_partial: true`` write each result file
+as ``<name>.part`` and rename it when complete; :class:`ResultWatcher`
+publishes renamed files while the runner is still going.
+"""
+import fnmatch
+import html
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+from collections import deque
+
+try:  # POSIX only
+    import resource
+except ImportError:  # pragma: no cover - Windows
+    resource = None
+
+LOG_FILE = 'run.log'
+# Suffix of result files still being written
+PART_SUFFIX = '.part'
+_PROGRESS_RE = re.compile(r'^PROGRESS\s+(\d+(?:\.\d+)?)\s*(.*)$')
+
+
+def build_command(task_conf, params, service_root):
+    """Return the argv running a plugin's script with ``params``.
+
+    ``task_conf`` is an entry of :func:`service.config_utils.load_config`;
+    its ``script_path`` is relative to ``service_root``.
+    """
+    # expand user and resolve absolute paths for Python executable and script
+    venv_python = os.path.expanduser(task_conf.get('venv_python', 'python'))
+    if venv_python == 'python':
+        venv_python = sys.executable
+    script_rel = task_conf.get('script_path')
+    script_path = os.path.join(service_root, script_rel) if script_rel else None
+    cmd = [venv_python, script_path]
+    for key, value in (params or {}).items():
+        cmd += [f'--{key}', str(value)]
+    return cmd
+
+
+def select_result_files(output_dir, keep_patterns=None):
+    """Return the files in ``output_dir`` to publish as task results.
+
+    Unfinished ``*.part`` files are never published.
+    """
+    files = [f for f in os.listdir(output_dir) if not f.endswith(PART_SUFFIX)]
+    if keep_patterns:
+        kept = set()
+        for pat in keep_patterns:
+            kept.update(fnmatch.filter(files, pat))
+        files = sorted(kept)
+    return files
+
+
+class ResultWatcher:
+    """Poll a running task's output directory for completed result files.
+
+    ``on_change(files)`` is called from a background thread with the
+    result of :func:`select_result_files` whenever it differs from the
+    previous poll.  Polling is used rather than file system notifications
+    so it works the same on every platform and network share.
+    """
+
+    def __init__(self, output_dir, keep_patterns, on_change, interval=5.0):
+        self.output_dir = output_dir
+        self.keep_patterns = keep_patterns
+        self.on_change = on_change
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._last = []
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='result-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop polling; no callback runs after this returns."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def poll(self):
+        try:
+            files = select_result_files(self.output_dir, self.keep_patterns)
+        except OSError:
+            return
+        if files != self._last:
+            self._last = files
+            self.on_change(files)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.poll()
+
+
+def write_error_report(output_dir, text):
+    """Write ``text`` as a preformatted ``error.html`` report."""
+    error_file = os.path.join(output_dir, 'error.html')
+    with open(error_file, 'w') as f:
+        f.write('<html><body><pre>')
+        f.write(html.escape(text))
+        f.write('</pre></body></html>')
+
+
+class RotatingLog:
+    """Append-only text log rotated to ``<name>.1`` ... when it grows too big."""
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._file = open(path, 'a', encoding='utf-8')
+        self._size = self._file.tell()
+
+    def write(self, text):
+        size = len(text.encode('utf-8'))
+        if self.max_bytes and self._size + size > self.max_bytes and self._size:
+            self._rotate()
+        self._file.write(text)
+        self._file.flush()
+        self._size += size
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = f'{self.path}.{i}'
+            if os.path.exists(src):
+                os.replace(src, f'{self.path}.{i + 1}')
+        if self.backups > 0:
+            os.replace(self.path, f'{self.path}.1')
+        self._file = open(self.path, 'w', encoding='utf-8')
+        self._size = 0
+
+    def close(self):
+        self._file.close()
+
+
+def parse_progress(line):
+    """Return ``(percent, message)`` for a progress line, otherwise ``None``."""
+    match = _PROGRESS_RE.match(line.strip())
+    if not match:
+        return None
+    percent = max(0, min(100, int(float(match.group(1)))))
+    return percent, match.group(2).strip()
+
+
+class ExecResult:
+    """Outcome of :func:`run_command`."""
+
+    def __init__(self, returncode, tail, timed_out=False, cpu_time=None, peak_rss_kb=None,
+                 cancelled=False):
+        self.returncode = returncode
+        # Last lines of combined stdout/stderr
+        self.tail = tail
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+        # User plus system CPU seconds and peak resident set size of the
+        # child; ``None`` where the platform cannot report them.
+        self.cpu_time = cpu_time
+        self.peak_rss_kb = peak_rss_kb
+
+    @property
+    def output(self):
+        return ''.join(self.tail)
+
+
+def _limit_preexec(limits):
+    """Return a ``preexec_fn`` applying memory and nice limits, if any."""
+    memory_mb = limits.get('memory_mb')
+    nice = limits.get('nice')
+    if resource is None or (not memory_mb and not nice):
+        return None
+
+    def apply():
+        if memory_mb:
+            size = int(memory_mb) * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (size, size))
+        if nice:
+            os.nice(int(nice))
+    return apply
+
+
+def kill_tree(pid):
+    """Forcefully terminate process ``pid`` and all of its descendants.
+
+    Runners are started as process group leaders (see :func:`run_command`)
+    so that AEDT/EDB child processes are stopped as well.
+    """
+    if os.name == 'nt':
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(pid)], capture_output=True)
+        return
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def terminate_tree(pid):
+    """Ask process ``pid`` and its descendants to exit.
+
+    Sends SIGTERM to the process group on POSIX and a close request to the
+    tree on Windows; use :func:`kill_tree` if they do not comply.
+    """
+    if os.name == 'nt':
+        subprocess.run(['taskkill', '/T', '/PID', str(pid)], capture_output=True)
+        return
+    try:
+        os.killpg(pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class CancelToken:
+    """Lets another thread stop a :func:`run_command` call.
+
+    :meth:`cancel` may be called before, during or after the run.  The
+    child tree is asked to terminate and killed if it is still alive after
+    ``grace`` seconds.  ``finished`` is set once the child has exited.
+    """
+
+    def __init__(self, grace=10.0):
+        self.grace = grace
+        self.cancelled = False
+        self.finished = threading.Event()
+        self._callback = None
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            callback = self._callback
+        if callback is not None:
+            callback()
+
+    def _bind(self, callback):
+        with self._lock:
+            self._callback = callback
+            cancelled = self.cancelled
+        if cancelled and callback is not None:
+            callback()
+
+
+def _wait(proc):
+    """Wait for ``proc`` and return ``(returncode, cpu_time, peak_rss_kb)``."""
+    if not hasattr(os, 'wait4'):
+        return proc.wait(), None, None
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    peak = usage.ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024  # reported in bytes on macOS
+    return proc.returncode, usage.ru_utime + usage.ru_stime, peak
+
+
+def run_command(cmd, cwd, log_path, on_progress=None, tail_lines=200,
+                max_bytes=10 * 1024 * 1024, backups=3, limits=None, cancel=None,
+                host=None):
+    """Run ``cmd`` in ``cwd`` streaming its output to ``log_path``.
+
+    ``on_progress(percent, message)`` is called for every progress line.
+    Memory use is bounded by ``tail_lines`` regardless of how much the
+    child prints.  ``limits`` may contain ``timeout`` (wall-clock seconds),
+    ``memory_mb`` (address space cap) and ``nice``; the last two only apply
+    on POSIX systems.  ``cancel`` is an optional :class:`CancelToken`.
+    With a :class:`~service.runner_host.RunnerHost` the job is forked from
+    the warm host instead of starting a new interpreter.
+    """
+    limits = limits or {}
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    tail = deque(maxlen=tail_lines)
+    log = RotatingLog(log_path, max_bytes=max_bytes, backups=backups)
+    timer = None
+    timed_out = threading.Event()
+    cancelled = threading.Event()
+    exited = threading.Event()
+    lock = threading.Lock()
+    try:
+        proc = None
+        if host is not None:
+            try:
+                proc = host.run(cmd, cwd, limits)
+            except (OSError, ValueError) as exc:
+                log.write(f'Runner host unavailable ({exc}); starting a new process\n')
+        if proc is None:
+            proc = subprocess.Popen(
+                cmd, cwd=cwd, env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                text=True, encoding='utf-8', errors='replace', bufsize=1,
+                preexec_fn=_limit_preexec(limits),
+                # Own process group so the whole tree can be killed at once
+                start_new_session=os.name != 'nt',
+                creationflags=getattr(subprocess, 'CREATE_NEW_PROCESS_GROUP', 0),
+            )
+        timeout = limits.get('timeout')
+        if timeout:
+            def expire():
+                with lock:
+                    if proc.returncode is None:
+                        timed_out.set()
+                        kill_tree(proc.pid)
+            timer = threading.Timer(float(timeout), expire)
+            timer.daemon = True
+            timer.start()
+        if cancel is not None:
+            def escalate():
+                with lock:
+                    if proc.returncode is not None:
+                        return
+                    cancelled.set()
+                    terminate_tree(proc.pid)
+                if not exited.wait(cancel.grace):
+                    with lock:
+                        if proc.returncode is None:
+                            kill_tree(proc.pid)
+            cancel._bind(lambda: threading.Thread(target=escalate, daemon=True).start())
+        with proc.stdout:
+            for line in proc.stdout:
+                log.write(line)
+                tail.append(line)
+                if on_progress is not None:
+                    progress = parse_progress(line)
+                    if progress is not None:
+                        on_progress(*progress)
+        if isinstance(proc, subprocess.Popen):
+            if hasattr(os, 'waitid'):
+                # Wait without reaping so the timer can never signal a reused PID
+                os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+            with lock:
+                returncode, cpu_time, peak_rss_kb = _wait(proc)
+        else:
+            # The host reaps the job and reports its status after the output
+            with lock:
+                returncode, cpu_time, peak_rss_kb = proc.wait()
+                if proc.lost:
+                    kill_tree(proc.pid)
+                    message = 'Runner host exited during the run\n'
+                    log.write(message)
+                    tail.append(message)
+        exited.set()
+        if timed_out.is_set():
+            message = f'Terminated after exceeding the {timeout} s time limit\n'
+            log.write(message)
+            tail.append(message)
+        if cancelled.is_set():
+            message = 'Cancelled\n'
+            log.write(message)
+            tail.append(message)
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if cancel is not None:
+            cancel._bind(None)
+            cancel.finished.set()
+        log.close()
+    return ExecResult(
+        returncode, list(tail), timed_out=timed_out.is_set(),
+        cpu_time=cpu_time, peak_rss_kb=peak_rss_kb, cancelled=cancelled.is_set(),
+    )
+
+
+def directory_size(path):
+    """Return the total size in bytes of all files below ``path``."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def read_log(log_path, offset=0, limit=64 * 1024):
+    """Return ``(text, new_offset)`` read from ``log_path`` after ``offset``.
+
+    When the log was rotated since the caller's last read, reading restarts
+    at the beginning of the new file.  A UTF-8 character cut by ``limit``
+    is left for the next read.
+    """
+    if not os.path.exists(log_path):
+        return '', 0
+    size = os.path.getsize(log_path)
+    if offset < 0 or offset > size:
+        offset = 0
+    with open(log_path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(limit)
+    data = data[:_complete_utf8(data)]
+    return data.decode('utf-8', errors='replace'), offset + len(data)
+
+
+def _complete_utf8(data):
+    """Length of ``data`` without a trailing incomplete UTF-8 sequence."""
+    for back in range(1, min(4, len(data)) + 1):
+        byte = data[-back]
+        if byte & 0xC0 != 0x80:  # not a continuation byte
+            needed = 2 if byte >= 0xC0 else 1
+            needed += (byte >= 0xE0) + (byte >= 0xF0)
+            return len(data) - back if needed > back else len(data)
+    return len(data)
@@ -0,0 +1,179 @@
+"""Record plugin resource profiles and generate fake-solver plugins.
+
+``record`` derives a profile per real plugin from finished tasks: runtime
+percentiles, CPU share, peak memory and the shape of the output directory.
+``generate`` turns each profile into ``apps/fake_<plugin>/`` with the same
+parameters and ``result_keep`` patterns as the real plugin and a runner
+(:mod:`service.fake_solver`) that replays the profile, so scheduling, I/O
+and file serving can be profiled on machines without AEDT::
+
+    python -m service.fake_plugins record
+    python -m service.fake_plugins generate
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+from datetime import date
+
+import yaml
+
+from .metrics import percentile
+from .plugin_loader import APP_DIR
+
+PROFILE_DIR = os.path.join(os.path.dirname(__file__), 'profiles')
+FAKE_PREFIX = 'fake_'
+_RUNNER_SOURCE = os.path.join(os.path.dirname(__file__), 'fake_solver.py')
+
+
+def _median(values):
+    return percentile(values, 50) if values else 0
+
+
+def _describe_outputs(output_dirs):
+    """Summarise output directories into profile ``outputs`` entries."""
+    samples = {}
+    for output_dir in output_dirs:
+        seen = {}
+        for name in os.listdir(output_dir):
+            path = os.path.join(output_dir, name)
+            if name in ('run.log', 'result.json') or name.startswith('run.log.'):
+                continue
+            if os.path.isdir(path):
+                files = [os.path.join(r, f) for r, _, fs in os.walk(path) for f in fs]
+                entry = {'name': name, 'type': 'tree', 'files': len(files),
+                         'bytes': sum(os.path.getsize(f) for f in files)}
+                seen[('tree', name)] = entry
+                continue
+            # Numbered outputs such as S_1_2.png collapse into one group
+            pattern = re.sub(r'\d+', '#', name)
+            size = os.path.getsize(path)
+            if pattern != name:
+                group = seen.setdefault(('group', pattern), {
+                    'pattern': pattern, 'type': 'group', 'count': 0, 'bytes_each': 0,
+                })
+                group['bytes_each'] = (group['bytes_each'] * group['count'] + size) // (group['count'] + 1)
+                group['count'] += 1
+            else:
+                seen[('file', name)] = {'name': name, 'bytes': size}
+        for key, entry in seen.items():
+            samples.setdefault(key, []).append(entry)
+
+    outputs = []
+    for key, entries in sorted(samples.items()):
+        # Keep outputs produced by at least half of the sampled runs
+        if len(entries) * 2 < len(output_dirs):
+            continue
+        merged = dict(entries[0])
+        for field in ('bytes', 'files', 'count', 'bytes_each'):
+            if field in merged:
+                merged[field] = int(_median([e[field] for e in entries]))
+        outputs.append(merged)
+    return outputs
+
+
+def record_profiles(limit=200):
+    """Write a profile for every real plugin with successful task history."""
+    from .config_utils import task_output_dir
+    from .models import Task
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    written = []
+    task_types = [t for (t,) in Task.query.with_entities(Task.task_type).distinct()]
+    for task_type in task_types:
+        if task_type.startswith(FAKE_PREFIX) or task_type == 'stub':
+            continue
+        tasks = Task.query.filter(
+            Task.task_type == task_type,
+            Task.status == 'SUCCESS',
+            Task.start_time.isnot(None),
+            Task.end_time.isnot(None),
+        ).order_by(Task.end_time.desc()).limit(limit).all()
+        if not tasks:
+            continue
+        durations = [(t.end_time - t.start_time).total_seconds() for t in tasks]
+        cpu_shares = [t.cpu_time / d for t, d in zip(tasks, durations) if t.cpu_time and d > 0]
+        peaks = [t.peak_rss_kb / 1024 for t in tasks if t.peak_rss_kb]
+        dirs = [task_output_dir(t.id) for t in tasks[:20] if os.path.isdir(task_output_dir(t.id))]
+        profile = {
+            'plugin': task_type,
+            'source': f'recorded {date.today().isoformat()} from {len(tasks)} tasks',
+            'duration_s': {
+                'p50': percentile(durations, 50, 2),
+                'p95': percentile(durations, 95, 2),
+            },
+            'cpu_fraction': round(min(1.0, _median(cpu_shares)), 2) if cpu_shares else 0.5,
+            'peak_rss_mb': round(_median(peaks)) if peaks else 0,
+            'outputs': _describe_outputs(dirs),
+        }
+        path = os.path.join(PROFILE_DIR, f'{task_type}.json')
+        with open(path, 'w') as f:
+            json.dump(profile, f, indent=2)
+        written.append(path)
+    return written
+
+
+def generate_plugins():
+    """Create ``apps/fake_<plugin>/`` from every profile in ``PROFILE_DIR``."""
+    created = []
+    for fname in sorted(os.listdir(PROFILE_DIR)):
+        if not fname.endswith('.json'):
+            continue
+        with open(os.path.join(PROFILE_DIR, fname)) as f:
+            profile = json.load(f)
+        plugin = profile['plugin']
+        real_cfg_path = os.path.join(APP_DIR, plugin, 'config.yaml')
+        real_cfg = {}
+        if os.path.exists(real_cfg_path):
+            with open(real_cfg_path) as f:
+                real_cfg = yaml.safe_load(f) or {}
+
+        timeout = max(600, int(profile['duration_s']['p95'] * 4))
+        config = {
+            'venv_python': 'python',
+            'script': 'runner.py',
+            'default_enabled': False,
+            'parameters': real_cfg.get('parameters', {}),
+            'limits': {'timeout': timeout},
+        }
+        if real_cfg.get('result_keep'):
+            config['result_keep'] = real_cfg['result_keep']
+        metadata = {
+            'name': f'Fake {plugin}',
+            'description': f'Synthetic load with the resource profile of {plugin} '
+                           f'({profile.get("source", "unknown source")})',
+        }
+
+        pdir = os.path.join(APP_DIR, FAKE_PREFIX + plugin)
+        os.makedirs(pdir, exist_ok=True)
+        with open(os.path.join(pdir, 'config.yaml'), 'w') as f:
+            f.write('# Generated by service.fake_plugins; do not edit by hand\n')
+            yaml.safe_dump(config, f, sort_keys=False, allow_unicode=True)
+        with open(os.path.join(pdir, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f, indent=2)
+            f.write('\n')
+        with open(os.path.join(pdir, 'profile.json'), 'w') as f:
+            json.dump(profile, f, indent=2)
+            f.write('\n')
+        shutil.copyfile(_RUNNER_SOURCE, os.path.join(pdir, 'runner.py'))
+        created.append(pdir)
+    return created
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record profiles and generate fake-solver plugins.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    rec = sub.add_parser('record', help='Derive profiles from finished tasks')
+    rec.add_argument('--limit', type=int, default=200, help='Recent tasks sampled per plugin')
+    sub.add_parser('generate', help='Write apps/fake_<plugin>/ from the profiles')
+    args = parser.parse_args()
+    if args.command == 'record':
+        from .flask_app import app
+
+        with app.app_context():
+            for path in record_profiles(args.limit):
+                print(f'Wrote {path}')
+    else:
+        for path in generate_plugins():
+            print(f'Generated {path}')
@@ -11,33 +11,107 @@ if __package__ is None or __package__ == "":
 
 from flask import Flask
 from flask_executor import Executor
-from werkzeug.security import generate_password_hash
 from flask_login import LoginManager
+from jinja2 import BaseLoader, ChoiceLoader, FileSystemLoader
 
-
-from .models import db, User, Task
+from .models import db, User, upgrade_schema
 from .user_routes import user_bp
 from .admin_routes import admin_bp
+from .worker_routes import worker_bp
+from .api_routes import api_bp, user_from_request
 from .plugin_loader import scan_plugins
-from jinja2 import ChoiceLoader, FileSystemLoader
-
-
-# Flask application instance
-app = Flask(__name__)
-executor = Executor(app)
-# Secret key for session management; override in environment for production
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'replace-this-secret')
-basedir = os.path.abspath(os.path.dirname(__file__))
-# Database configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
-    'DATABASE_URI', 'sqlite:///' + os.path.join(basedir, 'app.db')
+from .metrics import init_metrics
+from .assets import init_assets
+from .user_cache import get_user
+from .startup import phase
+
+executor = Executor()
+login_manager = LoginManager()
+login_manager.login_view = 'user.login'
+
+# Precomputed hashes of the documented default passwords ('admin' and
+# '1234') so creating a fresh database does not spend a second on PBKDF2
+DEFAULT_USERS = (
+    dict(username='admin', real_name='Administrator', is_admin=True, password_hash=(
+        'pbkdf2:sha256:1000000$hIx2qJD4jX8Feqa4$'
+        '901e251d2bd9fc4540205801bbd313a9a4733dc3eaa5fbc52cfcd4cd5fbceb63')),
+    dict(username='abc', real_name='Example User', password_hash=(
+        'pbkdf2:sha256:1000000$4NmfV4KuJywrkhyn$'
+        '6c8cf4ea4a288f7a01925be61b3e070ce428e12734e2974a2f82075630fab2b4')),
 )
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db.init_app(app)
+
+
+def _configure(app):
+    """Load settings from environment variables."""
+    # Secret key for session management; override in environment for production
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'replace-this-secret')
+    basedir = os.path.abspath(os.path.dirname(__file__))
+    # Database configuration
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+        'DATABASE_URI', 'sqlite:///' + os.path.join(basedir, 'app.db')
+    )
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Task outputs live in ``outputs/<task_id>/`` next to the service package
+    project_root = os.path.dirname(basedir)
+    app.config['OUTPUT_DIR'] = os.environ.get('OUTPUT_DIR', os.path.join(project_root, 'outputs'))
+    # Cold storage for finished tasks older than the retention window
+    app.config['ARCHIVE_DIR'] = os.environ.get('ARCHIVE_DIR', os.path.join(project_root, 'archive'))
+    app.config['ARCHIVE_RETENTION_DAYS'] = int(os.environ.get('ARCHIVE_RETENTION_DAYS', 90))
+    app.config['ARCHIVE_INTERVAL_HOURS'] = float(os.environ.get('ARCHIVE_INTERVAL_HOURS', 24))
+    # Runner output is streamed to ``outputs/<id>/run.log`` rotated at this size
+    app.config['LOG_MAX_BYTES'] = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+    app.config['LOG_BACKUPS'] = int(os.environ.get('LOG_BACKUPS', 3))
+    app.config['ARCHIVE_RESTORE_HOURS'] = float(os.environ.get('ARCHIVE_RESTORE_HOURS', 24))
+    # Shared secret for remote workers; the worker API is disabled when unset
+    app.config['WORKER_TOKEN'] = os.environ.get('WORKER_TOKEN')
+    # Seconds without a heartbeat before a worker's tasks are requeued
+    app.config['WORKER_TIMEOUT'] = float(os.environ.get('WORKER_TIMEOUT', 60))
+    # ``all`` serves HTTP and runs tasks; ``web`` and ``worker`` processes
+    # split those roles (see service.serve)
+    app.config['PROCESS_ROLE'] = os.environ.get('PROCESS_ROLE', 'all')
+    # Seconds between checks for queued and assigned tasks in worker processes
+    app.config['DISPATCH_INTERVAL'] = float(os.environ.get('DISPATCH_INTERVAL', 1))
+    # Tasks run at once per user; ``LOCAL_SLOTS`` is set once the executor exists
+    app.config['USER_MAX_RUNNING'] = int(os.environ.get('USER_MAX_RUNNING', 0))
+    app.config['SCHEDULER_INTERVAL'] = float(os.environ.get('SCHEDULER_INTERVAL', 10))
+    # Seconds a cancelled runner gets to exit before its process tree is killed
+    app.config['CANCEL_GRACE_SECONDS'] = float(os.environ.get('CANCEL_GRACE_SECONDS', 10))
+    # Largest number of tasks or ids accepted by one JSON API request
+    app.config['API_MAX_BATCH'] = int(os.environ.get('API_MAX_BATCH', 1000))
+    # Admission control defaults, overridden by a plugin's ``admission`` block
+    # (0 disables a limit); see service.admission
+    app.config['ADMISSION_MAX_QUEUED'] = int(os.environ.get('ADMISSION_MAX_QUEUED', 0))
+    app.config['ADMISSION_MAX_USER_PENDING'] = int(os.environ.get('ADMISSION_MAX_USER_PENDING', 0))
+    app.config['ADMISSION_MIN_FREE_MB'] = int(os.environ.get('ADMISSION_MIN_FREE_MB', 1024))
+    app.config['ADMISSION_RETRY_AFTER'] = int(os.environ.get('ADMISSION_RETRY_AFTER', 60))
+    # Seconds between checks for finished result files of running tasks
+    app.config['PUBLISH_INTERVAL'] = float(os.environ.get('PUBLISH_INTERVAL', 5))
+    # Rendered job tables and rows kept in memory, and the lifetime of
+    # tables showing queue positions or ETAs; see service.jobs_cache
+    app.config['JOBS_CACHE_USERS'] = int(os.environ.get('JOBS_CACHE_USERS', 1000))
+    app.config['JOBS_CACHE_ROWS'] = int(os.environ.get('JOBS_CACHE_ROWS', 50000))
+    app.config['JOBS_CACHE_TTL'] = float(os.environ.get('JOBS_CACHE_TTL', 15))
+    # Seconds between reads of tasks finished by other processes; see service.runtime_model
+    app.config['RUNTIME_MODEL_REFRESH'] = float(os.environ.get('RUNTIME_MODEL_REFRESH', 30))
+    # Seconds a session's user is reused without reading the database
+    app.config['USER_CACHE_SECONDS'] = float(os.environ.get('USER_CACHE_SECONDS', 30))
+    # Text outputs shown by view_file up to this size are compressed on the fly
+    app.config['OUTPUT_COMPRESS_MAX_MB'] = float(os.environ.get('OUTPUT_COMPRESS_MAX_MB', 16))
+    # Instrumentation on the request path must stay within this budget
+    app.config['METRICS_OVERHEAD_BUDGET_MS'] = float(os.environ.get('METRICS_OVERHEAD_BUDGET_MS', 0.5))
+    # Bearer token required by /metrics; the endpoint is disabled when unset
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+
+class PluginTemplateLoader(BaseLoader):
+    """Looks templates up in the plugin directories, found on first use."""
+
+    def get_source(self, environment, template):
+        paths = [info['path'] for info in scan_plugins().values()]
+        return FileSystemLoader(paths).get_source(environment, template)
 
 
 # Custom Jinja filter to map task status to Bootstrap text color classes
-@app.template_filter('status_color')
 def status_color(status):
     """Return Bootstrap color class for a task status."""
     mapping = {
@@ -45,63 +119,101 @@ def status_color(status):
         'FAILURE': 'danger',
         'RUNNING': 'primary',
         'PENDING': 'secondary',
+        'WAITING': 'info',
+        'CANCELLED': 'warning',
     }
     return mapping.get(status, 'secondary')
 
-# Setup Flask-Login
-login_manager = LoginManager()
-login_manager.login_view = 'user.login'
-login_manager.init_app(app)
-
 
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
-
-
-with app.app_context():
-    db.create_all()
-
-    # Discover plugins and store on app config
-    plugins = scan_plugins()
-    app.config['PLUGINS'] = plugins
-
-    # Extend Jinja loader to include plugin templates
-    plugin_paths = [info['path'] for info in plugins.values()]
-    if plugin_paths:
-        app.jinja_loader = ChoiceLoader([
-            app.jinja_loader,
-            FileSystemLoader(plugin_paths),
-        ])
-
-    # Ensure default admin and example user exist
-    if not User.query.filter_by(username='admin').first():
-        admin_user = User(
-            username='admin',
-            password_hash=generate_password_hash('admin', method='pbkdf2:sha256'),
-            real_name='Administrator',
-            is_admin=True,
-        )
-        db.session.add(admin_user)
-    if not User.query.filter_by(username='abc').first():
-        abc_user = User(
-            username='abc',
-            password_hash=generate_password_hash('1234', method='pbkdf2:sha256'),
-            real_name='Example User',
-        )
-        db.session.add(abc_user)
+    # Cached for USER_CACHE_SECONDS; see service.user_cache
+    return get_user(int(user_id))
+
+
+@login_manager.request_loader
+def load_user_from_request(request):
+    # ``Authorization: Bearer <token>`` for scripted clients; see api_routes
+    return user_from_request(request)
+
+
+def _ensure_default_users():
+    """Create the default admin and example user if they do not exist."""
+    names = [u['username'] for u in DEFAULT_USERS]
+    existing = {name for (name,) in db.session.query(User.username).filter(User.username.in_(names))}
+    for fields in DEFAULT_USERS:
+        if fields['username'] not in existing:
+            db.session.add(User(**fields))
     db.session.commit()
 
-app.register_blueprint(user_bp)
-app.register_blueprint(admin_bp)
+
+def create_app(config=None):
+    """Create the Flask application.
+
+    Settings come from environment variables, then ``config``.  Each step
+    is timed by :func:`service.startup.phase`; run ``python -m
+    service.startup`` for a breakdown.  Plugins are discovered when first
+    needed, not here.
+    """
+    with phase('configure'):
+        app = Flask(__name__)
+        _configure(app)
+        app.config.update(config or {})
+    with phase('extensions'):
+        db.init_app(app)
+        executor.init_app(app)
+        app.config.setdefault('LOCAL_SLOTS', int(os.environ.get('LOCAL_SLOTS', executor._self._max_workers)))
+        login_manager.init_app(app)
+        init_metrics(app, db, executor)
+        init_assets(app)
+        app.add_template_filter(status_color, 'status_color')
+        app.jinja_loader = ChoiceLoader([app.jinja_loader, PluginTemplateLoader()])
+    with phase('blueprints'):
+        app.register_blueprint(user_bp)
+        app.register_blueprint(admin_bp)
+        app.register_blueprint(worker_bp)
+        app.register_blueprint(api_bp)
+    with phase('database'), app.app_context():
+        db.create_all()
+        upgrade_schema()
+        _ensure_default_users()
+    return app
+
+
+_app = None
+
+
+def get_app():
+    """Return the application shared by scripts, creating it on first use."""
+    global _app
+    if _app is None:
+        _app = create_app()
+    return _app
+
+
+def __getattr__(name):
+    # ``from service.flask_app import app`` keeps working, but importing
+    # this module no longer builds the application
+    if name == 'app':
+        return get_app()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 if __name__ == '__main__':
+    app = create_app()
     # Use built-in server in debug mode; otherwise start Waitress for production
     if os.environ.get('FLASK_DEBUG'):  # development convenience
         app.run(debug=True)
     else:
         from waitress import serve
 
+        from .archive import start_archiver
+        from .tasks import start_runner_hosts, start_scheduler
+        from .worker_registry import start_worker_monitor
+
+        start_archiver(app)
+        start_worker_monitor(app)
+        start_scheduler(app)
+        start_runner_hosts(app)
         port = int(os.environ.get('PORT', 5000))
         serve(app, host='0.0.0.0', port=port)
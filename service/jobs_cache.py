@@ -0,0 +1,115 @@
+"""Cached rendering of the dashboard's job table.
+
+The dashboard polls ``/dashboard/jobs`` every few seconds while tasks
+are active.  Each user has a ``task_version`` that is incremented in the
+same transaction as any change to one of their tasks (submission, start,
+progress, finish, cancellation, deletion or archiving; see
+:func:`service.models.bump_task_version`), so a poll only reads that
+number while nothing has changed and serves the table from memory.
+
+Rows are rendered separately and reused while the task's displayed
+fields are unchanged, so a progress update re-renders one row.  Tables
+showing a queue position or an ETA, which also depend on other users'
+tasks and the clock, expire after ``JOBS_CACHE_TTL`` seconds.  Both
+caches are LRU bounded by ``JOBS_CACHE_USERS`` tables and
+``JOBS_CACHE_ROWS`` rows; every web process keeps its own.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app, render_template
+from markupsafe import Markup
+
+from .models import db, User
+
+ACTIVE_STATUSES = ('PENDING', 'RUNNING', 'WAITING')
+
+JobsTable = namedtuple('JobsTable', 'version html etag active expires')
+
+
+class LRUCache:
+    """Thread-safe mapping that drops the least recently used entries."""
+
+    def __init__(self):
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value, limit):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > max(limit, 0):
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_tables = LRUCache()
+_rows = LRUCache()
+
+
+def task_version(user_id):
+    return db.session.query(User.task_version).filter(User.id == user_id).scalar()
+
+
+def _row_key(item):
+    task = item['task']
+    return (
+        task.id, task.status, task.progress, task.progress_message,
+        tuple(task.result_files or ()), item['html_file'], item['queue'], item['eta'],
+    )
+
+
+def _render_rows(items):
+    template = current_app.jinja_env.get_template('_job_row.html')
+    limit = current_app.config['JOBS_CACHE_ROWS']
+    rows = []
+    for item in items:
+        key = _row_key(item)
+        html = _rows.get(key)
+        if html is None:
+            html = Markup(template.render(item=item))
+            _rows.put(key, html, limit)
+        rows.append(html)
+    return rows
+
+
+def jobs_table(user_id, load_rows):
+    """Return the :class:`JobsTable` of ``user_id``.
+
+    ``load_rows(user_id)`` returns the table's rows and is only called
+    when the cached table is out of date.
+    """
+    version = task_version(user_id)
+    now = time.monotonic()
+    cached = _tables.get(user_id)
+    if cached is not None and cached.version == version and (cached.expires is None or cached.expires > now):
+        return cached
+    # The version is read before the rows, so a change in between only
+    # causes an extra render on the next poll
+    items = load_rows(user_id)
+    html = render_template('_jobs_table.html', rows=_render_rows(items))
+    dynamic = any(item['queue'] or item['eta'] for item in items)
+    table = JobsTable(
+        version=version,
+        html=html,
+        etag=hashlib.blake2b(html.encode(), digest_size=12).hexdigest(),
+        active=any(item['task'].status in ACTIVE_STATUSES for item in items),
+        expires=now + current_app.config['JOBS_CACHE_TTL'] if dynamic else None,
+    )
+    _tables.put(user_id, table, current_app.config['JOBS_CACHE_USERS'])
+    return table
@@ -0,0 +1,354 @@
+"""Lightweight Prometheus-style metrics for the task platform.
+
+Metrics are kept in process memory and exposed in the Prometheus text
+format at ``/metrics``.  Instrumentation lives in :func:`init_metrics`
+(request latency, DB query counts and connection pool checkouts),
+:mod:`service.tasks` (task durations and executor usage) and :mod:`service.plugin_loader` (plugin
+scan time).  The time spent in the request hooks and in the database
+listeners during a request is recorded in ``sim_metrics_overhead_seconds``
+and compared with ``METRICS_OVERHEAD_BUDGET_MS``; ``service.stress_jobs``
+fails when its 95th percentile exceeds the budget.
+
+``/metrics`` is disabled while ``METRICS_TOKEN`` is unset; scrapers send
+the token as ``Authorization: Bearer <token>``.
+"""
+import bisect
+import hmac
+import math
+import threading
+import time
+
+from flask import Blueprint, Response, abort, current_app, g, request
+
+_lock = threading.Lock()
+_registry = []
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, 43200)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+OVERHEAD_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005)
+HOLD_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300, 3600)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for n, v in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._values = {}
+        _registry.append(self)
+
+    def clear(self):
+        with _lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.kind}']
+        with _lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labels, key)} {value}')
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing value."""
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with _lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that can go up and down."""
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with _lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with _lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    """Distribution of observations in cumulative buckets."""
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        idx = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][idx] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.kind}']
+        names = self.labels + ('le',)
+        with _lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append(
+                    f'{self.name}_bucket{_format_labels(names, key + (bound,))} {cumulative}'
+                )
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {count}')
+        return lines
+
+
+REQUEST_LATENCY = Histogram(
+    'sim_http_request_duration_seconds', 'HTTP request latency per route.',
+    ('endpoint', 'method'),
+)
+REQUESTS = Counter(
+    'sim_http_requests_total', 'HTTP requests per route and status code.',
+    ('endpoint', 'status'),
+)
+DB_QUERIES = Histogram(
+    'sim_db_queries_per_request', 'Database statements executed per request.',
+    ('endpoint',), buckets=COUNT_BUCKETS,
+)
+OVERHEAD = Histogram(
+    'sim_metrics_overhead_seconds', 'Time spent in request instrumentation, including database listeners.',
+    ('endpoint',), buckets=OVERHEAD_BUCKETS,
+)
+OVERHEAD_EXCEEDED = Counter(
+    'sim_metrics_overhead_budget_exceeded_total',
+    'Requests whose instrumentation exceeded METRICS_OVERHEAD_BUDGET_MS.',
+    ('endpoint',),
+)
+TASK_STATUS = Gauge(
+    'sim_tasks', 'Tasks per plugin and status (PENDING = queue depth).',
+    ('task_type', 'status'),
+)
+TASK_DURATION = Histogram(
+    'sim_task_duration_seconds', 'Wall-clock runtime of finished tasks.',
+    ('task_type', 'status'), buckets=DURATION_BUCKETS,
+)
+ADMISSION_REJECTED = Counter(
+    'sim_admission_rejected_total', 'Submissions refused by admission control per plugin and limit.',
+    ('task_type', 'reason'),
+)
+TASKS_SCHEDULED = Counter(
+    'sim_tasks_scheduled_total', 'Tasks handed to the executor.',
+)
+EXECUTOR_BUSY = Gauge(
+    'sim_executor_busy_threads', 'Executor threads currently running a task.',
+)
+EXECUTOR_MAX = Gauge(
+    'sim_executor_max_threads', 'Size of the task executor thread pool.',
+)
+DB_STATEMENT = Histogram(
+    'sim_db_statement_seconds',
+    'Database statement execution time, including time waiting for locks.',
+)
+DB_LOCK_ERRORS = Counter(
+    'sim_db_lock_errors_total', 'Statements that failed because the database was locked.',
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    'sim_db_pool_checked_out', 'Database connections currently checked out of the pool.',
+)
+DB_POOL_PEAK = Gauge(
+    'sim_db_pool_checked_out_peak', 'Most connections checked out at once since startup.',
+)
+DB_POOL_SIZE = Gauge(
+    'sim_db_pool_size', 'Connections the pool keeps open, not counting overflow.',
+)
+DB_POOL_CHECKOUTS = Counter(
+    'sim_db_pool_checkouts_total', 'Connections taken from the pool.',
+)
+DB_CONNECTION_HOLD = Histogram(
+    'sim_db_connection_hold_seconds', 'Time from checking a connection out of the pool to returning it.',
+    buckets=HOLD_BUCKETS,
+)
+PLUGIN_SCAN = Histogram(
+    'sim_plugin_scan_seconds', 'Time spent scanning the apps directory.',
+)
+STARTUP_PHASE = Gauge(
+    'sim_startup_phase_seconds', 'Time spent in each phase of application startup.',
+    ('phase',),
+)
+
+
+def percentile(values, pct, ndigits=None):
+    """Return the nearest-rank ``pct`` percentile of ``values`` or ``None``.
+
+    The result is rounded to ``ndigits`` when given.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    value = ordered[rank - 1]
+    return value if ndigits is None else round(value, ndigits)
+
+
+def render():
+    """Return all metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _charge(start):
+    """Add the time since ``start`` to the instrumentation cost of the current request."""
+    if g and g.get('_metrics_overhead') is not None:
+        g._metrics_overhead += time.perf_counter() - start
+
+
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    start = time.perf_counter()
+    conn.info.setdefault('_metrics_start', []).append(start)
+    counter = g.get('_metrics_queries') if g else None
+    if counter is not None:
+        g._metrics_queries = counter + 1
+    _charge(start)
+
+
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    end = time.perf_counter()
+    starts = conn.info.get('_metrics_start')
+    if starts:
+        DB_STATEMENT.observe(end - starts.pop())
+    _charge(end)
+
+
+def _query_error(context):
+    conn = context.connection
+    starts = conn.info.get('_metrics_start') if conn is not None else None
+    if starts:
+        DB_STATEMENT.observe(time.perf_counter() - starts.pop())
+    if 'locked' in str(context.original_exception):
+        DB_LOCK_ERRORS.inc()
+
+
+_pool_state = {'out': 0, 'peak': 0}
+
+
+def _on_checkout(dbapi_connection, record, proxy):
+    start = time.perf_counter()
+    record.info['_metrics_checkout'] = start
+    with _lock:
+        _pool_state['out'] += 1
+        _pool_state['peak'] = max(_pool_state['peak'], _pool_state['out'])
+        out, peak = _pool_state['out'], _pool_state['peak']
+    DB_POOL_CHECKED_OUT.set(out)
+    DB_POOL_PEAK.set(peak)
+    DB_POOL_CHECKOUTS.inc()
+    _charge(start)
+
+
+def _on_checkin(dbapi_connection, record):
+    end = time.perf_counter()
+    start = record.info.pop('_metrics_checkout', None)
+    if start is None:
+        return
+    DB_CONNECTION_HOLD.observe(end - start)
+    with _lock:
+        _pool_state['out'] -= 1
+        out = _pool_state['out']
+    DB_POOL_CHECKED_OUT.set(out)
+    _charge(end)
+
+
+def _before_request():
+    start = time.perf_counter()
+    g._metrics_start = start
+    g._metrics_queries = 0
+    g._metrics_overhead = time.perf_counter() - start
+
+
+def _after_request(response):
+    hook_start = time.perf_counter()
+    start = g.get('_metrics_start')
+    if start is None:
+        return response
+    endpoint = request.endpoint or 'unknown'
+    REQUEST_LATENCY.observe(hook_start - start, endpoint, request.method)
+    REQUESTS.inc(endpoint, response.status_code)
+    DB_QUERIES.observe(g._metrics_queries, endpoint)
+    overhead = g._metrics_overhead + time.perf_counter() - hook_start
+    OVERHEAD.observe(overhead, endpoint)
+    if overhead * 1000 > current_app.config['METRICS_OVERHEAD_BUDGET_MS']:
+        OVERHEAD_EXCEEDED.inc(endpoint)
+    return response
+
+
+def init_metrics(app, db, executor):
+    """Install request instrumentation on ``app`` and its database engine."""
+    from sqlalchemy import event
+
+    app.config.setdefault('METRICS_OVERHEAD_BUDGET_MS', 0.5)
+    app.config.setdefault('METRICS_TOKEN', None)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', _before_query)
+        event.listen(db.engine, 'after_cursor_execute', _after_query)
+        event.listen(db.engine, 'handle_error', _query_error)
+        event.listen(db.engine, 'checkout', _on_checkout)
+        event.listen(db.engine, 'checkin', _on_checkin)
+        pool_size = getattr(db.engine.pool, 'size', None)
+        if callable(pool_size):
+            DB_POOL_SIZE.set(pool_size())
+    EXECUTOR_MAX.set(getattr(executor._self, '_max_workers', 0))
+    app.register_blueprint(metrics_bp)
+
+
+metrics_bp = Blueprint('metrics', __name__)
+
+
+@metrics_bp.before_request
+def _authenticate():
+    expected = current_app.config.get('METRICS_TOKEN')
+    if not expected:
+        abort(404)
+    header = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(header.encode(), f'Bearer {expected}'.encode()):
+        abort(401)
+
+
+@metrics_bp.route('/metrics', endpoint='metrics')
+def metrics():
+    """Expose metrics for scraping by Prometheus."""
+    from .models import db, Task
+
+    # Answered from ix_task_status_type without reading finished tasks
+    rows = db.session.query(Task.task_type, Task.status, db.func.count(Task.id)).filter(
+        Task.status.in_(('PENDING', 'RUNNING'))
+    ).group_by(Task.task_type, Task.status).all()
+    TASK_STATUS.clear()
+    for task_type in {r[0] for r in rows}:
+        for status in ('PENDING', 'RUNNING'):
+            TASK_STATUS.set(0, task_type, status)
+    for task_type, status, count in rows:
+        TASK_STATUS.set(count, task_type, status)
+    return Response(render(), mimetype='text/plain; version=0.0.4')
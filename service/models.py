@@ -1,7 +1,10 @@
 """Define database models for users and tasks."""
+from itertools import chain
+
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime
+from sqlalchemy import event
 
 # Initialize the database instance
 db = SQLAlchemy()
@@ -17,22 +20,145 @@ class User(db.Model, UserMixin):
     email = db.Column(db.String(120))
     phone = db.Column(db.String(20))
     is_admin = db.Column(db.Boolean, default=False, nullable=False)
+    # Fair-share weight and cap on concurrently running tasks (``None`` uses
+    # ``USER_MAX_RUNNING``); see :mod:`service.scheduler`
+    share = db.Column(db.Float, default=1.0, nullable=False)
+    max_running = db.Column(db.Integer)
+    # Bumped whenever one of the user's tasks changes; see service.jobs_cache
+    task_version = db.Column(db.Integer, default=0, nullable=False)
     tasks = db.relationship('Task', backref='user', lazy=True)
 
 
-class Task(db.Model):
-    """Task record model."""
+class TaskFields:
+    """Columns shared by live tasks and their archived copies."""
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     task_type = db.Column(db.String(50), nullable=False)
-    parameters = db.Column(db.Text, nullable=False)
+    # Stored as native JSON so rows decode once on load and parameter
+    # values can be filtered in SQL, e.g. ``Task.parameters['er'].as_string()``
+    parameters = db.Column(db.JSON, nullable=False, default=dict)
     status = db.Column(db.String(20), default='PENDING', nullable=False)
-    result_files = db.Column(db.Text)
+    result_files = db.Column(db.JSON(none_as_null=True))
+    # HTML report split off from ``result_files`` when the task completes
+    html_file = db.Column(db.String(255))
     # Record creation time using the server's local timezone
     create_time = db.Column(db.DateTime, default=datetime.now, nullable=False)
     start_time = db.Column(db.DateTime)
     end_time = db.Column(db.DateTime)
     archived = db.Column(db.Boolean, default=False, nullable=False)
+    # Latest ``PROGRESS <percent> <message>`` line printed by the runner
+    progress = db.Column(db.Integer)
+    progress_message = db.Column(db.String(255))
+    # Resources used by the runner: CPU seconds, peak RSS and output size
+    cpu_time = db.Column(db.Float)
+    peak_rss_kb = db.Column(db.Integer)
+    output_bytes = db.Column(db.BigInteger)
+    # Name of the remote worker the task is dispatched to; ``None`` runs locally
+    worker = db.Column(db.String(80))
+    # Total size of the uploaded input files, used by service.runtime_model
+    input_bytes = db.Column(db.BigInteger)
+    # Tasks that must succeed first and the inputs taken from their outputs,
+    # ``{param: {"task": id, "file": name}}``; see service.pipeline
+    parents = db.Column(db.JSON)
+    input_refs = db.Column(db.JSON)
+    # Set by administrators; higher priorities are dispatched first
+    priority = db.Column(db.Integer, default=0, nullable=False)
+
+    def set_result_files(self, files):
+        """Store the output file list and precompute the HTML report link."""
+        files = list(files or [])
+        self.result_files = files
+        self.html_file = next((f for f in files if f.lower().endswith('.html')), None)
+
+    def requeue(self):
+        """Put the task back in the queue to be run from scratch."""
+        self.status = 'PENDING'
+        self.worker = None
+        self.start_time = None
+        self.progress = None
+        self.progress_message = None
+        # Files published while the interrupted run was going
+        self.set_result_files([])
+
+    @property
+    def download_files(self):
+        """Result files offered as downloads, i.e. all but the HTML report."""
+        return [f for f in (self.result_files or []) if f != self.html_file]
+
+
+class Task(TaskFields, db.Model):
+    """Task record model."""
+
+    __table_args__ = (
+        db.Index('ix_task_user_archived_created', 'user_id', 'archived', 'create_time'),
+        # Queue depths per plugin (/metrics, dispatch) without scanning finished tasks
+        db.Index('ix_task_status_type', 'status', 'task_type'),
+        # Ids of rows moved to ``task_archive`` must not be handed out again,
+        # as they name ``outputs/<id>/`` and the archived copy
+        {'sqlite_autoincrement': True},
+    )
+
+
+def bump_task_version(session, user_ids=None, task_ids=None):
+    """Increment ``task_version`` of ``user_ids`` or of the owners of ``task_ids``.
+
+    Changes made through the ORM are counted automatically when they are
+    flushed; call this after bulk ``Query.update()`` statements.
+    """
+    users = User.__table__
+    if task_ids is not None:
+        tasks = Task.__table__
+        condition = users.c.id.in_(db.select(tasks.c.user_id).where(tasks.c.id.in_(list(task_ids))))
+    else:
+        condition = users.c.id.in_(list(user_ids))
+    session.connection().execute(
+        users.update().where(condition).values(task_version=users.c.task_version + 1)
+    )
+
+
+@event.listens_for(db.session, 'before_flush')
+def _count_task_changes(session, flush_context, instances):
+    user_ids = {
+        obj.user_id for obj in chain(session.new, session.dirty, session.deleted)
+        if isinstance(obj, Task) and obj.user_id is not None
+        and (obj not in session.dirty or session.is_modified(obj))
+    }
+    if user_ids:
+        bump_task_version(session, user_ids)
+
+
+class TaskArchive(TaskFields, db.Model):
+    """Finished task moved out of the hot ``task`` table into cold storage."""
+    # Monthly zip under ``ARCHIVE_DIR`` holding the task's output files
+    archive_file = db.Column(db.String(255))
+    archived_time = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    # Set while the outputs are unpacked in ``outputs/<id>/`` for download
+    restored_time = db.Column(db.DateTime)
+    user = db.relationship('User', backref=db.backref('archived_tasks', lazy=True))
+
+
+class Worker(db.Model):
+    """Remote worker process that runs plugin jobs on another machine."""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), unique=True, nullable=False)
+    host = db.Column(db.String(120))
+    # Plugin names the worker can run and how many jobs it runs at once
+    plugins = db.Column(db.JSON, nullable=False, default=list)
+    capacity = db.Column(db.Integer, default=1, nullable=False)
+    last_heartbeat = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    # Worker process sharing the database and outputs directory (service.serve)
+    local = db.Column(db.Boolean, default=False, nullable=False)
+
+
+class ApiToken(db.Model):
+    """Bearer token for the JSON API; only a SHA-256 digest is stored."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    name = db.Column(db.String(80), nullable=False)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    create_time = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    last_used = db.Column(db.DateTime)
+    user = db.relationship('User', backref=db.backref('api_tokens', lazy=True))
 
 
 class AppLayout(db.Model):
@@ -40,3 +166,70 @@ class AppLayout(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
     layout = db.Column(db.Text, nullable=False)
     user = db.relationship('User', backref=db.backref('app_layout', uselist=False))
+
+
+def upgrade_schema():
+    """Bring tables created by older versions up to date with the models.
+
+    ``db.create_all`` only creates missing tables, so columns and indexes
+    added later are created here.  Returns the ``table.column`` names that
+    were added.
+    """
+    engine = db.engine
+    inspector = db.inspect(engine)
+    added = []
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} ' \
+                      f'{column.type.compile(dialect=engine.dialect)}'
+                default = column.default
+                if default is not None and default.is_scalar:
+                    literal = db.literal(default.arg, column.type).compile(
+                        dialect=engine.dialect, compile_kwargs={'literal_binds': True}
+                    )
+                    ddl += f' DEFAULT {literal}'
+                conn.execute(db.text(ddl))
+                added.append(f'{table.name}.{column.name}')
+            if table.name == 'task' and engine.dialect.name == 'sqlite':
+                _rebuild_with_autoincrement(conn, table)
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+    if 'task.html_file' in added:
+        # Precompute the report link for tasks finished before the column existed
+        for task in Task.query.filter(Task.result_files.isnot(None)):
+            task.set_result_files(task.result_files)
+        db.session.commit()
+    return added
+
+
+def _rebuild_with_autoincrement(conn, table):
+    """Recreate an SQLite ``table`` created without ``AUTOINCREMENT``.
+
+    SQLite cannot alter a primary key, so the rows are copied into a new
+    table.  The sequence starts after the largest id in ``task`` and
+    ``task_archive``, so archived ids are never reused.
+    """
+    sql = conn.execute(db.text(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"
+    ), {'name': table.name}).scalar()
+    if 'AUTOINCREMENT' in (sql or '').upper():
+        return
+    columns = ', '.join(c.name for c in table.columns)
+    ddl = str(db.schema.CreateTable(table).compile(dialect=conn.dialect))
+    conn.execute(db.text(ddl.replace(f'CREATE TABLE {table.name} ', f'CREATE TABLE {table.name}_new ', 1)))
+    conn.execute(db.text(f'INSERT INTO {table.name}_new ({columns}) SELECT {columns} FROM {table.name}'))
+    conn.execute(db.text(f'DROP TABLE {table.name}'))
+    conn.execute(db.text(f'ALTER TABLE {table.name}_new RENAME TO {table.name}'))
+    last = conn.execute(db.text(
+        f'SELECT MAX(id) FROM (SELECT id FROM {table.name} UNION ALL SELECT id FROM task_archive)'
+    )).scalar() or 0
+    conn.execute(db.text('DELETE FROM sqlite_sequence WHERE name = :name'), {'name': table.name})
+    conn.execute(db.text('INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)'),
+                 {'name': table.name, 'seq': last})
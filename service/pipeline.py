@@ -0,0 +1,170 @@
+"""Chain tasks by using output files of one task as inputs of another.
+
+A file parameter may reference ``<task_id>:<filename>`` instead of an
+upload.  When the parent has already succeeded the file is linked
+straight away; otherwise the new task waits with status ``WAITING`` and
+is queued by :func:`release_dependents` once all of its parents have
+succeeded.  Inputs are hard links to ``outputs/<parent_id>/<filename>``,
+so multi-GB archives are neither copied nor transferred.
+"""
+import os
+import shutil
+from datetime import datetime
+
+from flask import current_app
+
+from .config_utils import task_output_dir
+from .models import db, Task
+
+ACTIVE_STATUSES = ('PENDING', 'RUNNING', 'WAITING')
+
+
+class InputError(ValueError):
+    """A task input reference cannot be used."""
+
+
+def parse_ref(value):
+    """Split ``"<task_id>:<filename>"`` into ``(task_id, filename)``."""
+    task_id, sep, filename = str(value).partition(':')
+    if not sep or not task_id.strip().isdigit() or not filename:
+        raise InputError(f'Invalid task output reference {value!r}')
+    filename = filename.replace('\\', '/')
+    if filename.startswith('/') or '..' in filename.split('/'):
+        raise InputError(f'Invalid file name {filename!r}')
+    return int(task_id), filename
+
+
+def expected_outputs(task, configs):
+    """Files ``task`` publishes, or is expected to publish if unfinished."""
+    if task.status == 'SUCCESS':
+        return list(task.result_files or [])
+    keep = configs.get(task.task_type, {}).get('result_keep') or []
+    return [p for p in keep if not any(c in p for c in '*?[')]
+
+
+def output_sources(user_id, configs):
+    """Return ``[(ref, label)]`` of task outputs ``user_id`` can chain from."""
+    tasks = Task.query.filter(
+        Task.user_id == user_id,
+        Task.archived.is_(False),
+        Task.status.in_(('SUCCESS',) + ACTIVE_STATUSES),
+    ).order_by(Task.create_time.desc()).limit(50).all()
+    sources = []
+    for task in tasks:
+        for name in expected_outputs(task, configs):
+            sources.append((f'{task.id}:{name}', f'#{task.id} {task.task_type}: {name} ({task.status})'))
+    return sources
+
+
+def resolve_refs(refs, user):
+    """Validate ``{param: "<task_id>:<filename>"}`` for a task of ``user``.
+
+    Returns ``({param: {"task": id, "file": name}}, parent_ids)``.
+    """
+    inputs = {}
+    parents = set()
+    for param, value in refs.items():
+        parent_id, filename = parse_ref(value)
+        parent = db.session.get(Task, parent_id)
+        if parent is None or parent.archived or (parent.user_id != user.id and not user.is_admin):
+            raise InputError(f'Task {parent_id} not found')
+        if parent.status not in ('SUCCESS',) + ACTIVE_STATUSES:
+            raise InputError(f'Task {parent_id} ended as {parent.status}')
+        if parent.status == 'SUCCESS' and not os.path.exists(
+                os.path.join(task_output_dir(parent_id), filename)):
+            raise InputError(f'Task {parent_id} has no output {filename}')
+        inputs[param] = {'task': parent_id, 'file': filename}
+        parents.add(parent_id)
+    return inputs, sorted(parents)
+
+
+def link_file(src, dst):
+    """Hard-link ``src`` (a file or directory tree) to ``dst``."""
+    if os.path.isdir(src):
+        for root, _, files in os.walk(src):
+            rel = os.path.relpath(root, src)
+            os.makedirs(os.path.join(dst, rel), exist_ok=True)
+            for name in files:
+                link_file(os.path.join(root, name), os.path.join(dst, rel, name))
+        return
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError as exc:
+        # Hard links need both directories on one file system
+        current_app.logger.warning('Copying %s instead of linking: %s', src, exc)
+        shutil.copy2(src, dst)
+
+
+def link_inputs(task):
+    """Link the referenced parent outputs into the task's output directory.
+
+    Parameters of linked inputs are set to the local file name.
+    """
+    output_dir = task_output_dir(task.id)
+    os.makedirs(output_dir, exist_ok=True)
+    params = dict(task.parameters or {})
+    total = task.input_bytes or 0
+    for param, ref in (task.input_refs or {}).items():
+        src = os.path.join(task_output_dir(ref['task']), *ref['file'].split('/'))
+        if not os.path.exists(src):
+            raise InputError(f"Task {ref['task']} did not produce {ref['file']}")
+        name = os.path.basename(ref['file'])
+        link_file(src, os.path.join(output_dir, name))
+        params[param] = name
+        if os.path.isfile(src):
+            total += os.path.getsize(src)
+    task.parameters = params
+    task.input_bytes = total
+
+
+def settle(task):
+    """Queue a new task with parents, or leave it ``WAITING`` for them.
+
+    The task is committed as ``WAITING`` first and every parent that has
+    already finished is then released, so a parent finishing while the
+    task was being created cannot leave it waiting forever.  Returns
+    whether the task became ``PENDING``.
+    """
+    task.status = 'WAITING'
+    db.session.commit()
+    for parent in Task.query.filter(Task.id.in_(task.parents or [])).all():
+        if parent.status not in ACTIVE_STATUSES:
+            release_dependents(parent)
+    db.session.refresh(task)
+    return task.status == 'PENDING'
+
+
+def release_dependents(parent):
+    """Queue or cancel the tasks waiting for ``parent`` after it finished.
+
+    Returns the ids of tasks that became ``PENDING``.
+    """
+    released = []
+    waiting = [t for t in Task.query.filter_by(status='WAITING').all() if parent.id in (t.parents or [])]
+    for task in waiting:
+        if parent.status != 'SUCCESS':
+            _cancel_waiting(task, f'Parent task {parent.id} ended as {parent.status}')
+            continue
+        statuses = {t.status for t in Task.query.filter(Task.id.in_(task.parents)).all()}
+        if statuses != {'SUCCESS'}:
+            continue
+        try:
+            link_inputs(task)
+        except (InputError, OSError) as exc:
+            _cancel_waiting(task, str(exc))
+            continue
+        task.status = 'PENDING'
+        released.append(task.id)
+    db.session.commit()
+    return released
+
+
+def _cancel_waiting(task, reason):
+    task.status = 'CANCELLED'
+    task.progress_message = reason[:255]
+    task.end_time = datetime.now()
+    db.session.flush()
+    # Cancel the task's own dependents as well
+    release_dependents(task)
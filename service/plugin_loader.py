@@ -1,10 +1,14 @@
 import os
+import copy
 import json
-import yaml
+import threading
+import time
+
+from .metrics import PLUGIN_SCAN
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 APP_DIR = os.path.join(BASE_DIR, 'apps')
-REGISTRY_FILE = os.path.join(BASE_DIR, 'app_registry.json')
+REGISTRY_FILE = os.environ.get('APP_REGISTRY_FILE', os.path.join(BASE_DIR, 'app_registry.json'))
 
 
 def load_registry():
@@ -19,8 +23,59 @@ def save_registry(reg):
         json.dump(reg, f, indent=2)
 
 
+# Result of the last scan and the file modification times it was based on
+_cache = {'key': None, 'plugins': None}
+_cache_lock = threading.Lock()
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _cache_key():
+    """Modification times of everything a scan reads.
+
+    Stat calls are far cheaper than parsing every ``config.yaml``, so
+    unchanged plugins are not scanned again.
+    """
+    try:
+        names = sorted(os.listdir(APP_DIR))
+    except OSError:
+        names = []
+    key = [_mtime(APP_DIR), _mtime(REGISTRY_FILE)]
+    for name in names:
+        pdir = os.path.join(APP_DIR, name)
+        key.append((name, _mtime(os.path.join(pdir, 'metadata.json')),
+                    _mtime(os.path.join(pdir, 'runner.py')),
+                    _mtime(os.path.join(pdir, 'config.yaml'))))
+    return tuple(key)
+
+
 def scan_plugins():
-    """Scan the apps directory and return plugin info."""
+    """Return plugin info from the apps directory.
+
+    The directory is scanned on first use and again only after a plugin
+    or the registry changed on disk.  Callers get their own copy.
+    """
+    key = _cache_key()
+    with _cache_lock:
+        if _cache['key'] != key:
+            start = time.perf_counter()
+            try:
+                _cache['plugins'] = _scan_plugins()
+            finally:
+                PLUGIN_SCAN.observe(time.perf_counter() - start)
+            # Registering new plugins rewrites the registry file
+            _cache['key'] = _cache_key()
+        return copy.deepcopy(_cache['plugins'])
+
+
+def _scan_plugins():
+    import yaml
+
     registry = load_registry()
     plugins = {}
     changed = False
@@ -41,9 +96,10 @@ def scan_plugins():
         if os.path.exists(cfg_path):
             with open(cfg_path) as cf:
                 config = yaml.safe_load(cf) or {}
-        enabled = registry.get(name, True)
+        # Plugins may opt out of being enabled when first discovered
+        enabled = registry.get(name, config.get('default_enabled', True))
         if name not in registry:
-            registry[name] = True
+            registry[name] = enabled
             changed = True
         plugins[name] = {
             'metadata': metadata,
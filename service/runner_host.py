@@ -0,0 +1,398 @@
+"""Warm runner hosts: preloaded interpreters that fork once per job.
+
+Starting a runner in a fresh interpreter re-imports numpy, matplotlib,
+scikit-rf, openpyxl, pyedb ... for every task, which takes seconds before
+any work is done.  Plugins whose ``config.yaml`` sets ``mode: host`` are
+instead run by a long-lived host process started with the plugin's
+``venv_python``.  The host imports the modules listed under ``preload``
+and executes the runner script once under a name other than
+``__main__``, so its module-level imports are loaded but ``main`` is not
+called.  For every job it forks; the child becomes a new session (so
+:func:`~service.execution.kill_tree` stops it with its AEDT children),
+switches to the task directory, streams its output back over the
+connection and runs the script as ``__main__``.  Each job therefore starts
+from the same clean, already-imported state.
+
+This file runs as a script inside plugin virtual environments, so it
+only uses the standard library and has no package-relative imports.
+Fork is POSIX only; on Windows :class:`HostPool` returns no host and
+plugins run in fresh processes.
+
+Protocol, one Unix socket connection per job: the client sends a JSON
+line ``{"argv": [...], "cwd": ..., "limits": {...}}``, the child answers
+``{"pid": ...}`` followed by its output, and after the child has exited
+the host appends :data:`EXIT_MARK` with the exit status and resource use.
+"""
+import argparse
+import atexit
+import importlib
+import json
+import logging
+import os
+import runpy
+import select
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+try:  # POSIX only
+    import resource
+except ImportError:  # pragma: no cover - Windows
+    resource = None
+
+log = logging.getLogger(__name__)
+
+EXIT_MARK = '\x00runner-host-exit '
+# Seconds to wait for a new host to finish preloading
+START_TIMEOUT = 180.0
+# Seconds before retrying a host that failed to start
+RETRY_AFTER = 60.0
+
+
+def _run_job(conn, request):
+    """Body of a forked child: run one job with output sent to ``conn``."""
+    os.setsid()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    conn.sendall(json.dumps({'pid': os.getpid()}).encode() + b'\n')
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.dup2(conn.fileno(), 1)
+    os.dup2(conn.fileno(), 2)
+    os.close(devnull)
+    conn.close()
+    sys.stdout = open(1, 'w', encoding='utf-8', errors='replace', buffering=1, closefd=False)
+    sys.stderr = open(2, 'w', encoding='utf-8', errors='replace', buffering=1, closefd=False)
+
+    code = 1
+    try:
+        limits = request.get('limits') or {}
+        if resource is not None and limits.get('memory_mb'):
+            size = int(limits['memory_mb']) * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (size, size))
+        if limits.get('nice'):
+            os.nice(int(limits['nice']))
+        os.chdir(request['cwd'])
+        argv = [str(a) for a in request['argv']]
+        sys.argv = argv
+        sys.path[0] = os.path.dirname(os.path.abspath(argv[0]))
+        runpy.run_path(argv[0], run_name='__main__')
+        code = 0
+    except SystemExit as exc:
+        if exc.code is None or isinstance(exc.code, int):
+            code = exc.code or 0
+        else:
+            print(exc.code, file=sys.stderr)
+    except BaseException:
+        traceback.print_exc()
+    try:
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(code)
+
+
+def _reap(jobs):
+    """Report the status of exited jobs and close their connections."""
+    while jobs:
+        pid, status, usage = os.wait4(-1, os.WNOHANG)
+        if pid == 0:
+            return
+        conn = jobs.pop(pid, None)
+        if conn is None:
+            continue
+        trailer = {
+            'returncode': os.waitstatus_to_exitcode(status),
+            'cpu_time': usage.ru_utime + usage.ru_stime,
+            'peak_rss_kb': usage.ru_maxrss // (1024 if sys.platform == 'darwin' else 1),
+        }
+        try:
+            conn.sendall((EXIT_MARK + json.dumps(trailer) + '\n').encode())
+        except OSError:
+            pass  # the client went away
+        conn.close()
+
+
+def serve(socket_path, script=None, preload=()):
+    """Preload, then accept jobs on ``socket_path`` until SIGTERM.
+
+    After SIGTERM, or when the parent process exits, no new jobs are
+    accepted and the host exits once its running jobs are done.
+    """
+    for name in preload:
+        importlib.import_module(name)
+    if script:
+        # Replace this file's directory so service modules cannot shadow
+        # the plugin's imports
+        sys.path[0] = os.path.dirname(os.path.abspath(script))
+        runpy.run_path(script, run_name='__runner_host__')
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    # Wake the loop when a job exits so its status is reported at once
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_r, False)
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda *_: None)
+    parent = os.getppid()
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(64)
+    print(f'Runner host {os.getpid()} ready on {socket_path}', flush=True)
+
+    jobs = {}
+    while not stopping and os.getppid() == parent or jobs:
+        if stopping or os.getppid() != parent:
+            if listener.fileno() != -1:
+                listener.close()
+                os.unlink(socket_path)
+            _reap(jobs)
+            time.sleep(0.2)
+            continue
+        readable = select.select([listener, wake_r], [], [], 1.0)[0]
+        if wake_r in readable:
+            while True:
+                try:
+                    if not os.read(wake_r, 4096):
+                        break
+                except BlockingIOError:
+                    break
+        if listener in readable:
+            conn, _ = listener.accept()
+            try:
+                conn.settimeout(10)
+                request = json.loads(conn.makefile('rb').readline() or b'null')
+                conn.settimeout(None)
+            except (OSError, ValueError):
+                conn.close()
+                request = None
+            if isinstance(request, dict):
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        signal.set_wakeup_fd(-1)
+                        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                        os.close(wake_r)
+                        os.close(wake_w)
+                        listener.close()
+                        for other in jobs.values():
+                            other.close()
+                        _run_job(conn, request)
+                    finally:
+                        os._exit(1)
+                jobs[pid] = conn
+        _reap(jobs)
+    if listener.fileno() != -1:
+        listener.close()
+        os.unlink(socket_path)
+
+
+class HostJob:
+    """A job running in a host; quacks enough like :class:`subprocess.Popen`."""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._file = sock.makefile('r', encoding='utf-8', errors='replace', newline=None)
+        header = self._file.readline()
+        if not header:
+            self.close()
+            raise ConnectionError('Runner host closed the connection')
+        self.pid = json.loads(header)['pid']
+        self.returncode = None
+        # Set when the host died before reporting the exit status
+        self.lost = False
+        self._status = None
+
+    @property
+    def stdout(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        """Yield output lines until the host reports the exit status."""
+        for line in self._file:
+            index = line.find(EXIT_MARK)
+            if index == -1:
+                yield line
+                continue
+            if index:
+                # Last line of output without a trailing newline
+                yield line[:index] + '\n'
+            self._status = json.loads(line[index + len(EXIT_MARK):])
+            return
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def wait(self):
+        """Return ``(returncode, cpu_time, peak_rss_kb)`` once output ended."""
+        if self._status is None:
+            self.lost = True
+            self.returncode = -1
+            return -1, None, None
+        self.returncode = self._status['returncode']
+        return self.returncode, self._status.get('cpu_time'), self._status.get('peak_rss_kb')
+
+
+class RunnerHost:
+    """A host process serving one plugin script and interpreter."""
+
+    def __init__(self, python, script, preload, runtime_dir):
+        self.python = python
+        self.script = script
+        self.preload = list(preload)
+        name = f'{os.path.basename(os.path.dirname(script))}-{os.getpid()}-{id(self):x}'
+        self.socket_path = os.path.join(runtime_dir, name + '.sock')
+        self.log_path = os.path.join(runtime_dir, name + '.log')
+        self.mtime = _mtime(script)
+        self.proc = None
+
+    def start(self):
+        with open(self.log_path, 'w') as log_file:
+            self.proc = subprocess.Popen(
+                [self.python, os.path.abspath(__file__), '--socket', self.socket_path,
+                 '--script', self.script, '--preload', ','.join(self.preload)],
+                stdin=subprocess.DEVNULL, stdout=log_file, stderr=subprocess.STDOUT,
+                env=dict(os.environ, PYTHONUNBUFFERED='1'), start_new_session=True,
+            )
+
+    def wait_ready(self, timeout=START_TIMEOUT):
+        """Wait until the host accepts jobs; ``False`` if it died or hung."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                return False
+            if os.path.exists(self.socket_path):
+                return True
+            time.sleep(0.1)
+        return False
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def log_tail(self, size=4000):
+        try:
+            with open(self.log_path, encoding='utf-8', errors='replace') as f:
+                return f.read()[-size:]
+        except OSError:
+            return ''
+
+    def run(self, cmd, cwd, limits=None):
+        """Start ``cmd`` (``[python, script, args...]``) as a job in the host."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+            request = {'argv': list(cmd[1:]), 'cwd': cwd, 'limits': limits or {}}
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            return HostJob(sock)
+        except (OSError, ValueError):
+            sock.close()
+            raise
+
+    def stop(self):
+        """Let running jobs finish, then exit."""
+        if self.alive():
+            self.proc.terminate()
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class HostPool:
+    """Runner hosts keyed by interpreter, script and preload list."""
+
+    def __init__(self):
+        self._hosts = {}
+        self._failed = {}
+        self._lock = threading.Lock()
+        self._runtime_dir = None
+
+    @staticmethod
+    def supported():
+        return hasattr(os, 'fork') and hasattr(socket, 'AF_UNIX')
+
+    def get(self, task_conf, cmd):
+        """Return a ready host for a plugin in ``mode: host``, else ``None``.
+
+        ``cmd`` is the plugin's command from
+        :func:`~service.execution.build_command`.  A host is restarted
+        when the runner script changed on disk.
+        """
+        if task_conf.get('mode') != 'host' or not self.supported():
+            return None
+        key = (cmd[0], cmd[1], tuple(task_conf.get('preload') or ()))
+        with self._lock:
+            if time.monotonic() < self._failed.get(key, 0):
+                return None
+            host = self._hosts.get(key)
+            if host is not None and (not host.alive() or host.mtime != _mtime(host.script)):
+                host.stop()
+                host = None
+            if host is None:
+                if self._runtime_dir is None:
+                    self._runtime_dir = tempfile.mkdtemp(prefix='runner-hosts-')
+                    atexit.register(self.shutdown)
+                host = RunnerHost(cmd[0], cmd[1], key[2], self._runtime_dir)
+                host.start()
+                log.info('Starting runner host for %s', cmd[1])
+                self._hosts[key] = host
+        if not host.wait_ready():
+            log.error('Runner host for %s failed to start; using fresh processes for %.0f s\n%s',
+                      cmd[1], RETRY_AFTER, host.log_tail())
+            with self._lock:
+                host.stop()
+                if self._hosts.get(key) is host:
+                    del self._hosts[key]
+                self._failed[key] = time.monotonic() + RETRY_AFTER
+            return None
+        return host
+
+    def shutdown(self):
+        """Stop all hosts, letting them finish running jobs briefly."""
+        with self._lock:
+            hosts = list(self._hosts.values())
+            self._hosts.clear()
+        for host in hosts:
+            host.stop()
+        for host in hosts:
+            try:
+                host.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                pass
+        if self._runtime_dir is not None:
+            shutil.rmtree(self._runtime_dir, ignore_errors=True)
+
+
+pool = HostPool()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve plugin jobs from a preloaded interpreter.')
+    parser.add_argument('--socket', required=True, help='Unix socket to listen on')
+    parser.add_argument('--script', help='Runner script whose imports are preloaded')
+    parser.add_argument('--preload', default='', help='Comma separated modules to import')
+    args = parser.parse_args()
+    serve(args.socket, args.script, [m for m in args.preload.split(',') if m])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""Predict task runtimes from parameters and input sizes.
+
+Each plugin gets a ridge regression of ``log(duration)`` on
+``log(1 + feature)`` for the features returned by :func:`task_features`:
+numeric parameters, the total input size, the sweep point count of
+``srange`` and the port count of Touchstone inputs.  Power laws such as
+"runtime grows with the number of sweep points" become linear in log
+space, so a handful of finished tasks already gives usable estimates.
+
+Models are built from the task history on first use and updated
+incrementally with tasks that finished since.  Every process, including
+web processes that never run tasks, reads those from the database at
+most every ``RUNTIME_MODEL_REFRESH`` seconds when a prediction is made,
+and :func:`observe` reads them at once in the process that finished a
+task, so all processes order queues and show ETAs alike.  Until a
+plugin has enough samples, the median of its runtimes (or
+:data:`DEFAULT_DURATION`) is used instead.
+"""
+import math
+import re
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+
+from flask import current_app
+
+from .models import db, Task, TaskArchive
+
+# Fallback runtime for plugins without finished tasks
+DEFAULT_DURATION = 600.0
+# Finished tasks per plugin loaded when the models are first built
+HISTORY = 500
+RIDGE = 1.0
+# Finish times are read again this far back so tasks committed late are not missed
+OVERLAP = timedelta(seconds=60)
+
+_TOUCHSTONE_RE = re.compile(r'\.s(\d+)p$', re.IGNORECASE)
+
+
+def _solve(matrix, vector):
+    """Solve ``matrix @ x = vector`` by Gaussian elimination with pivoting.
+
+    The systems are tiny (one row per feature) so this avoids a numpy
+    dependency in the web service.
+    """
+    size = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(size)]
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda r: abs(rows[r][col]))
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        if abs(rows[col][col]) < 1e-12:
+            continue
+        for r in range(size):
+            if r != col:
+                factor = rows[r][col] / rows[col][col]
+                for c in range(col, size + 1):
+                    rows[r][c] -= factor * rows[col][c]
+    return [rows[i][size] / rows[i][i] if abs(rows[i][i]) >= 1e-12 else 0.0 for i in range(size)]
+
+
+_models = {}
+_loaded = False
+_lock = threading.Lock()
+# Ids and finish times of the tasks added within OVERLAP of the newest one
+_seen = {}
+_newest = None
+_checked = None
+
+
+def task_features(task):
+    """Return the numeric features of ``task`` used to predict its runtime."""
+    features = {}
+    for name, value in sorted((task.parameters or {}).items()):
+        text = str(value).strip()
+        try:
+            number = float(text)
+        except ValueError:
+            number = None
+        if number is not None and math.isfinite(number):
+            features[name] = abs(number)
+        if name == 'srange' and text:
+            # Sweeps such as "0GHz 20GHz 2001" end with the point count
+            try:
+                features['srange_points'] = float(text.split()[-1])
+            except ValueError:
+                pass
+        match = _TOUCHSTONE_RE.search(text)
+        if match:
+            features['ports'] = float(match.group(1))
+    if task.input_bytes is not None:
+        features['input_bytes'] = float(task.input_bytes)
+    return features
+
+
+class RuntimeModel:
+    """Incrementally updated runtime regression for one plugin."""
+
+    def __init__(self):
+        self.keys = None
+        self.n = 0
+        self.xtx = None
+        self.xty = None
+        self.recent = deque(maxlen=HISTORY)
+        # Relative errors of predictions made just before each observation
+        self.errors = deque(maxlen=100)
+        self._weights = None
+
+    def _vector(self, features):
+        return [1.0] + [math.log1p(features.get(k, 0.0)) for k in self.keys]
+
+    def add(self, features, duration):
+        if duration <= 0:
+            return
+        if self.keys is None:
+            self.keys = []
+            self.xtx = [[0.0]]
+            self.xty = [0.0]
+        self._extend(features)
+        if self.n:
+            predicted = self.predict(features)
+            self.errors.append(abs(predicted - duration) / duration)
+        x = self._vector(features)
+        target = math.log(duration)
+        for i, xi in enumerate(x):
+            row = self.xtx[i]
+            for j, xj in enumerate(x):
+                row[j] += xi * xj
+            self.xty[i] += xi * target
+        self.n += 1
+        self.recent.append(duration)
+        self._weights = None
+
+    def _extend(self, features):
+        """Add features not seen before as new regression columns.
+
+        Earlier samples count as 0 for them, as in :meth:`_vector`, so
+        appending zero rows and columns gives the same sums as refitting
+        the whole history with the larger key set.
+        """
+        for key in sorted(set(features) - set(self.keys)):
+            self.keys.append(key)
+            for row in self.xtx:
+                row.append(0.0)
+            self.xtx.append([0.0] * (len(self.keys) + 1))
+            self.xty.append(0.0)
+            self._weights = None
+
+    @property
+    def fitted(self):
+        """Whether there are enough samples for the regression."""
+        return self.keys is not None and self.n >= max(5, len(self.keys) + 2)
+
+    def predict(self, features):
+        if not self.fitted:
+            if not self.recent:
+                return DEFAULT_DURATION
+            ordered = sorted(self.recent)
+            return ordered[len(ordered) // 2]
+        if self._weights is None:
+            matrix = [list(row) for row in self.xtx]
+            for i in range(1, len(matrix)):  # do not shrink the intercept
+                matrix[i][i] += RIDGE
+            self._weights = _solve(matrix, self.xty)
+        log_duration = sum(w * x for w, x in zip(self._weights, self._vector(features)))
+        # Clamp to the observed range so extrapolation stays sane
+        low, high = min(self.recent), max(self.recent)
+        return min(max(math.exp(log_duration), low / 2), high * 2)
+
+    def summary(self):
+        errors = sorted(self.errors)
+        return {
+            'samples': self.n,
+            'method': 'regression' if self.fitted else 'median',
+            'features': sorted(self.keys or []),
+            'median_relative_error': round(errors[len(errors) // 2], 3) if errors else None,
+        }
+
+
+def _duration(task):
+    if task.start_time is None or task.end_time is None:
+        return None
+    return (task.end_time - task.start_time).total_seconds()
+
+
+def _finished(model_cls):
+    return model_cls.query.filter(
+        model_cls.status == 'SUCCESS',
+        model_cls.start_time.isnot(None),
+        model_cls.end_time.isnot(None),
+    )
+
+
+def _add(task):
+    _models.setdefault(task.task_type, RuntimeModel()).add(task_features(task), _duration(task))
+    if isinstance(task, Task):
+        _seen[task.id] = task.end_time
+
+
+def _forget_old():
+    global _newest
+    if _seen:
+        _newest = max(_seen.values())
+        for task_id in [i for i, end in _seen.items() if end < _newest - OVERLAP]:
+            del _seen[task_id]
+
+
+def _ensure_loaded():
+    global _loaded, _checked
+    if _loaded:
+        return
+    for model_cls in (TaskArchive, Task):
+        task_types = [t for (t,) in db.session.query(model_cls.task_type).distinct()]
+        for task_type in task_types:
+            rows = _finished(model_cls).filter(
+                model_cls.task_type == task_type,
+            ).order_by(model_cls.end_time.desc()).limit(HISTORY).all()
+            for task in reversed(rows):
+                _add(task)
+    _forget_old()
+    _loaded = True
+    _checked = time.monotonic()
+
+
+def _refresh(force=False):
+    """Add the tasks other processes finished since the last check."""
+    global _checked
+    _ensure_loaded()
+    now = time.monotonic()
+    if not force and now - _checked < current_app.config['RUNTIME_MODEL_REFRESH']:
+        return
+    _checked = now
+    query = _finished(Task)
+    if _newest is not None:
+        query = query.filter(Task.end_time >= _newest - OVERLAP)
+    for task in query.order_by(Task.end_time):
+        if task.id not in _seen:
+            _add(task)
+    _forget_old()
+
+
+def observe(task):
+    """Update the plugin's model once ``task`` has finished successfully."""
+    if task.status != 'SUCCESS' or _duration(task) is None:
+        return
+    with _lock:
+        # Also picks up tasks finished by other processes
+        _refresh(force=True)
+
+
+def predict(task):
+    """Expected wall-clock runtime of ``task`` in seconds."""
+    with _lock:
+        _refresh()
+        model = _models.get(task.task_type)
+        if model is None:
+            return DEFAULT_DURATION
+        return model.predict(task_features(task))
+
+
+def summaries():
+    """Return ``{task_type: summary}`` describing each plugin's model."""
+    with _lock:
+        _refresh()
+        return {name: model.summary() for name, model in sorted(_models.items())}
+
@@ -0,0 +1,111 @@
+"""Scheduling policy: which queued task runs next and when queued tasks start.
+
+Queued tasks are ordered by
+
+1. priority, set by administrators (higher first);
+2. weighted fair share: the user with the fewest running tasks relative to
+   their ``share`` goes first, so one user's 500 submissions cannot starve
+   everybody else;
+3. shortest expected runtime (see :mod:`service.runtime_model`), so
+   quick jobs are not stuck behind long ones of the same user;
+4. submission order.
+
+Users already running ``max_running`` tasks (or ``USER_MAX_RUNNING`` when
+unset; 0 means no cap) are skipped until one of their tasks finishes.
+
+:func:`queue_forecast` replays this policy against the runtimes predicted
+by :mod:`service.runtime_model` to give each queued task its position and
+an estimated start time.  Placing tasks on slots is done by
+:func:`service.tasks.dispatch`.
+"""
+import heapq
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from . import runtime_model
+from .models import User
+
+
+class UserPolicy:
+    """Fair-share weight and running-task cap of each user."""
+
+    def __init__(self, user_ids):
+        default_cap = current_app.config.get('USER_MAX_RUNNING', 0)
+        self.shares = {}
+        self.caps = {}
+        self._durations = {}
+        users = User.query.filter(User.id.in_(set(user_ids))).all() if user_ids else []
+        for user in users:
+            self.shares[user.id] = user.share if user.share and user.share > 0 else 1.0
+            cap = user.max_running if user.max_running is not None else default_cap
+            self.caps[user.id] = cap or None
+
+    def duration(self, task):
+        """Predicted runtime of ``task``, computed once per policy."""
+        if task.id not in self._durations:
+            self._durations[task.id] = runtime_model.predict(task)
+        return self._durations[task.id]
+
+    def eligible(self, user_id, running):
+        cap = self.caps.get(user_id)
+        return cap is None or running.get(user_id, 0) < cap
+
+    def key(self, task, running):
+        """Sort key of ``task`` given the running task count per user."""
+        share = self.shares.get(task.user_id, 1.0)
+        return (
+            -(task.priority or 0),
+            running.get(task.user_id, 0) / share,
+            self.duration(task),
+            task.id,
+        )
+
+
+def pick_next(candidates, running, policy):
+    """Return the candidate task that should start next, or ``None``."""
+    eligible = [t for t in candidates if policy.eligible(t.user_id, running)]
+    if not eligible:
+        return None
+    return min(eligible, key=lambda t: policy.key(t, running))
+
+
+def queue_forecast(queued, active, slots, now=None):
+    """Simulate the queue and return ``{task_id: (position, start, end)}``.
+
+    ``queued`` are tasks waiting for a slot, ``active`` those holding one and
+    ``slots`` the total number of slots.  Running tasks are assumed to end
+    after their estimated duration; one still running past its estimate
+    is assumed to end now.
+    """
+    now = now or datetime.now()
+    policy = UserPolicy([t.user_id for t in queued] + [t.user_id for t in active])
+    finishing = []  # heap of (end_time, sequence, user_id)
+    running = {}
+    for seq, task in enumerate(active):
+        started = task.start_time or now
+        end = max(now, started + timedelta(seconds=policy.duration(task)))
+        heapq.heappush(finishing, (end, seq, task.user_id))
+        running[task.user_id] = running.get(task.user_id, 0) + 1
+
+    forecast = {}
+    waiting = list(queued)
+    clock = now
+    seq = len(active)
+    while waiting:
+        while finishing and finishing[0][0] <= clock:
+            _, _, user_id = heapq.heappop(finishing)
+            running[user_id] -= 1
+        task = pick_next(waiting, running, policy) if len(finishing) < max(slots, 1) else None
+        if task is None:
+            if not finishing:
+                break  # only capped users are waiting and nothing is running
+            clock = finishing[0][0]
+            continue
+        waiting.remove(task)
+        seq += 1
+        end = clock + timedelta(seconds=policy.duration(task))
+        forecast[task.id] = (len(forecast) + 1, clock, end)
+        heapq.heappush(finishing, (end, seq, task.user_id))
+        running[task.user_id] = running.get(task.user_id, 0) + 1
+    return forecast
@@ -0,0 +1,150 @@
+"""Run the service as separate web and worker processes.
+
+``python -m service.flask_app`` runs everything in one process: Waitress,
+the scheduler and the executor threads that run tasks.  The two roles can
+also run apart, sharing only the database (``DATABASE_URI``) and the
+outputs directory (``OUTPUT_DIR``)::
+
+    python -m service.serve web --port 5000 --processes 4 --threads 8
+    python -m service.serve worker --slots 4 --archive
+
+Web processes serve pages, downloads and the APIs; submitting a task only
+inserts a ``PENDING`` row.  ``--processes`` forks web processes sharing
+one listening socket (POSIX only), each with its own job table and user
+caches.
+
+Worker processes run no HTTP server.  Each registers in the worker table
+(listed on the admin page) with ``--slots`` as its capacity, dispatches
+queued tasks every ``DISPATCH_INTERVAL`` seconds and runs the ones
+assigned to it.  A worker stopped with Ctrl+C or SIGTERM requeues its
+tasks; one that dies is noticed after ``WORKER_TIMEOUT`` seconds and its
+tasks are requeued by the other processes.  Worker processes also run the
+warm runner hosts; the archiver runs only in the one started with
+``--archive``.  Remote workers (:mod:`service.worker`) keep talking to the
+web processes.
+"""
+import argparse
+import os
+import signal
+import socket
+import threading
+import time
+
+
+def run_web(host, port, processes=1, threads=8):
+    """Serve HTTP from ``processes`` processes sharing one socket."""
+    from waitress import serve
+
+    from .flask_app import create_app
+    from .models import db
+
+    app = create_app({'PROCESS_ROLE': 'web'})
+    sock = socket.create_server((host, port))
+    if processes <= 1 or not hasattr(os, 'fork'):
+        serve(app, sockets=[sock], threads=threads)
+        return
+
+    children = []
+    for _ in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # Connections opened before the fork belong to the parent
+                with app.app_context():
+                    db.engine.dispose(close=False)
+                serve(app, sockets=[sock], threads=threads)
+            finally:
+                os._exit(0)
+        children.append(pid)
+    signal.signal(signal.SIGTERM, lambda signum, frame: _stop_children(children))
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _stop_children(children)
+
+
+def _stop_children(children):
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def run_worker(name, slots, archive=False):
+    """Dispatch queued tasks and run those assigned to worker ``name``.
+
+    ``archive`` also runs the archiver in this process; start exactly one
+    worker with it.
+    """
+    from .archive import start_archiver
+    from .config_utils import load_config
+    from .flask_app import create_app
+    from .tasks import dispatch, release_assigned, start_runner_hosts, work_assigned
+    from .worker_registry import register_local, start_worker_monitor, unregister
+
+    app = create_app({
+        'PROCESS_ROLE': 'worker', 'WORKER_NAME': name,
+        'LOCAL_SLOTS': slots, 'EXECUTOR_MAX_WORKERS': slots,
+    })
+    if archive:
+        start_archiver(app)
+    start_worker_monitor(app)
+    start_runner_hosts(app)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    interval = app.config['DISPATCH_INTERVAL']
+    heartbeat = max(app.config['WORKER_TIMEOUT'] / 4, interval)
+    last_heartbeat = None
+    app.logger.info('Worker process %s running %d task(s) at once', name, slots)
+    try:
+        while not stop.is_set():
+            try:
+                with app.app_context():
+                    now = time.monotonic()
+                    if last_heartbeat is None or now - last_heartbeat >= heartbeat:
+                        register_local(name, slots, load_config())
+                        last_heartbeat = now
+                    dispatch()
+                    work_assigned(name)
+            except Exception:  # pragma: no cover - keep the worker alive
+                app.logger.exception('Worker process %s failed to dispatch', name)
+            stop.wait(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        with app.app_context():
+            release_assigned(name)
+            unregister(name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    roles = parser.add_subparsers(dest='role', required=True)
+    web = roles.add_parser('web', help='serve HTTP without running tasks')
+    web.add_argument('--host', default='0.0.0.0')
+    web.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5000)))
+    web.add_argument('--processes', type=int, default=1, help='web processes sharing the port (POSIX)')
+    web.add_argument('--threads', type=int, default=8, help='Waitress threads per process')
+    worker = roles.add_parser('worker', help='run tasks without serving HTTP')
+    worker.add_argument('--name', default=f'{socket.gethostname()}-{os.getpid()}',
+                        help='name in the worker table (default: <host>-<pid>)')
+    worker.add_argument('--slots', type=int,
+                        default=int(os.environ.get('LOCAL_SLOTS', 0)) or os.cpu_count() or 1,
+                        help='tasks run at once')
+    worker.add_argument('--archive', action='store_true',
+                        help='also run the archiver (in exactly one worker process)')
+    args = parser.parse_args(argv)
+
+    if args.role == 'web':
+        run_web(args.host, args.port, args.processes, args.threads)
+    else:
+        run_worker(args.name, args.slots, args.archive)
+
+
+if __name__ == '__main__':
+    main()
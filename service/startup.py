@@ -0,0 +1,167 @@
+"""Startup timing for the Flask service.
+
+:func:`service.flask_app.create_app` wraps each initialisation step in
+:func:`phase`; the durations are kept in :data:`PHASES` and exported as
+``sim_startup_phase_seconds``.  Run as a script to measure cold starts in
+fresh interpreters, for example in CI::
+
+    python -m service.startup --runs 5 --budget-ms 1000
+    python -m service.startup --json > startup.json
+
+Each run imports :mod:`service.flask_app` under ``-X importtime`` against
+a scratch database and calls ``create_app()``.  The report lists the
+median import and initialisation times, every phase and the packages and
+modules that took longest to import.  The exit status is 1 when the
+median total exceeds the budget (``--budget-ms`` or ``STARTUP_BUDGET_MS``).
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from .metrics import STARTUP_PHASE
+
+# Seconds spent in each phase of the last ``create_app()`` call
+PHASES = {}
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CHILD = '''
+import json, time
+start = time.perf_counter()
+import service.flask_app as flask_app
+imported = time.perf_counter()
+flask_app.create_app()
+created = time.perf_counter()
+from service.startup import PHASES
+print(json.dumps({"import": imported - start, "create_app": created - imported, "phases": PHASES}))
+'''
+
+_IMPORTTIME = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)')
+
+
+@contextmanager
+def phase(name):
+    """Record how long the ``with`` block takes as startup phase ``name``."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PHASES[name] = time.perf_counter() - start
+        STARTUP_PHASE.set(PHASES[name], name)
+
+
+def _parse_importtime(stderr):
+    """Return ``{module: self_seconds}`` from ``-X importtime`` output."""
+    modules = {}
+    for line in stderr.splitlines():
+        match = _IMPORTTIME.match(line)
+        if match:
+            modules[match.group(4)] = int(match.group(1)) / 1e6
+    return modules
+
+
+def measure_once(python=sys.executable):
+    """Start the application once in a fresh interpreter and time it."""
+    with tempfile.TemporaryDirectory(prefix='sim_startup_') as workdir:
+        env = dict(
+            os.environ,
+            DATABASE_URI='sqlite:///' + os.path.join(workdir, 'startup.db'),
+            OUTPUT_DIR=os.path.join(workdir, 'outputs'),
+            ARCHIVE_DIR=os.path.join(workdir, 'archive'),
+            APP_REGISTRY_FILE=os.path.join(workdir, 'app_registry.json'),
+            PYTHONPATH=os.pathsep.join(filter(None, [PROJECT_ROOT, os.environ.get('PYTHONPATH')])),
+        )
+        start = time.perf_counter()
+        proc = subprocess.run(
+            [python, '-X', 'importtime', '-c', _CHILD],
+            cwd=workdir, env=env, capture_output=True, text=True,
+        )
+        wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f'Application failed to start:\n{proc.stderr[-4000:]}')
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result['total'] = result['import'] + result['create_app']
+    result['wall'] = wall
+    result['modules'] = _parse_importtime(proc.stderr)
+    return result
+
+
+def summarize(runs, top=15):
+    """Median timings over ``runs`` from :func:`measure_once`, in ms."""
+    def ms(values):
+        return round(statistics.median(values) * 1000, 1)
+
+    packages = {}
+    modules = {}
+    for run in runs:
+        per_package = {}
+        for name, seconds in run['modules'].items():
+            modules.setdefault(name, []).append(seconds)
+            package = name.split('.')[0]
+            per_package[package] = per_package.get(package, 0) + seconds
+        for package, seconds in per_package.items():
+            packages.setdefault(package, []).append(seconds)
+    phase_names = list(dict.fromkeys(name for run in runs for name in run['phases']))
+    return {
+        'runs': len(runs),
+        'total_ms': ms([r['total'] for r in runs]),
+        'import_ms': ms([r['import'] for r in runs]),
+        'create_app_ms': ms([r['create_app'] for r in runs]),
+        'interpreter_ms': ms([r['wall'] for r in runs]),
+        'phases_ms': {n: ms([r['phases'].get(n, 0) for r in runs]) for n in phase_names},
+        'packages_ms': dict(sorted(
+            ((p, ms(v)) for p, v in packages.items()), key=lambda item: -item[1],
+        )[:top]),
+        'modules_ms': dict(sorted(
+            ((m, ms(v)) for m, v in modules.items()), key=lambda item: -item[1],
+        )[:top]),
+    }
+
+
+def _print_report(summary, budget_ms):
+    print(f"Cold start over {summary['runs']} runs (median)")
+    print(f"  import service.flask_app  {summary['import_ms']:8.1f} ms")
+    print(f"  create_app()              {summary['create_app_ms']:8.1f} ms")
+    print(f"  total                     {summary['total_ms']:8.1f} ms"
+          + (f'   (budget {budget_ms:g} ms)' if budget_ms else ''))
+    print(f"  interpreter wall time     {summary['interpreter_ms']:8.1f} ms")
+    print('Phases of create_app()')
+    for name, value in summary['phases_ms'].items():
+        print(f'  {name:<25} {value:8.1f} ms')
+    print('Import time by package (self time)')
+    for name, value in summary['packages_ms'].items():
+        print(f'  {name:<25} {value:8.1f} ms')
+    print('Slowest modules (self time)')
+    for name, value in summary['modules_ms'].items():
+        print(f'  {name:<40} {value:8.1f} ms')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to start')
+    parser.add_argument('--budget-ms', type=float, default=float(os.environ.get('STARTUP_BUDGET_MS', 0)),
+                        help='fail when the median import + create_app time exceeds this')
+    parser.add_argument('--top', type=int, default=15, help='packages and modules to list')
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args(argv)
+
+    summary = summarize([measure_once() for _ in range(max(1, args.runs))], top=args.top)
+    over = bool(args.budget_ms) and summary['total_ms'] > args.budget_ms
+    if args.json:
+        print(json.dumps(dict(summary, budget_ms=args.budget_ms or None, over_budget=over), indent=2))
+    else:
+        _print_report(summary, args.budget_ms)
+        if over:
+            print(f"Startup took {summary['total_ms']:g} ms, over the {args.budget_ms:g} ms budget")
+    return 1 if over else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,106 +1,418 @@
-"""Stress test script to submit random jobs for all applications."""
+"""Load test and benchmark harness for the task platform.
+
+The harness starts the real application under Waitress against a scratch
+database, output directory and plugin registry, then drives it over HTTP
+from N simulated browsers.  Each browser logs in, submits ``stub`` tasks
+with an uploaded payload, polls the dashboard job table like the page's
+5 second refresh, downloads finished results and, for the admin browser,
+opens the admin pages.  The ``stub`` plugin (``apps/stub``) sleeps and
+writes synthetic outputs so no AEDT or PyEDB installation is required.
+
+Results (throughput, per-route latency percentiles, DB statement time,
+lock errors and connection pool checkouts, instrumentation overhead, peak
+memory) are written as JSON and can be compared with a previous run.  The
+run fails when the 95th percentile of the instrumentation overhead exceeds
+``METRICS_OVERHEAD_BUDGET_MS``.  The simulated browsers run in the
+server's process, so the peak memory covers both::
+
+    python -m service.stress_jobs --browsers 20 --duration 120 --output new.json
+    python -m service.stress_jobs --browsers 20 --duration 120 --compare new.json
+"""
 import argparse
+import http.cookiejar
 import json
+import math
 import os
 import random
+import re
+import sys
+import tempfile
+import threading
 import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
 
-# Ensure the service package root is on the import path when running directly
-PACKAGE_PATH = os.path.abspath(os.path.dirname(__file__))
-import sys
-if PACKAGE_PATH not in sys.path:
-    sys.path.insert(0, PACKAGE_PATH)
-
-from flask import current_app
-
-from .flask_app import app
-from .models import db, User, Task
-from .config_utils import load_config
-from .tasks import schedule_task
-
-
-_DEF_SAMPLE = "sample.s2p"
-
-
-def _ensure_sample_file():
-    """Create a minimal Touchstone file for S-parameter tasks."""
-    base_dir = os.path.dirname(PACKAGE_PATH)
-    path = os.path.join(base_dir, _DEF_SAMPLE)
-    if os.path.exists(path):
-        return path
-    with open(path, "w") as f:
-        f.write("# Hz S RI R 50\n")
-        for i in range(1, 11):
-            f.write(f"{i} 1 0 0 1\n")
-    return path
-
-
-def generate_params(task_type):
-    """Return randomized parameters for a task type."""
-    if task_type == "fractal":
-        return {"depth": random.randint(1, 6)}
-    if task_type == "primes":
-        return {"n": random.randint(1000, 10000)}
-    if task_type == "microstrip":
-        return {
-            "thickness": random.choice(["0.8", "1.6"]),
-            "er": random.choice(["2.2", "4.4"]),
-            "tand": random.choice(["0.001", "0.02"]),
-            "width": random.choice(["2", "3"]),
-            "length": random.choice(["10", "20"]),
-            "srange": "0GHz 10GHz 201",
-        }
-    if task_type == "sparams":
-        sample = _ensure_sample_file()
-        return {
-            "file": os.path.basename(sample),
-            "plot": "xy",
-            "parameter": "S",
-            "operation": "db",
-        }
-    return {}
-
-
-def main(iterations: int, rate: float, seed: int | None = None):
-    random.seed(seed)
-    with app.app_context():
-        users = User.query.filter_by(is_admin=False).all()
-        if not users:
-            print("No non-admin users found.")
-            return
-        configs = load_config()
-        task_types = list(configs.keys())
-        base_dir = os.path.dirname(PACKAGE_PATH)
-        for _ in range(iterations):
-            user = random.choice(users)
-            ttype = random.choice(task_types)
-            params = generate_params(ttype)
-            task = Task(
-                user_id=user.id,
-                task_type=ttype,
-                parameters=json.dumps(params),
+try:  # POSIX only
+    import resource
+except ImportError:  # pragma: no cover - Windows
+    resource = None
+
+from .metrics import percentile
+
+STUB_PLUGIN = 'stub'
+_PASSWORD = 'bench'
+_DOWNLOAD_RE = re.compile(r'href="(/download/\d+/[^"]+)"')
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Report redirects as responses so their latency is measured alone."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class Recorder:
+    """Thread-safe collection of request timings per route."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def add(self, route, seconds, ok):
+        with self._lock:
+            self.samples.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self):
+        result = {}
+        for route, values in sorted(self.samples.items()):
+            result[route] = {
+                'count': len(values),
+                'errors': self.errors.get(route, 0),
+                'p50_ms': round(percentile(values, 50) * 1000, 2),
+                'p95_ms': round(percentile(values, 95) * 1000, 2),
+                'p99_ms': round(percentile(values, 99) * 1000, 2),
+                'max_ms': round(max(values) * 1000, 2),
+            }
+        return result
+
+
+class Browser:
+    """Simulated user session talking to the server over HTTP."""
+
+    def __init__(self, base_url, recorder):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            _NoRedirect(),
+        )
+
+    def request(self, route, path, data=None, headers=None):
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers or {})
+        start = time.perf_counter()
+        try:
+            with self.opener.open(req, timeout=60) as resp:
+                body = resp.read()
+                status = resp.status
+        except urllib.error.HTTPError as exc:
+            body = exc.read()
+            status = exc.code
+        except OSError:
+            body, status = b'', 0
+        self.recorder.add(route, time.perf_counter() - start, 0 < status < 400)
+        return status, body
+
+    def login(self, username):
+        data = urllib.parse.urlencode({'username': username, 'password': _PASSWORD}).encode()
+        return self.request('login', '/login', data)
+
+    def submit(self, params, upload_bytes):
+        boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in params.items():
+            parts.append(
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
             )
-            db.session.add(task)
-            db.session.commit()
-
-            if ttype == "sparams" and "file" in params:
-                output_dir = os.path.join(base_dir, "outputs", str(task.id))
-                os.makedirs(output_dir, exist_ok=True)
-                sample_file = os.path.join(base_dir, params["file"])
-                dest = os.path.join(output_dir, params["file"])
-                if not os.path.exists(dest):
-                    from shutil import copyfile
-                    copyfile(sample_file, dest)
-
-            schedule_task(task.id)
-            delay = random.expovariate(rate)
-            time.sleep(delay)
-
-
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Submit random jobs for stress testing.")
-    parser.add_argument("--iterations", type=int, default=10, help="Number of jobs to submit")
-    parser.add_argument("--rate", type=float, default=1.0, help="Average jobs per second")
-    parser.add_argument("--seed", type=int, default=None, help="Random seed")
-    args = parser.parse_args()
-    main(args.iterations, args.rate, args.seed)
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="payload"; '
+            f'filename="payload.bin"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode()
+            + os.urandom(upload_bytes) + b'\r\n'
+        )
+        parts.append(f'--{boundary}--\r\n'.encode())
+        headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        return self.request('submit', f'/submit/{STUB_PLUGIN}', b''.join(parts), headers)
+
+    def poll(self):
+        status, body = self.request('dashboard_jobs', '/dashboard/jobs')
+        return _DOWNLOAD_RE.findall(body.decode('utf-8', errors='replace'))
+
+    def download(self, path):
+        return self.request('download', path)
+
+
+def _user_loop(browser, args, stop, seen_downloads):
+    """Behave like a user: submit now and then, poll every few seconds."""
+    next_submit = time.monotonic() + random.uniform(0, args.submit_interval)
+    while not stop.is_set():
+        now = time.monotonic()
+        if now >= next_submit:
+            params = {
+                'duration': round(random.uniform(*args.task_duration), 2),
+                'output_kb': args.output_kb,
+                'files': args.output_files,
+            }
+            browser.submit(params, args.upload_kb * 1024)
+            next_submit = now + random.expovariate(1.0 / args.submit_interval)
+        for path in browser.poll():
+            if path not in seen_downloads:
+                seen_downloads.add(path)
+                browser.download(path)
+        stop.wait(args.poll_interval)
+
+
+def _admin_loop(browser, args, stop):
+    while not stop.is_set():
+        browser.request('admin_tasks', '/admin/tasks')
+        browser.request('admin_users', '/admin/users')
+        stop.wait(args.admin_interval)
+
+
+def _scrape_metrics(base_url):
+    """Return ``{sample_name_with_labels: value}`` parsed from ``/metrics``."""
+    req = urllib.request.Request(
+        base_url + '/metrics', headers={'Authorization': f'Bearer {os.environ["METRICS_TOKEN"]}'},
+    )
+    with urllib.request.urlopen(req, timeout=60) as resp:
+        text = resp.read().decode()
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            values[name] = float(value)
+    return values
+
+
+def _histogram_percentile(metrics, name, pct):
+    """Approximate a percentile from Prometheus histogram buckets, summed over labels."""
+    counts = {}
+    for key, value in metrics.items():
+        if key.startswith(name + '_bucket{'):
+            bound = key.split('le="', 1)[1].rstrip('"}')
+            bound = math.inf if bound == '+Inf' else float(bound)
+            counts[bound] = counts.get(bound, 0) + value
+    buckets = sorted(counts.items())
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return None
+    target = pct / 100 * total
+    for bound, count in buckets:
+        if count >= target:
+            return bound
+    return None
+
+
+def _queries_per_request(metrics):
+    """Mean database statements per request of each endpoint."""
+    prefix = 'sim_db_queries_per_request_count{endpoint="'
+    means = {}
+    for key, count in metrics.items():
+        if key.startswith(prefix) and count:
+            endpoint = key[len(prefix):-2]
+            total = metrics.get(f'sim_db_queries_per_request_sum{{endpoint="{endpoint}"}}', 0)
+            means[endpoint] = round(total / count, 2)
+    return dict(sorted(means.items()))
+
+
+def _setup_environment(workdir):
+    """Point the application at scratch storage before it is imported."""
+    os.makedirs(workdir, exist_ok=True)
+    os.environ['DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['OUTPUT_DIR'] = os.path.join(workdir, 'outputs')
+    os.environ['APP_REGISTRY_FILE'] = os.path.join(workdir, 'app_registry.json')
+    os.environ['ARCHIVE_INTERVAL_HOURS'] = '0'
+    os.environ['METRICS_TOKEN'] = uuid.uuid4().hex
+
+
+def run_benchmark(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='sim_bench_')
+    _setup_environment(workdir)
+
+    from werkzeug.security import generate_password_hash
+    from waitress import create_server
+
+    from .flask_app import app
+    from .models import db, User, Task
+    from .plugin_loader import load_registry, save_registry
+
+    registry = load_registry()
+    registry[STUB_PLUGIN] = True
+    save_registry(registry)
+
+    password_hash = generate_password_hash(_PASSWORD, method='pbkdf2:sha256')
+    usernames = [f'bench{i}' for i in range(args.browsers)]
+    with app.app_context():
+        for name in usernames + ['benchadmin']:
+            if not User.query.filter_by(username=name).first():
+                db.session.add(User(
+                    username=name, password_hash=password_hash,
+                    is_admin=name == 'benchadmin',
+                ))
+        db.session.commit()
+
+    server = create_server(app, host='127.0.0.1', port=0, threads=args.threads)
+    base_url = f'http://127.0.0.1:{server.effective_port}'
+    server_thread = threading.Thread(target=server.run, daemon=True)
+    server_thread.start()
+
+    recorder = Recorder()
+    stop = threading.Event()
+    seen_downloads = set()
+    threads = []
+    for name in usernames:
+        browser = Browser(base_url, recorder)
+        browser.login(name)
+        threads.append(threading.Thread(
+            target=_user_loop, args=(browser, args, stop, seen_downloads), daemon=True
+        ))
+    if args.admin_interval > 0:
+        admin = Browser(base_url, recorder)
+        admin.login('benchadmin')
+        threads.append(threading.Thread(target=_admin_loop, args=(admin, args, stop), daemon=True))
+
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    stop.wait(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    metrics = _scrape_metrics(base_url)
+    with app.app_context():
+        counts = dict(
+            db.session.query(Task.status, db.func.count(Task.id)).group_by(Task.status).all()
+        )
+    # The server thread is a daemon and stops with the process; closing its
+    # socket while the event loop is polling would only raise in that thread.
+
+    total_requests = sum(len(v) for v in recorder.samples.values())
+    peak_rss_mb = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_rss_mb = round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+    statement_p95 = _histogram_percentile(metrics, 'sim_db_statement_seconds', 95)
+    overhead_p95 = _histogram_percentile(metrics, 'sim_metrics_overhead_seconds', 95)
+    return {
+        'config': {
+            'browsers': args.browsers,
+            'duration_s': args.duration,
+            'poll_interval_s': args.poll_interval,
+            'submit_interval_s': args.submit_interval,
+            'task_duration_s': list(args.task_duration),
+            'output_kb': args.output_kb,
+            'upload_kb': args.upload_kb,
+            'server_threads': args.threads,
+            'workdir': workdir,
+        },
+        'elapsed_s': round(elapsed, 2),
+        'throughput': {
+            'requests_per_s': round(total_requests / elapsed, 2),
+            'tasks_completed_per_s': round(
+                (counts.get('SUCCESS', 0) + counts.get('FAILURE', 0)) / elapsed, 3
+            ),
+        },
+        'latency': recorder.summary(),
+        'tasks': counts,
+        'db': {
+            'statements': int(metrics.get('sim_db_statement_seconds_count', 0)),
+            'statement_time_s': round(metrics.get('sim_db_statement_seconds_sum', 0.0), 3),
+            'statement_p95_s_bucket': statement_p95,
+            'lock_errors': int(metrics.get('sim_db_lock_errors_total', 0)),
+            'queries_per_request': _queries_per_request(metrics),
+            'pool_size': int(metrics.get('sim_db_pool_size', 0)),
+            'pool_checked_out_peak': int(metrics.get('sim_db_pool_checked_out_peak', 0)),
+            'pool_checkouts': int(metrics.get('sim_db_pool_checkouts_total', 0)),
+            'connection_hold_p99_s_bucket': _histogram_percentile(
+                metrics, 'sim_db_connection_hold_seconds', 99,
+            ),
+            'connection_hold_max_s_bucket': _histogram_percentile(
+                metrics, 'sim_db_connection_hold_seconds', 100,
+            ),
+        },
+        # The simulated browsers share the server's process
+        'metrics_overhead': {
+            'p95_ms_bucket': None if overhead_p95 is None else overhead_p95 * 1000,
+            'budget_ms': app.config['METRICS_OVERHEAD_BUDGET_MS'],
+            'budget_exceeded': int(sum(
+                v for k, v in metrics.items() if k.startswith('sim_metrics_overhead_budget_exceeded_total')
+            )),
+        },
+        'memory': {'peak_rss_mb': peak_rss_mb, 'scope': 'server and simulated browsers'},
+    }
+
+
+def compare(current, baseline):
+    """Return human readable lines comparing two benchmark results."""
+    lines = []
+
+    def delta(new, old):
+        if new is None or old in (None, 0):
+            return 'n/a'
+        return f'{(new - old) / old * 100:+.1f}%'
+
+    for key in ('requests_per_s', 'tasks_completed_per_s'):
+        new, old = current['throughput'][key], baseline['throughput'][key]
+        lines.append(f'{key:<28}{old:>12}{new:>12}  {delta(new, old)}')
+    for route, stats in current['latency'].items():
+        base = baseline['latency'].get(route, {})
+        for key in ('p50_ms', 'p95_ms'):
+            new, old = stats[key], base.get(key)
+            lines.append(f'{route + " " + key:<28}{old if old is not None else "-":>12}{new:>12}  {delta(new, old)}')
+    new, old = current['db']['lock_errors'], baseline['db']['lock_errors']
+    lines.append(f'{"db lock_errors":<28}{old:>12}{new:>12}')
+    pool_keys = (
+        ('pool_checked_out_peak', 'db pool peak'),
+        ('connection_hold_p99_s_bucket', 'db hold p99 (s)'),
+        ('connection_hold_max_s_bucket', 'db hold max (s)'),
+    )
+    for key, label in pool_keys:
+        new, old = current['db'].get(key), baseline['db'].get(key)
+        lines.append(f'{label:<28}{old if old is not None else "-":>12}{new if new is not None else "-":>12}')
+    base_queries = baseline['db'].get('queries_per_request', {})
+    for endpoint, new in current['db'].get('queries_per_request', {}).items():
+        old = base_queries.get(endpoint)
+        lines.append(f'{endpoint + " queries":<28}{old if old is not None else "-":>12}{new:>12}  {delta(new, old)}')
+    new = current.get('metrics_overhead', {}).get('p95_ms_bucket')
+    old = baseline.get('metrics_overhead', {}).get('p95_ms_bucket')
+    lines.append(f'{"metrics overhead p95 (ms)":<28}{old if old is not None else "-":>12}{new if new is not None else "-":>12}')
+    new, old = current['memory']['peak_rss_mb'], baseline['memory']['peak_rss_mb']
+    lines.append(f'{"peak_rss_mb (srv+browsers)":<28}{old if old is not None else "-":>12}{new if new is not None else "-":>12}  {delta(new, old)}')
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the task platform over HTTP.')
+    parser.add_argument('--browsers', type=int, default=10, help='Simulated browser sessions')
+    parser.add_argument('--duration', type=float, default=60, help='Benchmark length in seconds')
+    parser.add_argument('--poll-interval', type=float, default=5, help='Dashboard poll interval (s)')
+    parser.add_argument('--submit-interval', type=float, default=20,
+                        help='Mean seconds between submissions per browser')
+    parser.add_argument('--task-duration', type=float, nargs=2, default=(1, 5), metavar=('MIN', 'MAX'),
+                        help='Stub task runtime range in seconds')
+    parser.add_argument('--output-kb', type=int, default=256, help='Stub output size per task (KiB)')
+    parser.add_argument('--output-files', type=int, default=4, help='Stub output files per task')
+    parser.add_argument('--upload-kb', type=int, default=64, help='Uploaded payload size (KiB)')
+    parser.add_argument('--admin-interval', type=float, default=10,
+                        help='Seconds between admin page loads (0 disables)')
+    parser.add_argument('--threads', type=int, default=8, help='Waitress worker threads')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed')
+    parser.add_argument('--workdir', default=None, help='Scratch directory (default: temporary)')
+    parser.add_argument('--output', default=None, help='Write results JSON to this file')
+    parser.add_argument('--compare', default=None, help='Baseline results JSON to compare with')
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    result = run_benchmark(args)
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('\n'.join(compare(result, baseline)))
+    overhead = result['metrics_overhead']
+    if overhead['p95_ms_bucket'] is not None and overhead['p95_ms_bucket'] > overhead['budget_ms']:
+        raise SystemExit(f'Instrumentation overhead p95 is up to {overhead["p95_ms_bucket"]} ms, '
+                         f'over METRICS_OVERHEAD_BUDGET_MS={overhead["budget_ms"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Create tasks from submitted parameters, shared by the form and the API.
+
+Submitting happens in two steps so that many tasks can be created in
+one transaction: :func:`create_task` validates the inputs, adds the task
+to the session as ``WAITING`` and saves its uploads, then
+:func:`queue_tasks` commits and queues every task whose inputs are ready.
+"""
+import os
+
+from werkzeug.utils import secure_filename
+
+from .config_utils import task_output_dir
+from .models import db, Task
+from .pipeline import InputError, link_file, resolve_refs, settle
+
+
+def file_params(conf):
+    """Names of the plugin's file parameters."""
+    return [n for n, p in conf.get('params_def', {}).items() if p.get('type') == 'file']
+
+
+def check_inputs(conf, uploads, refs, user):
+    """Validate the file inputs of one task.
+
+    Every file parameter needs an upload in ``uploads`` or a
+    ``<task_id>:<filename>`` reference in ``refs``.  Returns
+    ``(input_refs, parent_ids)`` as :func:`~service.pipeline.resolve_refs`.
+    """
+    for name in file_params(conf):
+        if name not in refs and not getattr(uploads.get(name), 'filename', ''):
+            raise InputError(f'No file uploaded for {name}')
+    return resolve_refs(refs, user)
+
+
+def create_task(user, task_type, conf, values, uploads, refs, saved=None):
+    """Add a task to the session with its uploads saved.
+
+    ``values`` holds the other parameters.  Inputs must have been checked
+    by :func:`check_inputs`.  ``saved`` maps uploads already written for
+    another task to their path, so an upload shared by several tasks is
+    stored once and hard-linked into the other output directories.
+    """
+    input_refs, parents = resolve_refs(refs, user)
+    task = Task(
+        user_id=user.id, task_type=task_type, parameters={}, status='WAITING',
+        input_refs=input_refs or None, parents=parents or None,
+    )
+    db.session.add(task)
+    db.session.flush()
+    saved = {} if saved is None else saved
+    params = {}
+    for name in file_params(conf):
+        if name in refs:
+            continue
+        uploaded = uploads[name]
+        output_dir = task_output_dir(task.id)
+        os.makedirs(output_dir, exist_ok=True)
+        filename = secure_filename(uploaded.filename)
+        path = os.path.join(output_dir, filename)
+        if id(uploaded) in saved:
+            link_file(saved[id(uploaded)], path)
+        else:
+            uploaded.save(path)
+            saved[id(uploaded)] = path
+        params[name] = filename
+        task.input_bytes = (task.input_bytes or 0) + os.path.getsize(path)
+    params.update(values)
+    task.parameters = params
+    return task
+
+
+def queue_tasks(tasks):
+    """Commit tasks from :func:`create_task` and queue those that are ready.
+
+    Tasks with parents stay ``WAITING`` until their parents succeed.
+    Returns the ids of the queued tasks.
+    """
+    for task in tasks:
+        if not task.parents:
+            task.status = 'PENDING'
+    db.session.commit()
+    ready = [task.id for task in tasks if not task.parents]
+    ready += [task.id for task in tasks if task.parents and settle(task)]
+    if ready:
+        from .tasks import schedule_tasks
+        schedule_tasks(len(ready))
+    return ready
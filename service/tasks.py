@@ -1,104 +1,540 @@
-"""Background task execution utilities using :mod:`flask_executor`."""
+"""Background task execution utilities using :mod:`flask_executor`.
+
+A process started with ``PROCESS_ROLE=all`` (the default) serves HTTP
+and runs tasks in its own executor.  With separate roles (see
+:mod:`service.serve`) web processes only insert ``PENDING`` tasks, and
+worker processes register in the worker table like remote workers, run
+:func:`dispatch` and start the tasks assigned to them
+(:func:`work_assigned`).  The roles share nothing but the database and
+the outputs directory.
+"""
 import os
 import json
-import subprocess
-import html
-import fnmatch
+import shutil
+import threading
+import time
 from datetime import datetime
 
-from .config_utils import load_config
+from .config_utils import load_config, task_output_dir
+from .execution import (
+    LOG_FILE, CancelToken, ResultWatcher, build_command, directory_size,
+    run_command, select_result_files, write_error_report,
+)
+
+from flask import current_app, has_request_context
+from .models import db, Task, bump_task_version
+from .metrics import EXECUTOR_BUSY, TASK_DURATION, TASKS_SCHEDULED
+from . import runner_host, runtime_model
+from .pipeline import release_dependents
+from .scheduler import UserPolicy, pick_next
+from .worker_registry import free_slots, live_workers, pick_worker
+
+
+# Minimum seconds between progress updates written to the database
+PROGRESS_INTERVAL = 2.0
+
 
-from .flask_app import app, executor
-from flask import has_request_context
-from .models import db, Task
+# Tasks handed to the local executor that have not finished yet, with the
+# tokens used to cancel them, and those cancelled only to be requeued
+_local_tasks = set()
+_cancel_tokens = {}
+_preempted = set()
+_dispatch_lock = threading.Lock()
 
 
-def run_task(task_id):
+def run_task(task_id, app):
     """Execute a user-submitted script in a virtual environment."""
-    # Use application context when running in a background thread
+    EXECUTOR_BUSY.inc()
+    try:
+        _run_task(task_id, app)
+    finally:
+        EXECUTOR_BUSY.dec()
+        with _dispatch_lock:
+            _local_tasks.discard(task_id)
+            _preempted.discard(task_id)
+            token = _cancel_tokens.pop(task_id, None)
+        if token is not None:
+            token.finished.set()
+        # A slot was freed; start the next queued task
+        with app.app_context():
+            dispatch()
+
+
+def _run_task(task_id, app):
+    # Use application context when running in a background thread.  The
+    # database is only used in short transactions (start, progress, finish)
+    # so no pooled connection is held while the runner executes.
     with app.app_context():
-        task = db.session.get(Task, task_id)
-        if not task:
+        token = _cancel_tokens.get(task_id)
+        started = _start_task(task_id)
+        if started is None:
+            return
+        task_type, parameters = started
+        if token is not None and token.cancelled:
+            _finish_run(task_id, None, {})
             return
-
-        # Update task status and start time
-        task.status = 'RUNNING'
-        # Use server local time for consistency with displayed timestamps
-        task.start_time = datetime.now()
-        db.session.commit()
 
         config = load_config()
-        task_conf = config.get(task.task_type, {})
-        # expand user and resolve absolute paths for Python executable and script
-        from flask import current_app
-        venv_python = os.path.expanduser(task_conf.get('venv_python', 'python'))
-        if venv_python == 'python':
-            import sys
-            venv_python = sys.executable
-        script_rel = task_conf.get('script_path')
-        script_path = os.path.join(current_app.root_path, script_rel) if script_rel else None
-
-        # Determine absolute path for the task's output directory.  The project
-        # root is one level above the ``service`` package, so join that with
-        # ``outputs/<task_id>`` to ensure paths are consistent regardless of the
+        task_conf = config.get(task_type, {})
+
+        # Absolute output directory so paths are consistent regardless of the
         # current working directory.
-        base_dir = os.path.dirname(current_app.root_path)
-        output_dir = os.path.join(base_dir, 'outputs', str(task.id))
+        output_dir = task_output_dir(task_id)
         os.makedirs(output_dir, exist_ok=True)
 
         # Prepare command arguments
-        params = json.loads(task.parameters)
-        cmd = [venv_python, script_path]
-        for key, value in params.items():
-            cmd += [f'--{key}', str(value)]
+        cmd = build_command(task_conf, parameters, current_app.root_path)
+
+        def on_progress(percent, message):
+            progress[:] = [percent, message[:255]]
+            # Throttle writes so chatty runners do not hammer the database;
+            # the latest value is always saved with the final status.
+            now = time.monotonic()
+            if now - last_progress[0] >= PROGRESS_INTERVAL:
+                last_progress[0] = now
+                _save_progress(task_id, *progress)
 
+        progress = []
+        last_progress = [0.0]
+        result = None
+        watcher = _watch_results(app, task_id, task_conf)
+        # Return the connection to the pool before the runner starts
+        db.session.close()
         try:
-            # Run the external script and capture output for error reporting
-            result = subprocess.run(
-                cmd, cwd=output_dir, capture_output=True, text=True
-            )
-            status = 'SUCCESS' if result.returncode == 0 else 'FAILURE'
-            if status == 'FAILURE':
-                error_file = os.path.join(output_dir, 'error.html')
-                with open(error_file, 'w') as f:
-                    f.write('<html><body><pre>')
-                    f.write(html.escape((result.stdout or '') + (result.stderr or '')))
-                    f.write('</pre></body></html>')
+            # Stream the script's output to run.log keeping only a bounded tail
+            try:
+                result = run_command(
+                    cmd, output_dir, os.path.join(output_dir, LOG_FILE),
+                    on_progress=on_progress,
+                    max_bytes=current_app.config['LOG_MAX_BYTES'],
+                    backups=current_app.config['LOG_BACKUPS'],
+                    limits=task_conf.get('limits'),
+                    cancel=token,
+                    host=runner_host.pool.get(task_conf, cmd),
+                )
+            finally:
+                # The final file list is written when the task finishes
+                if watcher is not None:
+                    watcher.stop()
+            if token is not None and token.cancelled:
+                status = None
+            else:
+                status = 'SUCCESS' if result.returncode == 0 else 'FAILURE'
+                if status == 'FAILURE':
+                    write_error_report(output_dir, result.output)
         except Exception as exc:
             # Unexpected exceptions are also reported as FAILURE
             status = 'FAILURE'
-            error_file = os.path.join(output_dir, 'error.html')
-            with open(error_file, 'w') as f:
-                f.write('<html><body><pre>')
-                f.write(html.escape(str(exc)))
-                f.write('</pre></body></html>')
+            write_error_report(output_dir, str(exc))
+
+        _finish_run(task_id, status, task_conf, result, progress)
+
 
+def _start_task(task_id):
+    """Mark a dispatched task ``RUNNING`` and return its plugin and parameters.
+
+    Returns ``None`` when the task was cancelled or deleted since it was
+    dispatched.  The transaction is committed before returning.
+    """
+    # Only start tasks nobody cancelled since they were dispatched
+    started = Task.query.filter_by(
+        id=task_id, status='PENDING', worker=current_app.config.get('WORKER_NAME'),
+    ).update({
+        'status': 'RUNNING',
+        # Use server local time for consistency with displayed timestamps
+        'start_time': datetime.now(),
+    })
+    row = None
+    if started:
+        bump_task_version(db.session, task_ids=[task_id])
+        row = db.session.query(Task.task_type, Task.parameters).filter(Task.id == task_id).first()
+    db.session.commit()
+    return tuple(row) if row is not None else None
+
+
+def _save_progress(task_id, percent, message):
+    """Record the progress of a running task in its own transaction."""
+    try:
+        updated = Task.query.filter_by(id=task_id, status='RUNNING').update(
+            {'progress': percent, 'progress_message': message}, synchronize_session=False,
+        )
+        if updated:
+            bump_task_version(db.session, task_ids=[task_id])
+        db.session.commit()
+    except Exception:  # pragma: no cover - the final progress is saved with the status
+        db.session.rollback()
+        current_app.logger.exception('Saving progress of task %s failed', task_id)
+
+
+def _finish_run(task_id, status, task_conf, result=None, progress=()):
+    """Record the outcome of a local run; ``status`` is ``None`` when it was cancelled."""
+    task = db.session.get(Task, task_id)
+    if task is None or task.status != 'RUNNING' or task.worker != current_app.config.get('WORKER_NAME'):
+        # Deleted, or cancelled or requeued by another process, while it ran
+        _remove_deleted(task)
+        return
+    if progress:
+        task.progress, task.progress_message = progress
+    if result is not None:
+        task.cpu_time = result.cpu_time
+        task.peak_rss_kb = result.peak_rss_kb
+    if status is None:
+        _finish_cancelled(task, task_conf)
+    else:
+        finish_task(task, status, task_conf)
+    _remove_deleted(task)
+
+
+def _remove_deleted(task):
+    """Remove the outputs of a task the user deleted while it ran.
+
+    ``delete_task`` leaves them to the runner so they are only removed
+    once nothing writes to them any more.
+    """
+    if task is None or not task.archived or task.status != 'CANCELLED':
+        return
+    shutil.rmtree(task_output_dir(task.id), ignore_errors=True)
+    task.set_result_files([])
+    db.session.commit()
+
+
+def _watch_results(app, task_id, task_conf):
+    """Publish the task's finished result files while it runs.
+
+    Only for plugins with ``publish_partial: true``, whose runners write
+    ``<name>.part`` and rename it once complete.  The file list is saved
+    from the watcher's own session so the run's session is not shared
+    between threads.
+    """
+    interval = app.config['PUBLISH_INTERVAL']
+    if not task_conf.get('publish_partial') or interval <= 0:
+        return None
+
+    def publish(files):
+        with app.app_context():
+            try:
+                running = db.session.get(Task, task_id)
+                if running is not None and running.status == 'RUNNING':
+                    running.set_result_files(files)
+                    db.session.commit()
+            except Exception:  # pragma: no cover - finish_task writes the final list
+                db.session.rollback()
+                app.logger.exception('Publishing results of task %s failed', task_id)
+
+    return ResultWatcher(task_output_dir(task_id), task_conf.get('result_keep'), publish, interval).start()
+
+
+def _finish_cancelled(task, task_conf):
+    """Record the end of a local run stopped by :func:`cancel_task`."""
+    if task.id in _preempted:
+        task.requeue()
+        db.session.commit()
+    else:
+        finish_task(task, 'CANCELLED', task_conf)
+
+
+def finish_task(task, status, task_conf):
+    """Publish a task's results and record its final ``status``.
+
+    Shared by local execution and remote workers, whose outputs have been
+    uploaded to ``outputs/<task_id>/`` by the time this is called.  Returns
+    ``False`` without changing anything when the task is no longer
+    ``RUNNING``, e.g. because it was cancelled meanwhile.
+    """
+    # Conditional so a cancellation committed by another request wins
+    updated = Task.query.filter_by(id=task.id, status='RUNNING').update(
+        {'status': status}, synchronize_session=False,
+    )
+    if not updated:
+        db.session.rollback()
+        return False
+    output_dir = task_output_dir(task.id)
+    files = []
+    # The directory is gone when a running task was deleted
+    if os.path.isdir(output_dir):
         # Generate result.json with list of output files and status
-        files = os.listdir(output_dir)
-        keep_patterns = task_conf.get("result_keep")
-        if keep_patterns:
-            kept = set()
-            for pat in keep_patterns:
-                kept.update(fnmatch.filter(files, pat))
-            files = sorted(kept)
-        result = {'files': files, 'status': status}
+        files = select_result_files(output_dir, task_conf.get('result_keep'))
         with open(os.path.join(output_dir, 'result.json'), 'w') as f:
-            json.dump(result, f)
+            json.dump({'files': files, 'status': status}, f)
+
+    # Update task record with outcome and completion time
+    task.status = status
+    if status == 'SUCCESS':
+        task.progress = 100
+    task.set_result_files(files)
+    task.output_bytes = directory_size(output_dir)
+    # Record completion time in server local timezone
+    task.end_time = datetime.now()
+    db.session.commit()
+    release_dependents(task)
+    runtime_model.observe(task)
+    if task.start_time:
+        TASK_DURATION.observe(
+            (task.end_time - task.start_time).total_seconds(), task.task_type, status
+        )
+    return True
+
+
+def _in_process():
+    """Whether this process runs tasks in its executor without a worker row."""
+    return current_app.config['PROCESS_ROLE'] == 'all'
 
-        # Update task record with outcome and completion time
-        task.status = status
-        task.result_files = json.dumps(files)
-        # Record completion time in server local timezone
-        task.end_time = datetime.now()
+
+def _use_workers():
+    """Whether tasks may be handed to remote workers or worker processes."""
+    return bool(current_app.config.get('WORKER_TOKEN')) or not _in_process()
+
+
+def active_tasks():
+    """Tasks holding a slot: running locally or dispatched to a worker."""
+    tasks = Task.query.filter(Task.status.in_(('PENDING', 'RUNNING'))).all()
+    return [t for t in tasks if t.worker is not None or t.id in _local_tasks]
+
+
+def queued_tasks():
+    """Tasks waiting for the scheduler to give them a slot."""
+    tasks = Task.query.filter_by(status='PENDING', worker=None, archived=False).order_by(Task.id).all()
+    return [t for t in tasks if t.id not in _local_tasks]
+
+
+def total_slots():
+    """Local slots plus the capacity of live remote workers."""
+    slots = current_app.config['LOCAL_SLOTS'] if _in_process() else 0
+    if _use_workers():
+        slots += sum(w.capacity for w in live_workers())
+    return slots
+
+
+def dispatch():
+    """Start queued tasks in scheduling order while slots are free.
+
+    Tasks go to a live remote worker with room for their plugin, otherwise
+    to a free local slot; tasks that fit nowhere stay queued.  Returns the
+    ids of the started tasks.
+    """
+    started = []
+    with _dispatch_lock:
+        candidates = queued_tasks()
+        if not candidates:
+            return started
+        active = active_tasks()
+        running = {}
+        for task in active:
+            running[task.user_id] = running.get(task.user_id, 0) + 1
+        local_free = current_app.config['LOCAL_SLOTS'] - len(_local_tasks) if _in_process() else 0
+        policy = UserPolicy([t.user_id for t in candidates])
+        slots = free_slots() if _use_workers() else {}
+        while candidates:
+            if local_free <= 0:
+                # Only plugins a worker still has room for can start
+                open_types = {p for plugins, free in slots.values() if free > 0 for p in plugins}
+                candidates = [t for t in candidates if t.task_type in open_types]
+                if not candidates:
+                    break
+            task = pick_next(candidates, running, policy)
+            if task is None:
+                break
+            candidates.remove(task)
+            worker = pick_worker(task.task_type, slots) if slots else None
+            if worker is not None:
+                # The worker claims the task on its next poll.  Conditional so
+                # processes dispatching at once never assign it twice.
+                assigned = Task.query.filter_by(id=task.id, status='PENDING', worker=None).update(
+                    {'worker': worker}, synchronize_session=False,
+                )
+                if not assigned:
+                    slots[worker][1] += 1
+                    continue
+            elif local_free > 0:
+                local_free -= 1
+                _local_tasks.add(task.id)
+                _cancel_tokens[task.id] = CancelToken(current_app.config['CANCEL_GRACE_SECONDS'])
+                _submit(task.id)
+            else:
+                continue
+            running[task.user_id] = running.get(task.user_id, 0) + 1
+            started.append(task.id)
+        # One commit for all assignments; committing each would expire and
+        # reload every candidate
         db.session.commit()
+    return started
 
 
-def schedule_task(task_id):
-    """Submit ``run_task`` to the :class:`~flask_executor.Executor`."""
+def cancel_task(task, requeue=False):
+    """Stop a waiting, pending or running task.
+
+    Local runners are asked to terminate and killed after
+    ``CANCEL_GRACE_SECONDS``; remote workers stop the task on their next
+    heartbeat.  With ``requeue`` the task goes back to the queue instead of
+    ending as ``CANCELLED``.  Returns the :class:`CancelToken` of a local
+    run, whose ``finished`` event is set once the runner is gone, or
+    ``None``.
+    """
+    with _dispatch_lock:
+        if task.status not in ('PENDING', 'RUNNING', 'WAITING'):
+            return None
+        token = _cancel_tokens.get(task.id)
+        if token is not None:
+            # Running (or about to run) locally; run_task records the outcome
+            if requeue:
+                _preempted.add(task.id)
+            token.cancel()
+            return token
+        if requeue:
+            task.requeue()
+            db.session.commit()
+        elif task.worker is not None and task.status == 'RUNNING':
+            finish_task(task, 'CANCELLED', load_config(enabled_only=False).get(task.task_type, {}))
+        else:
+            task.status = 'CANCELLED'
+            task.end_time = datetime.now()
+            db.session.commit()
+            release_dependents(task)
+    return None
+
+
+def preempt_for(task):
+    """Free a slot for ``task`` by requeueing the lowest-priority running task.
+
+    Only tasks with a lower priority than ``task`` that run where ``task``
+    could run are considered.  Returns the preempted task or ``None``.
+    """
+    if task.id in dispatch():
+        return None
+    supported = set()
+    if _use_workers():
+        supported = {w.name for w in live_workers() if task.task_type in (w.plugins or [])}
+    victims = [
+        t for t in active_tasks()
+        if t.status == 'RUNNING'
+        and (t.priority or 0) < (task.priority or 0)
+        and (t.worker is None or t.worker in supported)
+    ]
+    if not victims:
+        return None
+    # Lowest priority first, then the one that has done the least work
+    victim = min(victims, key=lambda t: (t.priority or 0, -(t.start_time or datetime.now()).timestamp()))
+    cancel_task(victim, requeue=True)
+    dispatch()
+    return victim
+
+
+def _submit(task_id):
+    app = current_app._get_current_object()
+    executor = app.extensions['executor']
     if has_request_context():
-        return executor.submit(run_task, task_id)
+        return executor.submit(run_task, task_id, app)
     # When called outside a request context (e.g., stress tests), using
     # ``Executor.submit`` fails because it wraps the function with
     # ``copy_current_request_context``. Submit directly to the underlying
     # executor instead.
-    return executor._self.submit(run_task, task_id)
+    return executor._self.submit(run_task, task_id, app)
+
+
+def schedule_task(task_id):
+    """Queue a task and start whatever the scheduler allows to run now.
+
+    The task stays ``PENDING`` until :func:`dispatch` gives it a slot; see
+    :mod:`service.scheduler` for the order in which queued tasks start.
+    """
+    return schedule_tasks(1)
+
+
+def schedule_tasks(count):
+    """Count ``count`` newly queued tasks and dispatch once for all of them.
+
+    Web processes only count them; worker processes pick them up within
+    ``DISPATCH_INTERVAL`` seconds.
+    """
+    TASKS_SCHEDULED.inc(amount=count)
+    if current_app.config['PROCESS_ROLE'] == 'web':
+        return []
+    return dispatch()
+
+
+def work_assigned(name):
+    """Run the tasks assigned to worker process ``name`` and stop lost ones.
+
+    Tasks that were cancelled, requeued or reassigned by another process
+    since they started here have their runners cancelled.  Returns the
+    ids of the started tasks.
+    """
+    assigned = [task_id for (task_id,) in db.session.query(Task.id).filter(
+        Task.worker == name, Task.status == 'PENDING',
+    ).order_by(Task.id)]
+    started = []
+    with _dispatch_lock:
+        for task_id in assigned:
+            if task_id in _local_tasks:
+                continue
+            _local_tasks.add(task_id)
+            _cancel_tokens[task_id] = CancelToken(current_app.config['CANCEL_GRACE_SECONDS'])
+            _submit(task_id)
+            started.append(task_id)
+        running = list(_local_tasks)
+    if running:
+        owned = {task_id for (task_id,) in db.session.query(Task.id).filter(
+            Task.id.in_(running), Task.worker == name, Task.status.in_(('PENDING', 'RUNNING')),
+        )}
+        for task_id in set(running) - owned:
+            token = _cancel_tokens.get(task_id)
+            if token is not None and not token.cancelled:
+                token.cancel()
+    db.session.commit()
+    return started
+
+
+def release_assigned(name):
+    """Requeue the tasks of worker process ``name`` and stop its runners."""
+    tasks = Task.query.filter(Task.worker == name, Task.status.in_(('PENDING', 'RUNNING'))).all()
+    for task in tasks:
+        task.requeue()
+    db.session.commit()
+    with _dispatch_lock:
+        tokens = list(_cancel_tokens.values())
+    for token in tokens:
+        token.cancel()
+    for token in tokens:
+        token.finished.wait(token.grace + 5)
+
+
+def start_scheduler(app):
+    """Dispatch queued tasks every ``SCHEDULER_INTERVAL`` seconds.
+
+    Picks up tasks left queued by a restart and slots freed by workers.
+    """
+    interval = app.config['SCHEDULER_INTERVAL']
+    if interval <= 0:
+        return None
+
+    def loop():
+        while True:
+            try:
+                with app.app_context():
+                    dispatch()
+            except Exception:  # pragma: no cover - keep the scheduler alive
+                app.logger.exception('Scheduler failed')
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name='scheduler', daemon=True)
+    thread.start()
+    return thread
+
+
+def start_runner_hosts(app):
+    """Start the warm runner hosts of enabled ``mode: host`` plugins.
+
+    Runs in the background so the first task of each plugin does not wait
+    for the host's imports.
+    """
+    def warm():
+        with app.app_context():
+            for name, task_conf in load_config().items():
+                if task_conf.get('mode') == 'host':
+                    cmd = build_command(task_conf, {}, app.root_path)
+                    if runner_host.pool.get(task_conf, cmd) is not None:
+                        app.logger.info('Runner host for %s is ready', name)
+
+    thread = threading.Thread(target=warm, name='runner-hosts', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,53 @@
+"""Short-lived cache of the users behind session cookies.
+
+Flask-Login loads the user of every authenticated request, including
+each dashboard poll and file download.  :func:`get_user` keeps users
+loaded by the session loader for ``USER_CACHE_SECONDS`` (0 disables
+the cache).  Cached users are detached from the database session, so
+only their columns can be used; routes read ``id``, ``username`` and
+``is_admin``.
+
+Administrators are never cached, so admin rights are checked against
+the database on every request and a demoted administrator loses them at
+once in every process.  ``edit_user`` and ``delete_user`` call
+:func:`invalidate`; other web processes keep their copy of a regular
+user until it expires, which bounds how long a deleted user keeps
+access to their own tasks.
+"""
+import threading
+import time
+
+from flask import current_app
+
+from .models import db, User
+
+_users = {}
+_lock = threading.Lock()
+
+
+def get_user(user_id):
+    """Return user ``user_id``, from the cache while it is fresh."""
+    ttl = current_app.config['USER_CACHE_SECONDS']
+    now = time.monotonic()
+    entry = _users.get(user_id)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+    user = db.session.get(User, user_id)
+    if user is None or ttl <= 0 or user.is_admin:
+        return user
+    # Detached so later commits in this or other requests do not expire it
+    db.session.expunge(user)
+    with _lock:
+        for key in [k for k, (expires, _) in _users.items() if expires <= now]:
+            del _users[key]
+        _users[user_id] = (now + ttl, user)
+    return user
+
+
+def invalidate(user_id=None):
+    """Forget ``user_id``, or every cached user."""
+    with _lock:
+        if user_id is None:
+            _users.clear()
+        else:
+            _users.pop(user_id, None)
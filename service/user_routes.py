@@ -1,5 +1,6 @@
 import json
 import os
+from datetime import datetime, timedelta
 from flask import (
     Blueprint, render_template, request, redirect, url_for,
     flash, send_from_directory, abort, current_app
@@ -9,8 +10,16 @@ from flask_login import (
     login_user, login_required, logout_user, current_user
 )
 
-from .models import db, User, Task, AppLayout
-from .config_utils import load_config, get_task_description
+from .models import db, User, Task, TaskArchive, AppLayout, ApiToken
+from .config_utils import load_config, get_task_description, task_output_dir
+from .admission import AdmissionError, admit
+from .archive import restore_task
+from .assets import send_output
+from .pipeline import InputError, output_sources
+from .submission import check_inputs, create_task, file_params, queue_tasks
+from .execution import LOG_FILE, read_log
+from .jobs_cache import jobs_table
+from .worker_registry import is_local
 
 user_bp = Blueprint('user', __name__)
 
@@ -63,10 +72,42 @@ def task_detail(task_type):
             task_type=task_type,
             description=description,
             params=conf.get('params_def', {}),
-            metadata=conf.get('metadata', {})
+            metadata=conf.get('metadata', {}),
+            sources=output_sources(current_user.id, configs),
+            chain_from=request.args.get('from', type=int),
         )
 
 
+def _user_task_rows(user_id):
+    """Return the rows shown in the user's job table."""
+    tasks = Task.query.filter_by(
+        user_id=user_id,
+        archived=False
+    ).order_by(Task.create_time.desc()).all()
+    forecast = _forecast() if any(t.status == 'PENDING' for t in tasks) else {}
+    return [
+        {'task': t, 'files': t.download_files, 'html_file': t.html_file,
+         'queue': forecast.get(t.id), 'eta': _task_eta(t, forecast)}
+        for t in tasks
+    ]
+
+
+def _forecast():
+    from .scheduler import queue_forecast
+    from .tasks import active_tasks, queued_tasks, total_slots
+    return queue_forecast(queued_tasks(), active_tasks(), total_slots())
+
+
+def _task_eta(task, forecast):
+    """Return the predicted end time of a pending or running task."""
+    if task.id in forecast:
+        return forecast[task.id][2]
+    if task.status == 'RUNNING' and task.start_time:
+        from .runtime_model import predict
+        return max(datetime.now(), task.start_time + timedelta(seconds=predict(task)))
+    return None
+
+
 @user_bp.route('/dashboard', endpoint='dashboard')
 @login_required
 def dashboard():
@@ -104,20 +145,8 @@ def dashboard():
         for row in layout_names
     ]
 
-    tasks_query = Task.query.filter_by(
-        user_id=current_user.id,
-        archived=False
-    ).order_by(Task.create_time.desc()).all()
-    tasks_data = []
-    for t in tasks_query:
-        files = json.loads(t.result_files) if t.result_files else []
-        html_file = next((f for f in files if f.lower().endswith('.html')), None)
-        if html_file:
-            files = [f for f in files if f != html_file]
-        tasks_data.append({'task': t, 'files': files, 'html_file': html_file})
-    return render_template('dashboard.html', tasks=tasks_data, ordered_rows=ordered_rows)
-
-
+    jobs = jobs_table(current_user.id, _user_task_rows)
+    return render_template('dashboard.html', jobs=jobs, ordered_rows=ordered_rows)
 
 
 @user_bp.route('/dashboard/jobs', endpoint='dashboard_jobs')
@@ -125,19 +154,16 @@ def dashboard():
 def dashboard_jobs():
     if current_user.is_admin:
         return redirect(url_for('admin.admin_tasks'))
-    configs = load_config()
-    tasks_query = Task.query.filter_by(
-        user_id=current_user.id,
-        archived=False
-    ).order_by(Task.create_time.desc()).all()
-    tasks_data = []
-    for t in tasks_query:
-        files = json.loads(t.result_files) if t.result_files else []
-        html_file = next((f for f in files if f.lower().endswith('.html')), None)
-        if html_file:
-            files = [f for f in files if f != html_file]
-        tasks_data.append({'task': t, 'files': files, 'html_file': html_file})
-    return render_template('_jobs_table.html', tasks=tasks_data, configs=configs)
+    jobs = jobs_table(current_user.id, _user_task_rows)
+    response = current_app.make_response(jobs.html)
+    # Browsers revalidate with If-None-Match and get 304 while unchanged
+    response.set_etag(jobs.etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+
+def _wait_text(seconds):
+    return f'{seconds // 60} minute(s)' if seconds >= 120 else f'{seconds} seconds'
 
 
 @user_bp.route('/submit/<task_type>', methods=['POST'], endpoint='submit_task')
@@ -149,81 +175,181 @@ def submit_task(task_type):
     if task_type not in configs:
         abort(404)
     conf = configs[task_type]
-    params = {}
-    file_params = [n for n, p in conf.get('params_def', {}).items() if p.get('type') == 'file']
-    non_file_params = [n for n in conf.get('params_def', {}) if n not in file_params]
+    # File inputs are either uploaded or taken from another task's outputs
+    refs = {fp: request.form[f'{fp}__from'] for fp in file_params(conf) if request.form.get(f'{fp}__from')}
+    try:
+        admit(current_user, [task_type], configs)
+        check_inputs(conf, request.files, refs, current_user)
+    except AdmissionError as exc:
+        flash(f'{exc}. Please try again in {_wait_text(exc.retry_after)}.')
+        return redirect(url_for('user.task_detail', task_type=task_type))
+    except InputError as exc:
+        flash(str(exc))
+        return redirect(url_for('user.task_detail', task_type=task_type))
+    values = {name: request.form.get(name) for name in conf.get('params_def', {})
+              if name not in file_params(conf)}
+    task = create_task(current_user, task_type, conf, values, request.files, refs)
+    queue_tasks([task])
+    return redirect(url_for('user.dashboard'))
 
-    if file_params:
-        new_task = Task(user_id=current_user.id, task_type=task_type, parameters=json.dumps({}))
-        db.session.add(new_task)
-        db.session.commit()
-        base_dir = os.path.dirname(current_app.root_path)
-        output_dir = os.path.join(base_dir, 'outputs', str(new_task.id))
-        os.makedirs(output_dir, exist_ok=True)
-        from werkzeug.utils import secure_filename
-        for fp in file_params:
-            uploaded = request.files.get(fp)
-            if not uploaded or uploaded.filename == '':
-                flash('No file uploaded')
-                return redirect(url_for('user.task_detail', task_type=task_type))
-            filename = secure_filename(uploaded.filename)
-            uploaded.save(os.path.join(output_dir, filename))
-            params[fp] = filename
-    else:
-        new_task = Task(user_id=current_user.id, task_type=task_type, parameters=json.dumps({}))
-        db.session.add(new_task)
-        db.session.commit()
 
-    for pname in non_file_params:
-        params[pname] = request.form.get(pname)
+def _task_files_dir(task_id):
+    """Return the output directory of a task the current user may read.
 
-    new_task.parameters = json.dumps(params)
-    db.session.commit()
-    from .tasks import schedule_task
-    schedule_task(new_task.id)
-    return redirect(url_for('user.dashboard'))
+    Archived tasks are restored from cold storage on first access.
+    """
+    task = db.session.get(Task, task_id)
+    if task is None:
+        task = TaskArchive.query.get_or_404(task_id)
+    if task.user_id != current_user.id and not current_user.is_admin:
+        abort(403)
+    if isinstance(task, TaskArchive):
+        return restore_task(task)
+    return task_output_dir(task_id)
 
 
 @user_bp.route('/download/<int:task_id>/<path:filename>', endpoint='download_file')
 @login_required
 def download_file(task_id, filename):
-    task = Task.query.get_or_404(task_id)
-    if task.user_id != current_user.id and not current_user.is_admin:
-        abort(403)
-    base_dir = os.path.dirname(current_app.root_path)
-    directory = os.path.join(base_dir, 'outputs', str(task_id))
+    directory = _task_files_dir(task_id)
     return send_from_directory(directory, filename, as_attachment=True)
 
 
 @user_bp.route('/view/<int:task_id>/<path:filename>', endpoint='view_file')
 @login_required
 def view_file(task_id, filename):
+    directory = _task_files_dir(task_id)
+    return send_output(directory, filename)
+
+
+@user_bp.route('/tail/<int:task_id>', endpoint='tail_log')
+@login_required
+def tail_log(task_id):
+    """Return new runner output after ``offset`` plus the task's progress."""
+    task = Task.query.get_or_404(task_id)
+    if task.user_id != current_user.id and not current_user.is_admin:
+        abort(403)
+    offset = request.args.get('offset', 0, type=int)
+    log_path = os.path.join(task_output_dir(task_id), LOG_FILE)
+    data, offset = read_log(log_path, offset)
+    return {
+        'data': data,
+        'offset': offset,
+        'status': task.status,
+        'progress': task.progress,
+        'progress_message': task.progress_message,
+    }
+
+
+@user_bp.route('/eta/<int:task_id>', endpoint='task_eta')
+@login_required
+def task_eta(task_id):
+    """Return the predicted runtime, queue position and ETA of a task."""
+    from .runtime_model import predict
+
     task = Task.query.get_or_404(task_id)
     if task.user_id != current_user.id and not current_user.is_admin:
         abort(403)
-    base_dir = os.path.dirname(current_app.root_path)
-    directory = os.path.join(base_dir, 'outputs', str(task_id))
-    return send_from_directory(directory, filename, as_attachment=False)
+    forecast = _forecast() if task.status == 'PENDING' else {}
+    queue = forecast.get(task.id)
+    eta = _task_eta(task, forecast)
+    return {
+        'id': task.id,
+        'status': task.status,
+        'expected_seconds': round(predict(task), 1),
+        'queue_position': queue[0] if queue else None,
+        'expected_start': queue[1].isoformat(timespec='seconds') if queue else None,
+        'expected_end': eta.isoformat(timespec='seconds') if eta else None,
+    }
+
+
+@user_bp.route('/estimate/<task_type>', endpoint='estimate_runtime')
+@login_required
+def estimate_runtime(task_type):
+    """Predict the runtime of a plugin for the parameters in the query string.
+
+    ``input_bytes`` gives the total size of the files that would be uploaded.
+    """
+    from .runtime_model import predict, summaries
+
+    if task_type not in load_config():
+        abort(404)
+    params = request.args.to_dict()
+    input_bytes = params.pop('input_bytes', None)
+    task = Task(
+        task_type=task_type, parameters=params,
+        input_bytes=int(input_bytes) if input_bytes and input_bytes.isdigit() else None,
+    )
+    model = summaries().get(task_type, {'samples': 0, 'method': 'default', 'features': []})
+    return dict(model, task_type=task_type, expected_seconds=round(predict(task), 1))
+
+
+@user_bp.route('/log/<int:task_id>', endpoint='task_log')
+@login_required
+def task_log(task_id):
+    """Show the live output of a task."""
+    task = Task.query.get_or_404(task_id)
+    if task.user_id != current_user.id and not current_user.is_admin:
+        abort(403)
+    return render_template('task_log.html', task=task)
+
+
+@user_bp.route('/dashboard/archive', endpoint='archived_tasks')
+@login_required
+def archived_tasks():
+    """List the user's tasks that were moved to cold storage."""
+    if current_user.is_admin:
+        return redirect(url_for('admin.admin_tasks'))
+    entries = TaskArchive.query.filter_by(
+        user_id=current_user.id,
+        archived=False
+    ).order_by(TaskArchive.create_time.desc()).all()
+    tasks_data = [
+        {'task': t, 'files': t.download_files, 'html_file': t.html_file}
+        for t in entries
+    ]
+    return render_template('archived_tasks.html', tasks=tasks_data)
+
+
+@user_bp.route('/cancel/<int:task_id>', methods=['POST'], endpoint='cancel_task')
+@login_required
+def cancel_task(task_id):
+    """Stop a pending or running task and end it as CANCELLED."""
+    from .tasks import cancel_task as cancel
+
+    task = Task.query.get_or_404(task_id)
+    if task.user_id != current_user.id and not current_user.is_admin:
+        abort(403)
+    cancel(task)
+    flash(f'Task {task_id} cancelled')
+    if current_user.is_admin:
+        return redirect(url_for('admin.admin_tasks'))
+    return redirect(url_for('user.dashboard'))
 
 
 @user_bp.route('/delete/<int:task_id>', methods=['POST'], endpoint='delete_task')
 @login_required
 def delete_task(task_id):
     """Allow a user to delete their task and its output files."""
+    from .tasks import cancel_task as cancel
+
     task = Task.query.get_or_404(task_id)
     if task.user_id != current_user.id:
         abort(403)
-    base_dir = os.path.dirname(current_app.root_path)
-    output_dir = os.path.join(base_dir, 'outputs', str(task_id))
-    if os.path.exists(output_dir):
-        import shutil
-        try:
-            shutil.rmtree(output_dir)
-        except Exception as exc:  # pragma: no cover - best effort cleanup
-            current_app.logger.warning("Failed to remove %s: %s", output_dir, exc)
     task.archived = True
-    task.result_files = json.dumps([])
+    task.set_result_files([])
     db.session.commit()
+    # Runners of this or another worker process remove the outputs
+    # themselves once they have stopped
+    runs_elsewhere = task.status == 'RUNNING' and is_local(task.worker)
+    if cancel(task) is None and not runs_elsewhere:
+        output_dir = task_output_dir(task_id)
+        if os.path.exists(output_dir):
+            import shutil
+            try:
+                shutil.rmtree(output_dir)
+            except Exception as exc:  # pragma: no cover - best effort cleanup
+                current_app.logger.warning("Failed to remove %s: %s", output_dir, exc)
     flash('Task deleted')
     return redirect(url_for('user.dashboard'))
 
@@ -251,3 +377,29 @@ def save_layout():
         layout_obj.layout = json.dumps(layout_to_save)
     db.session.commit()
     return {'status': 'ok'}
+
+
+@user_bp.route('/tokens', methods=['GET', 'POST'], endpoint='api_tokens')
+@login_required
+def api_tokens():
+    """List, create and revoke the user's JSON API tokens."""
+    from .api_routes import issue_token
+
+    new_token = None
+    if request.method == 'POST':
+        name = (request.form.get('name') or '').strip() or 'API token'
+        new_token = issue_token(current_user, name)
+    tokens = ApiToken.query.filter_by(user_id=current_user.id).order_by(ApiToken.create_time).all()
+    return render_template('api_tokens.html', tokens=tokens, new_token=new_token)
+
+
+@user_bp.route('/tokens/<int:token_id>/delete', methods=['POST'], endpoint='delete_api_token')
+@login_required
+def delete_api_token(token_id):
+    token = ApiToken.query.get_or_404(token_id)
+    if token.user_id != current_user.id:
+        abort(403)
+    db.session.delete(token)
+    db.session.commit()
+    flash('Token revoked')
+    return redirect(url_for('user.api_tokens'))
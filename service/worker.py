@@ -0,0 +1,278 @@
+"""Worker daemon running plugin jobs on another machine.
+
+The worker announces its enabled plugins and capacity to the central
+server, claims the tasks dispatched to it, downloads their input files,
+runs the plugin's runner locally and uploads the results back into
+``outputs/<task_id>/`` on the server::
+
+    python -m service.worker --server http://host:5000 --token SECRET \\
+        --name ws01 --capacity 2 --workdir D:\\sim_worker
+
+The server must be started with the same ``WORKER_TOKEN``.  Plugins are
+taken from this machine's ``apps/`` directory, so the worker needs a
+checkout of the same version as the server.  Several workers with
+different ``--name`` and ``--workdir`` can run on one machine for testing.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from . import runner_host
+from .config_utils import load_config
+from .execution import (
+    LOG_FILE, CancelToken, build_command, read_log, run_command,
+    select_result_files, write_error_report,
+)
+
+log = logging.getLogger('service.worker')
+
+SERVICE_ROOT = os.path.dirname(os.path.abspath(__file__))
+# Seconds between progress/log uploads for a running task
+PROGRESS_INTERVAL = 2.0
+_CHUNK = 1024 * 1024
+
+
+class TaskLost(Exception):
+    """The server reassigned or removed the task this worker is running."""
+
+
+class ServerClient:
+    """Minimal client for the ``/api/workers`` endpoints."""
+
+    def __init__(self, base_url, token, name):
+        self.base_url = base_url.rstrip('/') + '/api/workers'
+        self.headers = {'X-Worker-Token': token, 'X-Worker-Name': name}
+
+    def _open(self, method, path, data=None, headers=None, timeout=60):
+        req = urllib.request.Request(
+            self.base_url + path, data=data, method=method,
+            headers=dict(self.headers, **(headers or {})),
+        )
+        try:
+            return urllib.request.urlopen(req, timeout=timeout)
+        except urllib.error.HTTPError as exc:
+            if exc.code in (404, 409) and path.startswith('/tasks/'):
+                raise TaskLost(path) from exc
+            raise
+
+    def call(self, path, payload=None):
+        """POST ``payload`` as JSON (or GET without one) and decode the reply."""
+        data = None if payload is None else json.dumps(payload).encode()
+        method = 'GET' if payload is None else 'POST'
+        with self._open(method, path, data, {'Content-Type': 'application/json'}) as resp:
+            return json.loads(resp.read() or b'{}')
+
+    def download(self, task_id, name, dest):
+        quoted = urllib.parse.quote(name)
+        with self._open('GET', f'/tasks/{task_id}/files/{quoted}', timeout=600) as resp, \
+                open(dest, 'wb') as f:
+            shutil.copyfileobj(resp, f, _CHUNK)
+
+    def upload(self, task_id, name, path):
+        quoted = urllib.parse.quote(name)
+        with open(path, 'rb') as f:
+            headers = {
+                'Content-Type': 'application/octet-stream',
+                'Content-Length': str(os.path.getsize(path)),
+            }
+            self._open('PUT', f'/tasks/{task_id}/files/{quoted}', f, headers, timeout=600).close()
+
+
+class Worker:
+    """Claims tasks from the server and runs up to ``capacity`` at once."""
+
+    def __init__(self, client, workdir, capacity=1, poll=2.0,
+                 max_bytes=10 * 1024 * 1024, backups=3, grace=10.0):
+        self.client = client
+        self.workdir = os.path.abspath(workdir)
+        self.capacity = capacity
+        self.poll = poll
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.grace = grace
+        self.running = {}
+        self.tokens = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        os.makedirs(self.workdir, exist_ok=True)
+
+    def plugins(self):
+        return sorted(load_config())
+
+    def loop(self):
+        """Heartbeat, claim and start tasks until :meth:`stop` is called."""
+        while not self._stop.is_set():
+            try:
+                with self._lock:
+                    running = list(self.running)
+                reply = self.client.call('/heartbeat', {
+                    'host': socket.gethostname(),
+                    'plugins': self.plugins(),
+                    'capacity': self.capacity,
+                    'running': running,
+                })
+                for task_id in reply.get('cancel', []):
+                    self.cancel(task_id)
+                with self._lock:
+                    free = self.capacity - len(self.running)
+                if free > 0:
+                    for task in self.client.call('/claim', {})['tasks']:
+                        self.start(task)
+            except (OSError, ValueError) as exc:
+                log.warning('Server unreachable: %s', exc)
+            self._stop.wait(self.poll)
+
+    def stop(self):
+        self._stop.set()
+
+    def cancel(self, task_id):
+        """Stop the runner of a task the server no longer wants."""
+        with self._lock:
+            token = self.tokens.get(task_id)
+        if token is not None:
+            log.info('Cancelling task %s', task_id)
+            token.cancel()
+
+    def start(self, task):
+        thread = threading.Thread(
+            target=self.run_task, args=(task,), name=f'task-{task["id"]}', daemon=True
+        )
+        with self._lock:
+            # A task requeued back to this worker waits for its old run to stop
+            previous = self.running.get(task['id'])
+            self.running[task['id']] = thread
+        thread.start_after = previous
+        thread.start()
+
+    def run_task(self, task):
+        task_id = task['id']
+        task_dir = os.path.join(self.workdir, str(task_id))
+        previous = getattr(threading.current_thread(), 'start_after', None)
+        if previous is not None:
+            previous.join()
+        token = CancelToken(self.grace)
+        with self._lock:
+            self.tokens[task_id] = token
+        try:
+            self._run_task(task, task_dir, token)
+        except TaskLost:
+            log.warning('Task %s was cancelled or reassigned; abandoning it', task_id)
+        except Exception as exc:
+            log.exception('Task %s failed', task_id)
+            try:
+                self.client.call(f'/tasks/{task_id}/finish', {'status': 'FAILURE', 'error': str(exc)})
+            except (OSError, TaskLost):
+                pass
+        finally:
+            shutil.rmtree(task_dir, ignore_errors=True)
+            with self._lock:
+                if self.tokens.get(task_id) is token:
+                    del self.tokens[task_id]
+                if self.running.get(task_id) is threading.current_thread():
+                    del self.running[task_id]
+
+    def _run_task(self, task, task_dir, token):
+        task_id = task['id']
+        log.info('Running task %s (%s)', task_id, task['task_type'])
+        shutil.rmtree(task_dir, ignore_errors=True)
+        os.makedirs(task_dir)
+        for name in self.client.call(f'/tasks/{task_id}/files')['files']:
+            dest = os.path.join(task_dir, *name.split('/'))
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            self.client.download(task_id, name, dest)
+        inputs = set(os.listdir(task_dir))
+
+        task_conf = load_config().get(task['task_type'])
+        if task_conf is None:
+            raise RuntimeError(f"Plugin {task['task_type']} is not enabled on this worker")
+        cmd = build_command(task_conf, task['parameters'], SERVICE_ROOT)
+        log_path = os.path.join(task_dir, LOG_FILE)
+        state = {'offset': 0, 'sent': 0.0}
+
+        def on_progress(percent, message):
+            now = time.monotonic()
+            if now - state['sent'] < PROGRESS_INTERVAL:
+                return
+            state['sent'] = now
+            chunk, state['offset'] = read_log(log_path, state['offset'])
+            try:
+                self.client.call(f'/tasks/{task_id}/progress', {
+                    'progress': percent, 'message': message, 'log': chunk,
+                })
+            except TaskLost:
+                # Stop the runner instead of abandoning it mid-stream
+                token.cancel()
+            except OSError as exc:
+                log.warning('Could not report progress of task %s: %s', task_id, exc)
+
+        result = run_command(
+            cmd, task_dir, log_path, on_progress=on_progress,
+            max_bytes=self.max_bytes, backups=self.backups,
+            limits=task.get('limits') or task_conf.get('limits'),
+            cancel=token,
+            host=runner_host.pool.get(task_conf, cmd),
+        )
+        if result.cancelled:
+            raise TaskLost(f'/tasks/{task_id}')
+        status = 'SUCCESS' if result.returncode == 0 else 'FAILURE'
+        if status == 'FAILURE':
+            write_error_report(task_dir, result.output)
+
+        # Upload outputs the server will publish plus the full log
+        uploads = set(select_result_files(task_dir, task_conf.get('result_keep')))
+        uploads.update(n for n in os.listdir(task_dir) if n.startswith(LOG_FILE) or n == 'error.html')
+        for name in sorted(uploads - inputs):
+            path = os.path.join(task_dir, name)
+            if os.path.isdir(path):
+                for root, _, files in os.walk(path):
+                    for fname in files:
+                        full = os.path.join(root, fname)
+                        rel = os.path.relpath(full, task_dir).replace(os.sep, '/')
+                        self.client.upload(task_id, rel, full)
+            else:
+                self.client.upload(task_id, name, path)
+        self.client.call(f'/tasks/{task_id}/finish', {
+            'status': status,
+            'cpu_time': result.cpu_time,
+            'peak_rss_kb': result.peak_rss_kb,
+        })
+        log.info('Task %s finished: %s', task_id, status)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run plugin jobs for a remote task server.')
+    parser.add_argument('--server', required=True, help='Base URL of the task server')
+    parser.add_argument('--token', default=os.environ.get('WORKER_TOKEN'),
+                        help='Shared secret (default: WORKER_TOKEN)')
+    parser.add_argument('--name', default=socket.gethostname(), help='Unique worker name')
+    parser.add_argument('--capacity', type=int, default=1, help='Jobs run at the same time')
+    parser.add_argument('--workdir', default=os.path.join(os.getcwd(), 'worker_tasks'),
+                        help='Scratch directory for running tasks')
+    parser.add_argument('--poll', type=float, default=2.0, help='Seconds between heartbeats')
+    parser.add_argument('--grace', type=float, default=10.0,
+                        help='Seconds a cancelled runner gets before it is killed')
+    args = parser.parse_args()
+    if not args.token:
+        parser.error('--token or WORKER_TOKEN is required')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    worker = Worker(ServerClient(args.server, args.token, args.name), args.workdir,
+                    capacity=args.capacity, poll=args.poll, grace=args.grace)
+    log.info('Worker %s serving %s with capacity %d', args.name, ', '.join(worker.plugins()),
+             args.capacity)
+    try:
+        worker.loop()
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+if __name__ == '__main__':
+    main()
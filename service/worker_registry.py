@@ -0,0 +1,133 @@
+"""Track remote workers and decide where tasks run.
+
+Workers (see :mod:`service.worker`) report their plugins and capacity via
+heartbeats.  :func:`pick_worker` assigns a task to the live worker with
+the most free slots for its plugin; tasks are run by the local executor
+when no worker has room.  Worker processes sharing the server's database
+(see :mod:`service.serve`) register themselves with
+:func:`register_local` instead of the HTTP heartbeat.  Workers that stop sending heartbeats for
+``WORKER_TIMEOUT`` seconds are considered lost and their tasks requeued.
+"""
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from sqlalchemy import func
+
+from .models import db, Task, Worker
+
+
+def live_workers():
+    """Return workers whose last heartbeat is within ``WORKER_TIMEOUT``."""
+    cutoff = datetime.now() - timedelta(seconds=current_app.config['WORKER_TIMEOUT'])
+    return Worker.query.filter(Worker.last_heartbeat >= cutoff).all()
+
+
+def worker_loads():
+    """Unfinished tasks of every worker, counted in one query."""
+    rows = db.session.query(Task.worker, func.count(Task.id)).filter(
+        Task.worker.isnot(None),
+        Task.status.in_(('PENDING', 'RUNNING')),
+    ).group_by(Task.worker).all()
+    return dict(rows)
+
+
+def free_slots():
+    """Free slots of the live workers, ``{name: [plugins, free]}``.
+
+    Computed once per dispatch; :func:`pick_worker` decrements it.
+    """
+    loads = worker_loads()
+    return {
+        w.name: [set(w.plugins or []), w.capacity - loads.get(w.name, 0)]
+        for w in live_workers()
+    }
+
+
+def pick_worker(task_type, slots):
+    """Take a slot of the worker in ``slots`` with the most room for ``task_type``.
+
+    Returns the worker's name, or ``None`` when none has room.
+    """
+    best, best_free = None, 0
+    for name, (plugins, free) in slots.items():
+        if task_type in plugins and free > best_free:
+            best, best_free = name, free
+    if best is not None:
+        slots[best][1] -= 1
+    return best
+
+
+def requeue_lost_tasks():
+    """Give tasks of workers that stopped sending heartbeats to someone else.
+
+    Returns the ids of requeued tasks; the caller dispatches them again.
+    """
+    live = {w.name for w in live_workers()}
+    lost = Task.query.filter(
+        Task.worker.isnot(None),
+        Task.status.in_(('PENDING', 'RUNNING')),
+    ).all()
+    requeued = []
+    for task in lost:
+        if task.worker in live:
+            continue
+        current_app.logger.warning('Worker %s lost, requeueing task %s', task.worker, task.id)
+        task.requeue()
+        requeued.append(task.id)
+    if requeued:
+        db.session.commit()
+    return requeued
+
+
+def register_local(name, capacity, plugins):
+    """Create or refresh the worker row of a worker process on this host."""
+    worker = Worker.query.filter_by(name=name).first()
+    if worker is None:
+        worker = Worker(name=name)
+        db.session.add(worker)
+        current_app.logger.info('Worker process %s registered', name)
+    worker.host = socket.gethostname()[:120]
+    worker.plugins = list(plugins)
+    worker.capacity = capacity
+    worker.local = True
+    worker.last_heartbeat = datetime.now()
+    db.session.commit()
+
+
+def is_local(name):
+    """Whether ``name`` is a worker process writing to the outputs directory itself."""
+    return name is not None and Worker.query.filter_by(name=name, local=True).count() > 0
+
+
+def unregister(name):
+    """Remove the row of worker ``name``; its tasks must have been requeued."""
+    Worker.query.filter_by(name=name).delete()
+    db.session.commit()
+
+
+def start_worker_monitor(app):
+    """Requeue tasks of lost workers every ``WORKER_TIMEOUT`` seconds."""
+    from .tasks import dispatch
+
+    interval = app.config['WORKER_TIMEOUT']
+    uses_workers = app.config.get('WORKER_TOKEN') or app.config['PROCESS_ROLE'] != 'all'
+    if not uses_workers or interval <= 0:
+        return None
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                with app.app_context():
+                    if requeue_lost_tasks():
+                        dispatch()
+            except Exception:  # pragma: no cover - keep the monitor alive
+                app.logger.exception('Worker monitor failed')
+
+    thread = threading.Thread(target=loop, name='worker-monitor', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,198 @@
+"""HTTP API used by remote workers (see :mod:`service.worker`).
+
+Requests must carry the shared secret from ``WORKER_TOKEN`` in the
+``X-Worker-Token`` header and the worker's name in ``X-Worker-Name``.
+The API is disabled while ``WORKER_TOKEN`` is unset.
+"""
+import hmac
+import os
+from datetime import datetime
+
+from flask import Blueprint, abort, current_app, g, request, send_from_directory
+from werkzeug.security import safe_join
+
+from .config_utils import load_config, task_output_dir
+from .execution import LOG_FILE, RotatingLog, write_error_report
+from .models import db, Task, Worker, bump_task_version
+from .worker_registry import requeue_lost_tasks
+
+worker_bp = Blueprint('worker', __name__, url_prefix='/api/workers')
+
+_CHUNK = 1024 * 1024
+
+
+@worker_bp.before_request
+def _authenticate():
+    expected = current_app.config.get('WORKER_TOKEN')
+    if not expected:
+        abort(404)
+    token = request.headers.get('X-Worker-Token', '')
+    if not hmac.compare_digest(token.encode(), expected.encode()):
+        abort(403)
+    g.worker_name = request.headers.get('X-Worker-Name', '')
+    if not g.worker_name:
+        abort(400)
+
+
+def _owned_task(task_id):
+    """Return task ``task_id`` if the calling worker is running it.
+
+    Answers 409 when the task was cancelled or handed to another worker,
+    which tells the worker to abandon it.
+    """
+    task = db.session.get(Task, task_id)
+    if task is None:
+        abort(404)
+    if task.worker != g.worker_name or task.status != 'RUNNING':
+        abort(409)
+    return task
+
+
+@worker_bp.route('/heartbeat', methods=['POST'], endpoint='heartbeat')
+def heartbeat():
+    """Register the worker or refresh its plugins, capacity and liveness.
+
+    The reply lists the ``running`` tasks the worker must stop.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        running = [int(task_id) for task_id in data.get('running') or []]
+        capacity = max(0, int(data.get('capacity') or 0))
+    except (TypeError, ValueError):
+        abort(400)
+    worker = Worker.query.filter_by(name=g.worker_name).first()
+    if worker is None:
+        worker = Worker(name=g.worker_name)
+        db.session.add(worker)
+        current_app.logger.info('Worker %s registered', g.worker_name)
+    worker.host = str(data.get('host') or request.remote_addr)[:120]
+    worker.plugins = [str(p) for p in data.get('plugins') or []]
+    worker.capacity = capacity
+    worker.last_heartbeat = datetime.now()
+    db.session.commit()
+
+    from .tasks import dispatch
+
+    requeue_lost_tasks()
+    dispatch()
+    # Tasks the worker runs that were cancelled, preempted or reassigned
+    cancel = []
+    for task_id in running:
+        task = db.session.get(Task, task_id)
+        if task is None or task.worker != g.worker_name or task.status != 'RUNNING':
+            cancel.append(task_id)
+    return {'status': 'ok', 'cancel': cancel}
+
+
+@worker_bp.route('/claim', methods=['POST'], endpoint='claim')
+def claim():
+    """Mark the worker's pending tasks as running and return them."""
+    configs = load_config(enabled_only=False)
+    pending = Task.query.filter_by(worker=g.worker_name, status='PENDING').order_by(Task.id).all()
+    claimed = []
+    for task in pending:
+        # Conditional update so a task requeued concurrently is not run twice
+        updated = Task.query.filter_by(
+            id=task.id, worker=g.worker_name, status='PENDING'
+        ).update({'status': 'RUNNING', 'start_time': datetime.now()})
+        if updated:
+            bump_task_version(db.session, user_ids=[task.user_id])
+        db.session.commit()
+        if not updated:
+            continue
+        claimed.append({
+            'id': task.id,
+            'task_type': task.task_type,
+            'parameters': task.parameters,
+            'limits': configs.get(task.task_type, {}).get('limits') or {},
+        })
+    return {'tasks': claimed}
+
+
+@worker_bp.route('/tasks/<int:task_id>/files', endpoint='list_files')
+def list_files(task_id):
+    """List the input files uploaded with the task."""
+    _owned_task(task_id)
+    output_dir = task_output_dir(task_id)
+    files = []
+    for root, _, names in os.walk(output_dir):
+        for name in names:
+            files.append(os.path.relpath(os.path.join(root, name), output_dir).replace(os.sep, '/'))
+    return {'files': sorted(files)}
+
+
+@worker_bp.route('/tasks/<int:task_id>/files/<path:filename>', methods=['GET'], endpoint='get_file')
+def get_file(task_id, filename):
+    _owned_task(task_id)
+    return send_from_directory(task_output_dir(task_id), filename)
+
+
+@worker_bp.route('/tasks/<int:task_id>/files/<path:filename>', methods=['PUT'], endpoint='put_file')
+def put_file(task_id, filename):
+    """Store a result file uploaded by the worker."""
+    _owned_task(task_id)
+    output_dir = task_output_dir(task_id)
+    path = safe_join(output_dir, filename)
+    if path is None:
+        abort(400)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Stream to a temporary name so readers never see a partial file
+    tmp = path + '.part'
+    with open(tmp, 'wb') as f:
+        while True:
+            chunk = request.stream.read(_CHUNK)
+            if not chunk:
+                break
+            f.write(chunk)
+    os.replace(tmp, path)
+    return {'status': 'ok'}
+
+
+@worker_bp.route('/tasks/<int:task_id>/progress', methods=['POST'], endpoint='progress')
+def progress(task_id):
+    """Record progress and append new runner output to the task log."""
+    task = _owned_task(task_id)
+    data = request.get_json(silent=True) or {}
+    if data.get('progress') is not None:
+        try:
+            task.progress = int(data['progress'])
+        except (TypeError, ValueError):
+            abort(400)
+        task.progress_message = str(data.get('message') or '')[:255]
+        db.session.commit()
+    if data.get('log'):
+        output_dir = task_output_dir(task_id)
+        os.makedirs(output_dir, exist_ok=True)
+        # Rotated like the log of a local run so a chatty runner cannot fill the disk
+        max_bytes = current_app.config['LOG_MAX_BYTES']
+        text = str(data['log'])
+        encoded = text.encode('utf-8')
+        if max_bytes and len(encoded) > max_bytes:
+            text = encoded[-max_bytes:].decode('utf-8', errors='ignore')
+        log = RotatingLog(os.path.join(output_dir, LOG_FILE), max_bytes, current_app.config['LOG_BACKUPS'])
+        try:
+            log.write(text)
+        finally:
+            log.close()
+    return {'status': 'ok'}
+
+
+@worker_bp.route('/tasks/<int:task_id>/finish', methods=['POST'], endpoint='finish')
+def finish(task_id):
+    """Publish the uploaded results and record the final status."""
+    from .tasks import dispatch, finish_task
+
+    task = _owned_task(task_id)
+    data = request.get_json(silent=True) or {}
+    status = 'SUCCESS' if data.get('status') == 'SUCCESS' else 'FAILURE'
+    task.cpu_time = data.get('cpu_time')
+    task.peak_rss_kb = data.get('peak_rss_kb')
+    output_dir = task_output_dir(task_id)
+    os.makedirs(output_dir, exist_ok=True)
+    if status == 'FAILURE' and data.get('error'):
+        write_error_report(output_dir, data['error'])
+    task_conf = load_config(enabled_only=False).get(task.task_type, {})
+    if not finish_task(task, status, task_conf):
+        abort(409)
+    dispatch()
+    return {'status': 'ok'}